@@ -0,0 +1,91 @@
+import threading
+from collections import Counter
+
+# Admission control for the server.
+#
+# Without limits every accepted socket gets a reader (a thread in threaded
+# mode) and every request goes straight onto the executor's queue, so a burst
+# of clients or a flood of requests grows memory and latency without bound
+# until the whole server is slow for everyone. Instead the server sheds load at
+# the door:
+#
+#   connections: at most max_connections open sockets, and at most per_ip from
+#                any one address; a connection past either limit is sent a
+#                "busy" event and closed straight away
+#   requests:    at most max_pending requests queued or running on the worker
+#                pool; a request past that is answered SERVER_BUSY unrun, so
+#                the client can back off and retry instead of waiting blind
+#   idle:        a connection that sends nothing (not even a heartbeat) for
+#                idle_timeout seconds is closed and its slot freed
+#
+# A limit of 0 means unlimited. All counters are shown by the stats request.
+
+
+class AdmissionControl:
+    def __init__(self, max_connections=0, per_ip=0, max_pending=0, idle_timeout=0):
+        self.max_connections = max_connections
+        self.per_ip = per_ip
+        self.max_pending = max_pending
+        self.idle_timeout = idle_timeout
+
+        self.lock = threading.Lock()
+        self.by_ip = Counter()
+        self.connections = 0
+        self.pending = 0
+        self.counters = {'peak_connections': 0, 'peak_pending': 0, 'rejected_connections': 0,
+                         'rejected_requests': 0, 'idle_closed': 0}
+
+    def admit(self, ip):
+        # returns None when the connection may stay, otherwise why it may not
+        with self.lock:
+            if self.max_connections and self.connections >= self.max_connections:
+                reason = f"server full ({self.max_connections} connections)"
+            elif self.per_ip and self.by_ip[ip] >= self.per_ip:
+                reason = f"too many connections from {ip} ({self.per_ip} allowed)"
+            else:
+                self.connections += 1
+                self.by_ip[ip] += 1
+                self.counters['peak_connections'] = max(self.counters['peak_connections'], self.connections)
+                return None
+            self.counters['rejected_connections'] += 1
+            return reason
+
+    def release(self, ip):
+        with self.lock:
+            if self.by_ip[ip] <= 0:
+                return  # never admitted, or already released
+            self.connections -= 1
+            self.by_ip[ip] -= 1
+            if not self.by_ip[ip]:
+                del self.by_ip[ip]
+
+    def begin_request(self):
+        # False when the worker pool already has max_pending requests
+        with self.lock:
+            if self.max_pending and self.pending >= self.max_pending:
+                self.counters['rejected_requests'] += 1
+                return False
+            self.pending += 1
+            self.counters['peak_pending'] = max(self.counters['peak_pending'], self.pending)
+            return True
+
+    def end_request(self):
+        with self.lock:
+            self.pending -= 1
+
+    def record_idle_close(self):
+        with self.lock:
+            self.counters['idle_closed'] += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'connections': self.connections,
+                'addresses': len(self.by_ip),
+                'pending_requests': self.pending,
+                **self.counters,
+                'max_connections': self.max_connections,
+                'max_per_ip': self.per_ip,
+                'max_pending': self.max_pending,
+                'idle_timeout': self.idle_timeout,
+            }
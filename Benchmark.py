@@ -0,0 +1,386 @@
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import platform
+import argparse
+import datetime
+from io import BytesIO
+
+try:
+    from PIL import Image
+except ImportError:  # without Pillow the generated images are random bytes and get no thumbnails
+    Image = None
+
+# Synthetic marketplace data and microbenchmarks of the server's hot queries.
+#
+# The server always opens marketplace.db in its working directory, so a
+# dataset is a directory holding one. generate creates it by importing
+# ServerGUI there (the real schema, indexes and triggers) and bulk-inserting
+# users, products with images, chat messages, transactions and ratings through
+# those triggers, so the derived tables (conversations, rating totals, search
+# index, catalog log) end up exactly as the server would have built them.
+#
+# run times the server's own helpers against a dataset (the helpers, not the
+# protocol; LoadGenerator.py covers that) and writes the results as JSON.
+# compare checks a run against an earlier one and exits with status 1 when any
+# benchmark got slower than --threshold times its baseline.
+#
+#   python Benchmark.py generate bench --users 50000 --products 100000 --messages 5000000 --transactions 500000
+#   python Benchmark.py run bench --json before.json
+#   python Benchmark.py run bench --json after.json --compare before.json
+
+BATCH = 50000  # rows per executemany and per commit while generating
+WORDS = ("vintage lamp desk chair textbook calculus physics notes bike helmet laptop stand monitor cable "
+         "keyboard mouse headphones speaker jacket hoodie boots backpack mug kettle blender fan heater "
+         "poster frame plant shelf mirror rug pillow blanket charger tripod camera lens guitar amp").split()
+STATUSES = (('completed', 60), ('declined', 15), ('pending', 15), ('approved', 10))
+NOISE_FLOOR_MS = 0.05  # changes smaller than this are never called regressions
+
+
+def timestamp(seconds):
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def make_image(rng, size_kb):
+    # a noisy JPEG compresses about as badly as a phone photo; random bytes without Pillow
+    if Image is None:
+        return rng.randbytes(size_kb * 1024)
+    side = max(32, int((size_kb * 1024 / 1.2) ** 0.5))
+    img = Image.frombytes('RGB', (side, side), rng.randbytes(side * side * 3))
+    buffer = BytesIO()
+    img.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def open_dataset(directory, create=False):
+    # imports ServerGUI inside the dataset directory, which creates or migrates its marketplace.db
+    path = os.path.abspath(os.path.join(directory, 'marketplace.db'))
+    if create:
+        if os.path.exists(path):
+            raise SystemExit(f"{path} already exists; generate into a new directory")
+        os.makedirs(directory, exist_ok=True)
+    elif not os.path.exists(path):
+        raise SystemExit(f"No marketplace.db in {directory}; run generate first")
+    os.chdir(directory)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import ServerGUI
+    return ServerGUI
+
+
+def insert_batches(conn, query, rows, label, total):
+    # rows: an iterable of parameter tuples; committed every BATCH rows with progress
+    cursor = conn.cursor()
+    batch = []
+    done = 0
+    started = time.perf_counter()
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH:
+            cursor.executemany(query, batch)
+            conn.commit()
+            done += len(batch)
+            batch = []
+            print(f"\r{label}: {done}/{total} ({done / (time.perf_counter() - started):.0f}/s)", end='', flush=True)
+    if batch:
+        cursor.executemany(query, batch)
+        conn.commit()
+        done += len(batch)
+    print(f"\r{label}: {done}/{total} in {time.perf_counter() - started:.1f}s" + " " * 20)
+    cursor.close()
+
+
+def summarize(samples):
+    # exact percentiles: a benchmark keeps every sample, unlike the server's histograms
+    ordered = sorted(samples)
+
+    def at(fraction):
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 3)
+
+    return {
+        'count': len(ordered),
+        'avg_ms': round(sum(ordered) / len(ordered) * 1000, 3),
+        'p50_ms': at(0.50),
+        'p95_ms': at(0.95),
+        'p99_ms': at(0.99),
+        'max_ms': round(ordered[-1] * 1000, 3),
+    }
+
+
+def generate(directory, users, products, images, image_kb, messages, conversations, transactions,
+             rated, unread, seed):
+    server = open_dataset(directory, create=True)
+    rng = random.Random(seed)
+    conn = sqlite3.connect('marketplace.db')
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = OFF")  # a half-written dataset is just generated again
+    conn.execute("PRAGMA cache_size = -262144")
+    start = time.time() - 365 * 24 * 3600  # a year of history up to now
+
+    usernames = [f"student{i:06d}" for i in range(users)]
+    insert_batches(conn, "INSERT INTO infoList (username, password, real_name, bio) VALUES (?, ?, ?, ?)",
+                   ((name, 'password', f"Student {i}", f"Bio of student {i}") for i, name in enumerate(usernames)),
+                   "users", users)
+
+    # a fifth of the students sell; a few of them list a lot
+    sellers = usernames[:max(1, users // 5)]
+    seller_weights = [1.0 / (rank + 1) ** 0.7 for rank in range(len(sellers))]
+
+    cursor = conn.cursor()
+    hashes = []
+    started = time.perf_counter()
+    for i in range(images):
+        hashes.append(server.put_image(cursor, make_image(rng, image_kb), ('card', 'detail')))
+        if i % 500 == 499:
+            conn.commit()
+            print(f"\rimages: {i + 1}/{images}", end='', flush=True)
+    conn.commit()
+    print(f"\rimages: {images}/{images} in {time.perf_counter() - started:.1f}s" + " " * 20)
+
+    catalog = []  # (product_name, seller)
+    owners = rng.choices(sellers, seller_weights, k=products)
+    for i, seller in enumerate(owners):
+        catalog.append((f"{rng.choice(WORDS)} {rng.choice(WORDS)} {i}", seller))
+    insert_batches(conn, """INSERT INTO productList (product_name, user_name, description, price, quantity, image_hash)
+                            VALUES (?, ?, ?, ?, ?, ?)""",
+                   ((name, seller, " ".join(rng.choices(WORDS, k=12)), round(rng.uniform(1, 500), 2),
+                     rng.randint(0, 20), rng.choice(hashes) if hashes else None) for name, seller in catalog),
+                   "products", products)
+
+    # conversations between random pairs, a few of them very busy; messages
+    # interleave in time across conversations, the newest ones partly unread
+    pairs = [tuple(rng.sample(usernames, 2)) for _ in range(conversations)] if users > 1 else []
+    pair_weights = [rng.paretovariate(1.2) for _ in pairs]
+    step = 365 * 24 * 3600 / max(messages, 1)
+
+    def message_rows():
+        for offset in range(0, messages, BATCH):
+            chosen = rng.choices(pairs, pair_weights, k=min(BATCH, messages - offset))
+            for i, (first, second) in enumerate(chosen, offset):
+                sender, receiver = (first, second) if rng.random() < 0.5 else (second, first)
+                is_read = 0 if i >= messages * (1 - unread) and rng.random() < 0.5 else 1
+                yield (sender, receiver, f"message {i} about the {rng.choice(WORDS)}", timestamp(start + i * step),
+                       is_read)
+
+    if pairs:
+        insert_batches(conn, """INSERT INTO chat_messages (sender, receiver, message, timestamp, is_read)
+                                VALUES (?, ?, ?, ?, ?)""", message_rows(), "chat messages", messages)
+
+    statuses, status_weights = zip(*STATUSES)
+    step = 365 * 24 * 3600 / max(transactions, 1)
+    completed = []
+
+    def transaction_rows():
+        for i in range(transactions):
+            product, seller = rng.choice(catalog)
+            buyer = rng.choice(usernames)
+            status = rng.choices(statuses, status_weights)[0]
+            if status == 'completed':
+                completed.append((buyer, product, seller))
+            when = timestamp(start + i * step)
+            yield f"{i:08x}", buyer, seller, product, when[:10], 1, status, when
+
+    if catalog:
+        insert_batches(conn, """INSERT INTO transactions (id, buyer, seller, product, date, quantity, status, created_at)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?)""", transaction_rows(), "transactions", transactions)
+    insert_batches(conn, "INSERT INTO buyers (seller_username, product_name, buyer_username) VALUES (?, ?, ?)",
+                   ((seller, product, buyer) for buyer, product, seller in completed), "purchases", len(completed))
+
+    ratings = [purchase for purchase in completed if rng.random() < rated]
+    insert_batches(conn, "INSERT INTO product_ratings (product_name, seller, buyer, rating) VALUES (?, ?, ?, ?)",
+                   ((product, seller, buyer, rng.randint(1, 5)) for buyer, product, seller in ratings),
+                   "product ratings", len(ratings))
+    insert_batches(conn, "INSERT INTO buyer_ratings (buyer, rating, rated_by) VALUES (?, ?, ?)",
+                   ((seller, rng.randint(1, 5), buyer) for buyer, product, seller in ratings),
+                   "user ratings", len(ratings))
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+    print(f"Dataset written to {os.path.abspath('marketplace.db')} "
+          f"({os.path.getsize('marketplace.db') / 1024 / 1024:.0f} MiB)")
+
+
+def dataset_summary(cursor):
+    summary = {}
+    for table in ('infoList', 'productList', 'images', 'chat_messages', 'conversations', 'transactions',
+                  'product_ratings'):
+        cursor.execute(f"SELECT COUNT(*) FROM {table}")
+        summary[table] = cursor.fetchone()[0]
+    cursor.execute("SELECT COALESCE(SUM(unread), 0) FROM conversations")
+    summary['unread_messages'] = cursor.fetchone()[0]
+    return summary
+
+
+def benchmarks(server, cursor, rng):
+    # name -> (function, argument picker, iterations as a fraction of --iterations)
+    cursor.execute("SELECT username FROM infoList")
+    users = [row[0] for row in cursor.fetchall()]
+    cursor.execute("SELECT seller FROM product_rating_totals ORDER BY rating_count DESC LIMIT 1000")
+    sellers = [row[0] for row in cursor.fetchall()] or users
+    cursor.execute("SELECT username FROM conversations ORDER BY unread DESC, last_message_id DESC LIMIT 1000")
+    chatters = [row[0] for row in cursor.fetchall()] or users
+    cursor.execute("SELECT username, partner, last_message_id FROM conversations ORDER BY last_message_id DESC LIMIT 2000")
+    pairs = cursor.fetchall()
+    cursor.execute("SELECT product_name, user_name FROM productList ORDER BY rowid DESC LIMIT 2000")
+    products = cursor.fetchall()
+    version = server.get_catalog_version(cursor)
+
+    def with_reader(function):
+        def call(*args):
+            connection = server.get_read_connection()
+            try:
+                return function(connection.cursor(), *args)
+            finally:
+                connection.close()
+        return call
+
+    def chat_pair():
+        return rng.choice(pairs)[:2] if pairs else (rng.choice(users), rng.choice(users))
+
+    def older_chat_page():
+        user, partner, last_id = rng.choice(pairs)
+        return user, partner, rng.randint(1, last_id), None
+
+    def catalog_cursor():
+        return 24, server.encode_catalog_cursor(*rng.choice(products)) if products else ""
+
+    return {
+        'catalog_snapshot': (with_reader(server.build_catalog_snapshot), lambda: (version,), 0.05),
+        'catalog_page': (server.get_product_page, catalog_cursor, 1),
+        'search_products': (server.search_products, lambda: (rng.choice(WORDS), 24), 1),
+        'product_info': (server.get_product_info, lambda: rng.choice(products) if products else ("", ""), 1),
+        'chat_history': (server.get_chat_history, chat_pair, 1),
+        'chat_page_older': (server.get_chat_page, older_chat_page, 1) if pairs else None,
+        'conversations': (server.get_conversations, lambda: (rng.choice(chatters),), 1),
+        'user_profile': (server.get_user_profile, lambda: (rng.choice(sellers),), 1),
+        'user_transactions': (server.get_user_transactions, lambda: (rng.choice(users),), 1),
+        'purchase_history': (server.get_user_purchase_history, lambda: (rng.choice(sellers),), 1),
+        'unread_messages': (server.get_unread_messages, lambda: (rng.choice(chatters),), 1),
+        'unread_counts': (with_reader(server.read_unread_counts), lambda: (rng.choice(chatters),), 1),
+    }
+
+
+def run(directory, iterations, seed, only=None):
+    server = open_dataset(directory)
+    rng = random.Random(seed)
+    pool = server.get_pool()
+    connection = pool.reader()
+    cursor = connection.cursor()
+    summary = dataset_summary(cursor)
+    suite = benchmarks(server, cursor, rng)
+    cursor.close()
+    connection.close()
+
+    results = {}
+    for name, bench in suite.items():
+        if bench is None or (only and name not in only):
+            continue
+        function, pick, share = bench
+        count = max(3, int(iterations * share))
+        function(*pick())  # warm-up, not recorded
+        samples = []
+        db_seconds = 0.0
+        for _ in range(count):
+            args = pick()
+            pool.take_thread_time()
+            started = time.perf_counter()
+            function(*args)
+            samples.append(time.perf_counter() - started)
+            db_seconds += pool.take_thread_time()
+        result = results[name] = summarize(samples)
+        result['db_ms'] = round(db_seconds / count * 1000, 3)
+        print(f"{name:>18}: {count:>5} calls, p50 {result['p50_ms']:>9} ms, p95 {result['p95_ms']:>9} ms, "
+              f"max {result['max_ms']:>9} ms, {result['db_ms']} ms in SQLite")
+
+    return {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'pillow': Image is not None,
+        'dataset': summary,
+        'iterations': iterations,
+        'results': results,
+    }
+
+
+def compare(baseline, current, threshold, metric='p50_ms'):
+    # returns the names of benchmarks that got slower than threshold x their baseline
+    regressed = []
+    if baseline.get('dataset') != current.get('dataset'):
+        print("Note: the runs used different datasets; the comparison may not mean much")
+    print(f"{'benchmark':>18} {'before':>10} {'after':>10} {'ratio':>7}  ({metric})")
+    for name, result in current['results'].items():
+        before = baseline['results'].get(name)
+        if before is None:
+            print(f"{name:>18} {'-':>10} {result[metric]:>10}      new")
+            continue
+        ratio = result[metric] / before[metric] if before[metric] else float('inf')
+        slower = ratio > threshold and result[metric] - before[metric] > NOISE_FLOOR_MS
+        if slower:
+            regressed.append(name)
+        print(f"{name:>18} {before[metric]:>10} {result[metric]:>10} {ratio:>7.2f}"
+              f"{'  REGRESSED' if slower else ''}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Marketplace dataset generator and query benchmarks")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    make = commands.add_parser('generate', help="fill a new dataset directory with synthetic data")
+    make.add_argument('directory')
+    make.add_argument('--users', type=int, default=50000)
+    make.add_argument('--products', type=int, default=100000)
+    make.add_argument('--images', type=int, default=5000, help="distinct product images, shared by the products")
+    make.add_argument('--image-kb', type=int, default=24, help="approximate size of each image")
+    make.add_argument('--messages', type=int, default=5000000)
+    make.add_argument('--conversations', type=int, default=200000, help="user pairs the messages are spread over")
+    make.add_argument('--transactions', type=int, default=500000)
+    make.add_argument('--rated', type=float, default=0.5, help="fraction of completed purchases that were rated")
+    make.add_argument('--unread', type=float, default=0.02, help="newest fraction of messages that may be unread")
+    make.add_argument('--seed', type=int, default=1)
+
+    bench = commands.add_parser('run', help="time the server's hot queries against a dataset")
+    bench.add_argument('directory')
+    bench.add_argument('--iterations', type=int, default=200, help="calls per benchmark (the snapshot gets 5%%)")
+    bench.add_argument('--only', nargs='*', help="run just these benchmarks")
+    bench.add_argument('--seed', type=int, default=1)
+    bench.add_argument('--json', default=None, help="write the results to this file")
+    bench.add_argument('--compare', default=None, help="results file of an earlier run to check against")
+    bench.add_argument('--threshold', type=float, default=1.25,
+                       help="slower than this many times the baseline p50 counts as a regression")
+
+    check = commands.add_parser('compare', help="compare two results files")
+    check.add_argument('baseline')
+    check.add_argument('current')
+    check.add_argument('--threshold', type=float, default=1.25)
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        generate(args.directory, args.users, args.products, args.images, args.image_kb, args.messages,
+                 args.conversations, args.transactions, args.rated, args.unread, args.seed)
+        return
+
+    if args.command == 'compare':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        raise SystemExit(1 if compare(baseline, current, args.threshold) else 0)
+
+    # paths given on the command line are relative to where it was typed, not the dataset
+    output = os.path.abspath(args.json) if args.json else None
+    baseline_path = os.path.abspath(args.compare) if args.compare else None
+    results = run(args.directory, args.iterations, args.seed, args.only)
+    if output:
+        with open(output, 'w') as out:
+            json.dump(results, out, indent=2)
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        raise SystemExit(1 if compare(baseline, results, args.threshold) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,8 @@ import base64
 from PIL import Image, ImageTk
 from io import BytesIO
 
+HISTORY_PAGE_SIZE = 50
+
 class ChatWindow:
     
     def __init__(self, parent_app, other_user, product_name=None, auto_message=None):
@@ -21,7 +23,13 @@ class ChatWindow:
         self.displayed_message_ids = set()  # prevents duplicates
         self.proposal_denied = False
         
+        # history fetched so far for this conversation, kept by the app so that
+        # reopening the chat only asks for messages newer than the last one
+        self.history = parent_app.chat_histories.setdefault(other_user, {'messages': [], 'done': False})
+        self.history_loading = False
+        
         self.setup_ui()
+        self.register_chat()
         self.load_history()
         self.check_online_status()
         self.start_polling()
@@ -70,6 +78,7 @@ class ChatWindow:
             wrap=tk.WORD
         )
         self.chat_display.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        self.chat_display.configure(yscrollcommand=self.on_history_scroll)  # older pages load at the top
         self.chat_display.tag_config("me", foreground="#4ade80")  # colors for different senders
         self.chat_display.tag_config("them", foreground="#60a5fa")
         
@@ -98,51 +107,119 @@ class ChatWindow:
                  border=0,
                  padx=10,
                  pady=8).pack(side=tk.LEFT)
-                # cleanup when window closes        self.window.protocol("WM_DELETE_WINDOW", self.on_close)
+        
+        # cleanup when window closes
+        self.window.protocol("WM_DELETE_WINDOW", self.on_close)
+    
+    def register_chat(self):
+        """Tell the server this chat is open so presence changes are pushed to us"""
+        def do_register():
+            try:
+                self.app.client.request("26", self.other_user)
+            except Exception as e:
+                print(f"Error registering chat: {e}")
+        
+        threading.Thread(target=do_register, daemon=True).start()
     
     def load_history(self):
-        """Load chat history from server"""
+        """Show the history we already have, then fetch only what is newer (or the latest page)"""
+        cached = self.history['messages']
+        if cached:
+            self.display_history(cached)
+        after_id = cached[-1][0] if cached else ""
+        self.history_loading = True
+        
         def do_load():
+            messages, older_remaining = [], None
             try:
-                with self.app.client_lock:
-                    self.app.client.send("6".encode('utf-8'))
-                    # Pad recipient to 1024 bytes for consistency
-                    recipient_padded = self.other_user.encode('utf-8').ljust(1024, b'\0')
-                    self.app.client.send(recipient_padded)
-                    
-                    response = self.app.client.recv(1).decode('utf-8')
-                    if response == '1':
-                        length = int.from_bytes(self.app.client.recv(16), 'big')
-                        data = b""
-                        while len(data) < length:
-                            packet = self.app.client.recv(4096)
-                            if not packet:
-                                break
-                            data += packet
-                        
-                        if data:
-                            history = json.loads(data.decode('utf-8'))
-                            self.app.root.after(0, lambda: self.display_history(history))
-                            
-                            # Mark messages from this user as read
-                            self.mark_messages_read()
+                cursor = after_id
+                while True:
+                    # reply: 1, [id, sender, message, timestamp] oldest first, 1 if more remain
+                    # (newer ones after an after_id, older ones otherwise)
+                    reply = self.app.client.request("40", self.other_user, "", cursor, HISTORY_PAGE_SIZE)
+                    if reply[0] != b'1':
+                        break
+                    page = json.loads(reply[1].decode('utf-8'))
+                    more = reply[2] == b'1'
+                    messages += page
+                    if not cursor:
+                        older_remaining = more  # the latest page
+                        break
+                    if not more or not page:
+                        break
+                    cursor = page[-1][0]
+                
+                # Mark messages from this user as read
+                self.mark_messages_read()
             except Exception as e:
                 print(f"Error loading history: {e}")
+            self.app.root.after(0, lambda: self.add_newer_history(messages, older_remaining))
+        
+        threading.Thread(target=do_load, daemon=True).start()
+    
+    def add_newer_history(self, messages, older_remaining):
+        if older_remaining is not None:
+            self.history['done'] = not older_remaining
+        self.history['messages'].extend(messages)
+        self.history_loading = False
+        try:
+            if self.window.winfo_exists():
+                self.display_history(messages)
+        except tk.TclError:
+            pass
+    
+    def on_history_scroll(self, first, last):
+        self.chat_display.vbar.set(first, last)
+        if float(first) <= 0.0:
+            self.load_older_history()
+    
+    def load_older_history(self):
+        """Fetch the page before the oldest message shown"""
+        if self.history_loading or self.history['done'] or not self.history['messages']:
+            return
+        self.history_loading = True
+        before_id = self.history['messages'][0][0]
+        
+        def do_load():
+            page, more = [], True
+            try:
+                reply = self.app.client.request("40", self.other_user, before_id, "", HISTORY_PAGE_SIZE)
+                if reply[0] == b'1':
+                    page = json.loads(reply[1].decode('utf-8'))
+                    more = reply[2] == b'1'
+            except Exception as e:
+                print(f"Error loading older messages: {e}")
+            self.app.root.after(0, lambda: self.prepend_history(page, more))
         
         threading.Thread(target=do_load, daemon=True).start()
     
+    def prepend_history(self, page, more):
+        self.history['messages'][:0] = page
+        self.history['done'] = not more
+        self.history_loading = False
+        try:
+            if not page or not self.window.winfo_exists():
+                return
+        except tk.TclError:
+            return
+        
+        self.chat_display.config(state=tk.NORMAL)
+        lines = 0
+        for _, sender, message, timestamp in reversed(page):
+            self.displayed_message_ids.add(f"{sender}:{message[:50]}:{timestamp}")
+            text, tag = self.history_line(sender, message)
+            self.chat_display.insert("1.0", text, tag)
+            lines += text.count("\n")
+        self.chat_display.config(state=tk.DISABLED)
+        self.chat_display.yview(f"{lines + 1}.0")  # keep what was on screen in place
+    
     def mark_messages_read(self):
         """Mark all messages from other_user as read"""
         def do_mark():
             try:
-                with self.app.client_lock:
-                    self.app.client.send("30".encode('utf-8'))  # Mark read command
-                    sender_padded = self.other_user.encode('utf-8').ljust(1024, b'\0')
-                    self.app.client.send(sender_padded)
-                    self.app.client.recv(1)  # Acknowledgment
-                    # Update local unread count
-                    if self.other_user in self.app.unread_messages:
-                        self.app.unread_messages[self.other_user] = 0
+                self.app.client.request("30", self.other_user)  # Mark read command
+                # Update local unread count
+                self.app.root.after(0, lambda: self.app.clear_unread(self.other_user))
             except Exception as e:
                 print(f"Error marking messages read: {e}")
         
@@ -154,18 +231,23 @@ class ChatWindow:
             return
         
         self.chat_display.config(state=tk.NORMAL)
-        for sender, message, timestamp in history:
+        for _, sender, message, timestamp in history:
             # Track message by creating unique ID from sender+message+timestamp
             msg_id = f"{sender}:{message[:50]}:{timestamp}"
+            if msg_id in self.displayed_message_ids:
+                continue  # already pushed to us while the history loaded
             self.displayed_message_ids.add(msg_id)
             
-            if sender == self.app.username:
-                self.chat_display.insert(tk.END, f"You: {message}\n", "me")
-            else:
-                self.chat_display.insert(tk.END, f"{sender}: {message}\n", "them")
+            text, tag = self.history_line(sender, message)
+            self.chat_display.insert(tk.END, text, tag)
         self.chat_display.config(state=tk.DISABLED)
         self.chat_display.see(tk.END)
     
+    def history_line(self, sender, message):
+        if sender == self.app.username:
+            return f"You: {message}\n", "me"
+        return f"{sender}: {message}\n", "them"
+    
     def send_message(self):
         """Send message to server"""
         message = self.msg_entry.get().strip()
@@ -206,18 +288,10 @@ class ChatWindow:
         # Send to server
         def do_send():
             try:
-                with self.app.client_lock:
-                    self.app.client.send("7".encode('utf-8'))
-                    # Pad recipient to 1024 bytes
-                    recipient_padded = self.other_user.encode('utf-8').ljust(1024, b'\0')
-                    self.app.client.send(recipient_padded)
-                    # Pad message to 4096 bytes
-                    message_padded = message.encode('utf-8').ljust(4096, b'\0')
-                    self.app.client.send(message_padded)
-                    response = self.app.client.recv(1).decode('utf-8')
-                    
-                    if response != '1':
-                        print(f"Server response: {response}")
+                reply = self.app.client.request("7", self.other_user, message)
+                
+                if reply[0] != b'1':
+                    print(f"Server response: {reply[0]}")
             except Exception as e:
                 print(f"Send error: {e}")
                 import traceback
@@ -239,30 +313,21 @@ class ChatWindow:
         
         def check():
             try:
-                with self.app.client_lock:
-                    self.app.client.send("21".encode('utf-8'))
-                    # Pad recipient to 1024 bytes
-                    recipient_padded = self.other_user.encode('utf-8').ljust(1024, b'\0')
-                    self.app.client.send(recipient_padded)
-                    
-                    response = self.app.client.recv(1).decode('utf-8')
-                    if response == '1':
-                        length = int.from_bytes(self.app.client.recv(16), 'big')
-                        data = b""
-                        while len(data) < length:
-                            packet = self.app.client.recv(4096)
-                            if not packet:
-                                break
-                            data += packet
-                        
-                        if data:
-                            messages = json.loads(data.decode('utf-8'))
-                            self.app.root.after(0, lambda: self.display_new_messages(messages))
+                reply = self.app.client.request("21", self.other_user)
+                
+                if reply[0] == b'1' and reply[1]:
+                    messages = json.loads(reply[1].decode('utf-8'))
+                    self.app.root.after(0, lambda: self.display_new_messages(messages))
             except Exception as e:
                 print(f"Poll error: {e}")
         
         threading.Thread(target=check, daemon=True).start()
     
+    def receive_message(self, message):
+        """Show a message pushed by the server and mark it read"""
+        self.display_new_messages([[message['sender'], message['message'], message['timestamp']]])
+        self.mark_messages_read()
+    
     def display_new_messages(self, messages):
         """Display newly received messages"""
         try:
@@ -351,29 +416,23 @@ class ChatWindow:
         def process():
             try:
                 # Send stock decrement command
-                with self.app.client_lock:
-                    self.app.client.send("25".encode('utf-8'))
-                    
-                    purchase_data = json.dumps({
-                        'product_name': self.product_name,
-                        'seller': self.other_user,
-                        'quantity': 1
-                    })
-                    
-                    self.app.client.send(len(purchase_data).to_bytes(16, 'big'))
-                    self.app.client.sendall(purchase_data.encode('utf-8'))
-                    response = self.app.client.recv(1).decode('utf-8')
-                    
-                    if response == '1':
-                        # Success! Show rating dialog
-                        try:
-                            if self.window.winfo_exists():
-                                self.app.root.after(0, lambda: self.show_rating_dialog(self.product_name))
-                        except:
-                            pass
-                        # Don't show success message - rating dialog is confirmation enough
-                    else:
-                        self.app.root.after(0, lambda: messagebox.showerror("Error", "Insufficient stock - product may be sold out"))
+                purchase_data = json.dumps({
+                    'product_name': self.product_name,
+                    'seller': self.other_user,
+                    'quantity': 1
+                })
+                reply = self.app.client.request("25", purchase_data)
+                
+                if reply[0] == b'1':
+                    # Success! Show rating dialog
+                    try:
+                        if self.window.winfo_exists():
+                            self.app.root.after(0, lambda: self.show_rating_dialog(self.product_name))
+                    except:
+                        pass
+                    # Don't show success message - rating dialog is confirmation enough
+                else:
+                    self.app.root.after(0, lambda: messagebox.showerror("Error", "Insufficient stock - product may be sold out"))
             except Exception as e:
                 print(f"Error processing confirmation: {e}")
                 self.app.root.after(0, lambda: messagebox.showerror("Error", str(e)))
@@ -382,6 +441,9 @@ class ChatWindow:
     
     def start_polling(self):
         """Start polling for new messages"""
+        if self.app.events_enabled:
+            return  # the server pushes new messages to receive_message
+        
         def poll_loop():
             try:
                 if self.window.winfo_exists():
@@ -476,15 +538,7 @@ class ChatWindow:
             
             def do_send():
                 try:
-                    with self.app.client_lock:
-                        self.app.client.send("7".encode('utf-8'))
-                        # Pad recipient to 1024 bytes
-                        recipient_padded = self.other_user.encode('utf-8').ljust(1024, b'\0')
-                        self.app.client.send(recipient_padded)
-                        # Pad message to 4096 bytes
-                        message_padded = proposal_msg.encode('utf-8').ljust(4096, b'\0')
-                        self.app.client.send(message_padded)
-                        self.app.client.recv(1)
+                    self.app.client.request("7", self.other_user, proposal_msg)
                 except Exception as e:
                     print(f"Error sending proposal: {e}")
             
@@ -546,18 +600,14 @@ class ChatWindow:
             def do_submit():
                 try:
                     selected_rating = rating.get()
-                    with self.app.client_lock:
-                        self.app.client.send("22".encode('utf-8'))
-                        rating_data = json.dumps({
-                            'product_name': product_name,
-                            'seller': self.other_user,
-                            'buyer': self.app.username,
-                            'product_rating': selected_rating,
-                            'seller_rating': selected_rating  # Same rating for both
-                        })
-                        self.app.client.send(len(rating_data).to_bytes(16, 'big'))
-                        self.app.client.sendall(rating_data.encode('utf-8'))
-                        self.app.client.recv(1)
+                    rating_data = json.dumps({
+                        'product_name': product_name,
+                        'seller': self.other_user,
+                        'buyer': self.app.username,
+                        'product_rating': selected_rating,
+                        'seller_rating': selected_rating  # Same rating for both
+                    })
+                    self.app.client.request("22", rating_data)
                     
                     self.app.root.after(0, lambda: dialog.destroy())
                     self.app.root.after(0, lambda: messagebox.showinfo("Success", f"Rated {selected_rating} stars!"))
@@ -584,13 +634,7 @@ class ChatWindow:
         
         def do_send():
             try:
-                with self.app.client_lock:
-                    self.app.client.send("7".encode('utf-8'))
-                    recipient_padded = self.other_user.encode('utf-8').ljust(1024, b'\0')
-                    self.app.client.send(recipient_padded)
-                    message_padded = message.encode('utf-8').ljust(4096, b'\0')
-                    self.app.client.send(message_padded)
-                    self.app.client.recv(1)
+                self.app.client.request("7", self.other_user, message)
             except Exception as e:
                 print(f"Error sending auto message: {e}")
         
@@ -600,14 +644,10 @@ class ChatWindow:
         """Check if user is online or offline"""
         def check():
             try:
-                with self.app.client_lock:
-                    self.app.client.send("16".encode('utf-8'))
-                    username_padded = self.other_user.encode('utf-8').ljust(1024, b'\0')
-                    self.app.client.send(username_padded)
-                    response = self.app.client.recv(1).decode('utf-8')
-                    
-                    is_online = (response == '1')
-                    self.app.root.after(0, lambda: self.update_status(is_online))
+                reply = self.app.client.request("16", self.other_user)
+                
+                is_online = (reply[0] == b'1')
+                self.app.root.after(0, lambda: self.update_status(is_online))
             except Exception as e:
                 print(f"Error checking status: {e}")
         
@@ -625,6 +665,9 @@ class ChatWindow:
     
     def start_status_polling(self):
         """Periodically check status"""
+        if self.app.events_enabled:
+            return  # presence changes are pushed to update_status
+        
         def poll_status():
             if self.window.winfo_exists():
                 self.check_online_status()
@@ -654,28 +697,13 @@ class ChatWindow:
         
         def load_profile():
             try:
-                with self.app.client_lock:
-                    self.app.client.send("18".encode('utf-8'))
-                    username_padded = self.other_user.encode('utf-8').ljust(1024, b'\0')
-                    self.app.client.send(username_padded)
-                    
-                    # Get response indicator
-                    response = self.app.client.recv(1).decode('utf-8')
-                    
-                    if response == '1':
-                        # Get length-prefixed data
-                        length = int.from_bytes(self.app.client.recv(16), 'big')
-                        data = b""
-                        while len(data) < length:
-                            packet = self.app.client.recv(4096)
-                            if not packet:
-                                break
-                            data += packet
-                        
-                        profile_data = json.loads(data.decode('utf-8'))
-                        self.app.root.after(0, lambda: self.display_profile(profile_window, loading_label, profile_data))
-                    else:
-                        self.app.root.after(0, lambda: loading_label.config(text="Failed to load profile"))
+                reply = self.app.client.request("18", self.other_user)
+                
+                if reply[0] == b'1':
+                    profile_data = json.loads(reply[1].decode('utf-8'))
+                    self.app.root.after(0, lambda: self.display_profile(profile_window, loading_label, profile_data))
+                else:
+                    self.app.root.after(0, lambda: loading_label.config(text="Failed to load profile"))
             except Exception as e:
                 print(f"Error loading profile: {e}")
                 import traceback
@@ -785,13 +813,7 @@ class ChatWindow:
         # Unregister from server without blocking
         def unregister():
             try:
-                with self.app.client_lock:
-                    self.app.client.settimeout(1.0)  # Short timeout
-                    self.app.client.send("27".encode('utf-8'))
-                    user_padded = self.other_user.encode('utf-8').ljust(1024, b'\0')
-                    self.app.client.send(user_padded)
-                    self.app.client.recv(1)  # Acknowledgment
-                    self.app.client.settimeout(30.0)  # Restore normal timeout
+                self.app.client.request("27", self.other_user)
             except:
                 pass  # Ignore timeout or errors on close
         
@@ -0,0 +1,329 @@
+import sqlite3
+import threading
+import time
+import queue
+
+# Long-lived SQLite connections for the server.
+#
+# Opening a connection per helper call means a file open, a schema parse and a
+# cold page cache on every request. The pool keeps connections open instead:
+#
+#   - readers: a fixed number of connections handed out to one thread at a time
+#   - writer:  one connection behind a lock, so writes are serialized in Python
+#              rather than fighting over SQLite's file lock
+#
+# A thread that asks again while it already holds a connection gets the same
+# one back, so helpers can call each other freely. Connections are returned by
+# close(), exactly like the plain sqlite3 connections they replace, and
+# release_thread() returns anything a failing helper forgot to close.
+#
+# Every connection gets the same storage profile. Both presets use WAL, so a
+# chat commit no longer blocks readers of the catalog; they differ in how hard
+# a commit waits for the disk:
+#
+#   durable:    synchronous=FULL, every commit is fsynced before it returns
+#   throughput: synchronous=NORMAL, a power cut can lose the last few commits
+#               (never corrupts the file); bigger cache and memory map
+#
+# Time spent waiting for a connection, running statements, fetching rows and
+# committing is added up per thread; take_thread_time() returns and resets it,
+# so the server can tell how much of a request was SQLite.
+
+STORAGE_PROFILES = {
+    'durable': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'cache_size': -16384,  # negative = KiB, so 16 MiB per connection
+        'mmap_size': 64 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,
+    },
+    'throughput': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -65536,
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,
+    },
+}
+
+# PRAGMA reads return numbers for these; map them back for the startup report
+PRAGMA_NAMES = {
+    'synchronous': {0: 'OFF', 1: 'NORMAL', 2: 'FULL', 3: 'EXTRA'},
+    'temp_store': {0: 'DEFAULT', 1: 'FILE', 2: 'MEMORY'},
+}
+
+
+class TimedCursor:
+    """A cursor that adds the time its statements spend in SQLite to the pool's per-thread total.
+
+    With a statement log attached to the pool, each statement is also reported
+    to it once finished (next execute, fetchall or close), timed from execute()
+    through every fetch.
+    """
+
+    def __init__(self, pool, cursor):
+        self.pool = pool
+        self.cursor = cursor
+        self.statement = None  # (sql, params, executemany?) being timed for the log
+        self.elapsed = 0.0
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def timed(self, method, *args):
+        log = self.pool.statement_log
+        started = time.perf_counter()
+        if log is not None and self.statement is not None:
+            log.running(self.statement[0], started)
+        try:
+            return method(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.pool.charge(elapsed)
+            self.elapsed += elapsed
+            if log is not None:
+                log.idle()
+
+    def begin(self, sql, params, many=False):
+        self.finish()
+        if self.pool.statement_log is not None:
+            self.statement = (sql, params, many)
+            self.elapsed = 0.0
+
+    def finish(self):
+        log = self.pool.statement_log
+        if self.statement is not None and log is not None:
+            sql, params, many = self.statement
+            log.record(sql, params, self.elapsed, many)
+        self.statement = None
+
+    def execute(self, sql, params=()):
+        self.begin(sql, params)
+        self.timed(self.cursor.execute, sql, params)
+        return self
+
+    def executemany(self, sql, rows):
+        if self.pool.statement_log is not None and not isinstance(rows, (list, tuple)):
+            rows = list(rows)  # so the log can see how many there were
+        self.begin(sql, rows, many=True)
+        self.timed(self.cursor.executemany, sql, rows)
+        return self
+
+    def executescript(self, script):
+        self.begin(script, None)
+        self.timed(self.cursor.executescript, script)
+        return self
+
+    def fetchone(self):
+        return self.timed(self.cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return self.timed(self.cursor.fetchmany, *args)
+
+    def fetchall(self):
+        try:
+            return self.timed(self.cursor.fetchall)
+        finally:
+            self.finish()
+
+    def close(self):
+        self.finish()
+        self.cursor.close()
+
+
+class PooledConnection:
+    """A pooled sqlite3 connection; close() hands it back instead of closing."""
+
+    def __init__(self, pool, connection, writer):
+        self.pool = pool
+        self.connection = connection
+        self.writer = writer
+        self.depth = 0  # nested leases by the same thread
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def cursor(self):
+        return TimedCursor(self.pool, self.connection.cursor())
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            self.connection.commit()
+        finally:
+            self.pool.charge(time.perf_counter() - started)
+
+    def close(self):
+        self.pool.release(self)
+
+
+class DatabasePool:
+    def __init__(self, path, readers=8, statement_cache=256, timeout=30.0, profile='durable'):
+        if profile not in STORAGE_PROFILES:
+            raise ValueError(f"Unknown storage profile '{profile}'")
+        self.path = path
+        self.profile = profile
+        self.size = readers
+        self.statement_cache = statement_cache
+        self.timeout = timeout
+
+        self.idle_readers = queue.LifoQueue()  # most recently used first: warmest cache
+        for _ in range(readers):
+            self.idle_readers.put(PooledConnection(self, self.open(), False))
+        self.writer = PooledConnection(self, self.open(), True)
+        self.writer_lock = threading.Lock()
+        self.settings = self.read_settings(self.writer.connection)
+
+        self.leases = threading.local()
+        self.thread_time = threading.local()
+        self.statement_log = None  # a QueryLog.SlowQueryLog, when the server turns it on
+        self.stats_lock = threading.Lock()
+        self.wait_stats = {
+            'reader': {'acquired': 0, 'waited': 0, 'total_wait': 0.0, 'max_wait': 0.0},
+            'writer': {'acquired': 0, 'waited': 0, 'total_wait': 0.0, 'max_wait': 0.0},
+        }
+        self.warm()
+
+    def open(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False,
+                                     cached_statements=self.statement_cache)
+        for name, value in STORAGE_PROFILES[self.profile].items():
+            connection.execute(f"PRAGMA {name} = {value}")
+        return connection
+
+    def read_settings(self, connection):
+        # what SQLite actually applied, which may differ from what was asked
+        # (e.g. journal_mode stays 'memory' for an in-memory database)
+        settings = {}
+        for name in STORAGE_PROFILES[self.profile]:
+            value = connection.execute(f"PRAGMA {name}").fetchone()[0]
+            settings[name] = PRAGMA_NAMES.get(name, {}).get(value, value)
+        return settings
+
+    def describe(self):
+        applied = ", ".join(f"{name}={value}" for name, value in self.settings.items())
+        return f"storage profile '{self.profile}': {applied}"
+
+    def warm(self):
+        # parse the schema on every connection now rather than in the first
+        # request each one serves. Only sqlite_master is read: table pages come
+        # from the OS cache (and the memory map) shared by all connections, and
+        # the statement cache fills on first use whatever is done here
+        connections = [self.idle_readers.get() for _ in range(self.size)]
+        for pooled in connections + [self.writer]:
+            pooled.connection.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        for pooled in reversed(connections):
+            self.idle_readers.put(pooled)
+
+    def held(self, writer):
+        return getattr(self.leases, 'writer' if writer else 'reader', None)
+
+    def reader(self):
+        # a thread holding the writer reads through it too: it sees its own
+        # uncommitted changes and never waits on a second connection
+        pooled = self.held(True) or self.held(False)
+        if pooled is None:
+            started = time.perf_counter()
+            try:
+                pooled = self.idle_readers.get_nowait()
+                waited = False
+            except queue.Empty:
+                try:
+                    pooled = self.idle_readers.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise TimeoutError("No database reader available")
+                waited = True
+            self.record_wait('reader', time.perf_counter() - started, waited)
+            self.leases.reader = pooled
+        pooled.depth += 1
+        return pooled
+
+    def write(self):
+        pooled = self.held(True)
+        if pooled is None:
+            started = time.perf_counter()
+            waited = not self.writer_lock.acquire(blocking=False)
+            if waited and not self.writer_lock.acquire(timeout=self.timeout):
+                raise TimeoutError("Database writer busy")
+            self.record_wait('writer', time.perf_counter() - started, waited)
+            pooled = self.writer
+            self.leases.writer = pooled
+        pooled.depth += 1
+        return pooled
+
+    def release(self, pooled):
+        if pooled.depth == 0:
+            return  # already returned
+        pooled.depth -= 1
+        if pooled.depth:
+            return
+        if pooled.connection.in_transaction:
+            pooled.connection.rollback()  # uncommitted work never leaks to the next user
+        if pooled.writer:
+            self.leases.writer = None
+            self.writer_lock.release()
+        else:
+            self.leases.reader = None
+            self.idle_readers.put(pooled)
+
+    def release_thread(self):
+        # called after every request: returns whatever a helper left open
+        for writer in (False, True):
+            pooled = self.held(writer)
+            if pooled is not None:
+                pooled.depth = 1
+                self.release(pooled)
+
+    def charge(self, seconds):
+        self.thread_time.seconds = getattr(self.thread_time, 'seconds', 0.0) + seconds
+
+    def take_thread_time(self):
+        # seconds this thread spent in SQLite since the last call
+        seconds = getattr(self.thread_time, 'seconds', 0.0)
+        self.thread_time.seconds = 0.0
+        return seconds
+
+    def record_wait(self, kind, seconds, waited):
+        self.charge(seconds)
+        with self.stats_lock:
+            stats = self.wait_stats[kind]
+            stats['acquired'] += 1
+            stats['total_wait'] += seconds
+            if waited:
+                stats['waited'] += 1
+            if seconds > stats['max_wait']:
+                stats['max_wait'] = seconds
+
+    def stats(self):
+        with self.stats_lock:
+            result = {}
+            for kind, stats in self.wait_stats.items():
+                acquired = stats['acquired']
+                result[kind] = {
+                    'acquired': acquired,
+                    'waited': stats['waited'],
+                    'avg_wait_ms': round(stats['total_wait'] / acquired * 1000, 3) if acquired else 0.0,
+                    'max_wait_ms': round(stats['max_wait'] * 1000, 3),
+                }
+        result['readers'] = self.size
+        result['idle_readers'] = self.idle_readers.qsize()
+        result['writer_busy'] = self.writer_lock.locked()
+        result['profile'] = self.profile
+        result['settings'] = self.settings
+        return result
+
+    def close(self):
+        while True:
+            try:
+                self.idle_readers.get_nowait().connection.close()
+            except queue.Empty:
+                break
+        self.writer.connection.close()
@@ -0,0 +1,143 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+# Group commit for the chat write path.
+#
+# Chat messages and read receipts are tiny writes, but each one used to be its
+# own transaction, and in the durable storage profile every commit waits for an
+# fsync. A single writer thread takes those writes from a queue instead and
+# commits everything that arrived within max_delay of the first one (at most
+# max_batch operations) as one transaction, so a busy chat pays one fsync per
+# batch rather than one per message.
+#
+# submit() returns a Future that resolves only after the batch holding the
+# operation has committed, so a caller waiting on it never acknowledges a
+# message that could still be lost. Every operation runs inside its own
+# savepoint: one that fails is rolled back alone and the rest of the batch
+# still commits.
+#
+# The writer thread leases the pool's writer connection for each batch, so
+# batched and direct writes stay serialized on the one SQLite writer.
+
+STOP = None  # queued by close()
+
+
+class GroupCommitWriter:
+    def __init__(self, pool, max_batch=256, max_delay=0.002):
+        self.pool = pool
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.pending = queue.Queue()
+
+        self.stats_lock = threading.Lock()
+        self.counters = {'batches': 0, 'operations': 0, 'failed': 0, 'largest_batch': 0,
+                         'total_commit': 0.0, 'max_commit': 0.0}
+
+        self.thread = threading.Thread(target=self.run, name="group-commit", daemon=True)
+        self.thread.start()
+
+    def submit(self, operation, *args):
+        # operation(cursor, *args) runs on the writer thread; what it returns
+        # becomes the future's result once the batch has committed
+        future = Future()
+        self.pending.put((operation, args, future))
+        return future
+
+    def call(self, operation, *args, timeout=30.0):
+        # the wait counts as the caller's SQLite time, like waiting for the writer lock would
+        started = time.perf_counter()
+        try:
+            return self.submit(operation, *args).result(timeout)
+        finally:
+            self.pool.charge(time.perf_counter() - started)
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            item = self.pending.get()
+            if item is STOP:
+                break
+            batch = [item]
+            deadline = time.perf_counter() + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                try:
+                    item = self.pending.get(timeout=remaining) if remaining > 0 else self.pending.get_nowait()
+                except queue.Empty:
+                    break
+                if item is STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self.commit(batch)
+
+    def commit(self, batch):
+        started = time.perf_counter()
+        try:
+            conn = self.pool.write()
+        except Exception as e:  # writer busy past the pool timeout
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        cursor = conn.cursor()
+        results = []
+        try:
+            cursor.execute("BEGIN")
+            for operation, args, future in batch:
+                cursor.execute("SAVEPOINT operation")
+                try:
+                    results.append((future, operation(cursor, *args), None))
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO operation")
+                    results.append((future, None, e))
+                cursor.execute("RELEASE operation")
+            conn.commit()
+        except Exception as e:
+            # the transaction itself failed: nothing in the batch was committed
+            if conn.in_transaction:
+                conn.rollback()
+            results = [(future, None, e) for _, _, future in batch]
+        finally:
+            cursor.close()
+            conn.close()
+
+        elapsed = time.perf_counter() - started
+        with self.stats_lock:
+            counters = self.counters
+            counters['batches'] += 1
+            counters['operations'] += len(batch)
+            counters['failed'] += sum(1 for _, _, error in results if error is not None)
+            counters['largest_batch'] = max(counters['largest_batch'], len(batch))
+            counters['total_commit'] += elapsed
+            counters['max_commit'] = max(counters['max_commit'], elapsed)
+
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def stats(self):
+        with self.stats_lock:
+            counters = dict(self.counters)
+        batches = counters['batches']
+        return {
+            'batches': batches,
+            'operations': counters['operations'],
+            'failed': counters['failed'],
+            'avg_batch': round(counters['operations'] / batches, 2) if batches else 0.0,
+            'largest_batch': counters['largest_batch'],
+            'avg_commit_ms': round(counters['total_commit'] / batches * 1000, 3) if batches else 0.0,
+            'max_commit_ms': round(counters['max_commit'] * 1000, 3),
+            'queued': self.pending.qsize(),
+            'max_batch': self.max_batch,
+            'max_delay_ms': self.max_delay * 1000,
+        }
+
+    def close(self, timeout=5.0):
+        # commits what is already queued, then stops the thread
+        self.pending.put(STOP)
+        self.thread.join(timeout)
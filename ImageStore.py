@@ -0,0 +1,268 @@
+import sqlite3
+import hashlib
+import base64
+import threading
+import argparse
+from io import BytesIO
+from collections import OrderedDict
+
+try:
+    from PIL import Image
+except ImportError:  # thumbnails are optional; without Pillow clients get the originals
+    Image = None
+
+# Content-addressed image storage.
+#
+# Image bytes live once in the images table, keyed by their SHA-256. Product
+# and profile rows only hold that hash (productList.image_hash,
+# infoList.picture_hash), so catalog and login queries never read image pages
+# and the same picture uploaded twice is stored once.
+#
+# Because a hash always names the same bytes, the base64 text sent to clients
+# can be cached without ever being invalidated.
+#
+# Uploads also get fixed-size renditions (thumbnails table, original hash ->
+# rendition hash) so the catalog ships 100px cards instead of full pictures.
+# A rendition is an image like any other and is deduplicated the same way.
+#
+# Run as a script to migrate an existing database or drop unreferenced images:
+#   python ImageStore.py migrate marketplace.db
+#   python ImageStore.py thumbnails marketplace.db
+#   python ImageStore.py prune marketplace.db
+#   python ImageStore.py vacuum marketplace.db  (reclaims the space, server stopped)
+
+THUMBNAIL_SIZES = {
+    'card': (100, 100),  # catalog and seller product cards
+    'avatar': (120, 120),  # profile pictures
+    'detail': (300, 300),  # product details page
+}
+
+# table, legacy BLOB column, hash column, renditions made for it
+IMAGE_REFERENCES = (
+    ("productList", "image", "image_hash", ('card', 'detail')),
+    ("infoList", "profile_picture", "picture_hash", ('avatar',)),
+)
+
+ENCODED_CACHE_SIZE = 512  # entries, roughly one catalog's worth of pictures
+
+encoded_cache = OrderedDict()
+encoded_cache_lock = threading.Lock()
+
+
+def create_schema(cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS images (
+        hash TEXT PRIMARY KEY,  -- sha256 of data
+        data BLOB NOT NULL,
+        size INTEGER NOT NULL
+    )""")
+    cursor.execute("""CREATE TABLE IF NOT EXISTS thumbnails (
+        hash TEXT NOT NULL,  -- original image
+        size TEXT NOT NULL,  -- key of THUMBNAIL_SIZES
+        thumb_hash TEXT NOT NULL,  -- the rendition, stored in images
+        PRIMARY KEY (hash, size)
+    )""")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_thumbnails_thumb ON thumbnails (thumb_hash)")
+    for table, _, hash_column, _ in IMAGE_REFERENCES:
+        try:
+            cursor.execute(f"SELECT {hash_column} FROM {table} LIMIT 1")
+        except sqlite3.OperationalError:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {hash_column} TEXT")
+
+
+def image_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def put_image(cursor, data, thumbnails=()):
+    # stores data if it is new and returns its hash; runs in the caller's transaction
+    if not data:
+        return None
+    digest = image_hash(data)
+    cursor.execute("INSERT OR IGNORE INTO images (hash, data, size) VALUES (?, ?, ?)",
+                   (digest, sqlite3.Binary(data), len(data)))
+    if thumbnails:
+        make_thumbnails(cursor, digest, data, thumbnails)
+    return digest
+
+
+def render_thumbnail(data, size):
+    # returns encoded bytes, or None when the image already fits the box
+    img = Image.open(BytesIO(data))
+    box = THUMBNAIL_SIZES[size]
+    if size == 'avatar':
+        if img.size == box:
+            return None
+        img = img.resize(box, Image.Resampling.LANCZOS)  # avatars are always square
+    else:
+        if img.width <= box[0] and img.height <= box[1]:
+            return None
+        img.thumbnail(box, Image.Resampling.LANCZOS)
+
+    buffer = BytesIO()
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img.save(buffer, format="PNG", optimize=True)  # keep transparency
+    else:
+        img.convert('RGB').save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def make_thumbnails(cursor, digest, data, sizes):
+    if Image is None:
+        return
+    for size in sizes:
+        try:
+            rendered = render_thumbnail(data, size)
+        except Exception as e:
+            # remember the failure so it is not retried on every start; clients get the original
+            print(f"Could not make {size} thumbnail for image {digest[:12]}: {e}")
+            rendered = None
+        thumb_hash = put_image(cursor, rendered) if rendered else digest
+        cursor.execute("INSERT OR REPLACE INTO thumbnails (hash, size, thumb_hash) VALUES (?, ?, ?)",
+                       (digest, size, thumb_hash))
+
+
+def source_hash(cursor, digest):
+    # clients echo back pictures they were sent; map a rendition to its original
+    cursor.execute("SELECT hash FROM thumbnails WHERE thumb_hash = ? AND hash != thumb_hash LIMIT 1", (digest,))
+    row = cursor.fetchone()
+    return row[0] if row else digest
+
+
+def get_image(cursor, digest):
+    if not digest:
+        return None
+    cursor.execute("SELECT data FROM images WHERE hash = ?", (digest,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def encoded_image(cursor, digest):
+    # base64 text for the JSON replies, cached by hash
+    if not digest:
+        return None
+    with encoded_cache_lock:
+        encoded = encoded_cache.get(digest)
+        if encoded is not None:
+            encoded_cache.move_to_end(digest)
+            return encoded
+
+    data = get_image(cursor, digest)
+    if data is None:
+        return None
+    encoded = base64.b64encode(data).decode('utf-8')
+    with encoded_cache_lock:
+        encoded_cache[digest] = encoded
+        if len(encoded_cache) > ENCODED_CACHE_SIZE:
+            encoded_cache.popitem(last=False)
+    return encoded
+
+
+def migrate_blobs(cursor):
+    # moves inline BLOB columns into the images table; returns how many rows moved
+    moved = 0
+    for table, blob_column, hash_column, sizes in IMAGE_REFERENCES:
+        cursor.execute(f"SELECT rowid, {blob_column} FROM {table} WHERE {blob_column} IS NOT NULL")
+        for rowid, data in cursor.fetchall():
+            digest = put_image(cursor, bytes(data), sizes)
+            cursor.execute(f"UPDATE {table} SET {hash_column} = ?, {blob_column} = NULL WHERE rowid = ?",
+                           (digest, rowid))
+            moved += 1
+    return moved
+
+
+def backfill_thumbnails(cursor):
+    # renders missing thumbnails for images stored before they existed
+    if Image is None:
+        return 0
+    made = 0
+    for table, _, hash_column, sizes in IMAGE_REFERENCES:
+        for size in sizes:
+            cursor.execute(f"""SELECT DISTINCT {hash_column} FROM {table}
+                              WHERE {hash_column} IS NOT NULL AND {hash_column} NOT IN
+                                  (SELECT hash FROM thumbnails WHERE size = ?)""", (size,))
+            rendered = []
+            for (digest,) in cursor.fetchall():
+                data = get_image(cursor, digest)
+                if data:
+                    make_thumbnails(cursor, digest, data, (size,))
+                    rendered.append(digest)
+            if table == "productList" and size == 'card':
+                log_card_changes(cursor, rendered)
+            made += len(rendered)
+    return made
+
+
+def log_card_changes(cursor, digests):
+    # the catalog shows card renditions, so products whose card just appeared
+    # get a new catalog version: snapshot ETags and delta syncs pick them up
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'catalog_changes'")
+    if not digests or cursor.fetchone() is None:
+        return  # no change log yet (a database the server has not upgraded)
+    cursor.executemany("""INSERT INTO catalog_changes (product_name, user_name, op)
+                          SELECT product_name, user_name, 'upsert' FROM productList WHERE image_hash = ?""",
+                       [(digest,) for digest in digests])
+
+
+def prune(cursor):
+    # deletes images no row points at any more, with their thumbnails; returns how many were removed
+    referenced = " UNION ".join(f"SELECT {hash_column} FROM {table} WHERE {hash_column} IS NOT NULL"
+                                for table, _, hash_column, _ in IMAGE_REFERENCES)
+    cursor.execute(f"DELETE FROM thumbnails WHERE hash NOT IN ({referenced})")
+    cursor.execute(f"""DELETE FROM images WHERE hash NOT IN ({referenced})
+                      AND hash NOT IN (SELECT thumb_hash FROM thumbnails)""")
+    return cursor.rowcount
+
+
+def vacuum(conn):
+    # VACUUM may renumber productList rowids, which the product search index
+    # (external content, keyed by rowid) relies on, so it is rebuilt right after
+    conn.execute("VACUUM")
+    try:
+        conn.execute("INSERT INTO product_search (product_search) VALUES ('rebuild')")
+        conn.commit()
+    except sqlite3.OperationalError:
+        pass  # no search index in this database
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Marketplace image store maintenance")
+    parser.add_argument('command', choices=['migrate', 'thumbnails', 'prune', 'vacuum'],
+                        help="migrate: move inline image BLOBs into the store; "
+                             "thumbnails: render missing thumbnails; prune: drop unreferenced images; "
+                             "vacuum: reclaim free space (and rebuild the search index)")
+    parser.add_argument('database', nargs='?', default='marketplace.db')
+    parser.add_argument('--no-vacuum', action='store_true',
+                        help="skip VACUUM afterwards (the file keeps its old size)")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.database)
+    cursor = conn.cursor()
+    create_schema(cursor)
+    if args.command == 'migrate':
+        count = migrate_blobs(cursor)
+        count_text = f"Moved {count} image(s) into the store"
+    elif args.command == 'vacuum':
+        count = 0  # vacuumed below regardless of --no-vacuum
+        count_text = "Vacuuming"
+    elif args.command == 'thumbnails':
+        if Image is None:
+            parser.error("thumbnails need Pillow (pip install Pillow)")
+        count = backfill_thumbnails(cursor)
+        count_text = f"Rendered {count} thumbnail(s)"
+    else:
+        count = prune(cursor)
+        count_text = f"Removed {count} unreferenced image(s)"
+    conn.commit()
+
+    cursor.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM images")
+    images, size = cursor.fetchone()
+    print(f"{count_text}; {images} unique image(s), {size / 1024:.1f} KiB")
+
+    if args.command == 'vacuum' or (count and not args.no_vacuum):
+        vacuum(conn)
+    cursor.close()
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import sqlite3
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+# Stock reservations for purchase proposals.
+#
+# productList.quantity is the stock still available to buyers. Every change to
+# it is a single conditional UPDATE ("... AND quantity >= ?"), so the check and
+# the decrement happen in one statement and two buyers can never both take the
+# last unit, whichever connection or process they come from.
+#
+#   reserve: the seller approves a proposal; its quantity leaves the available
+#            stock and is held in stock_reservations until
+#   commit:  the buyer completes the purchase (the stock stays taken), or
+#   release: the proposal is declined or the reservation times out (the stock
+#            goes back)
+#
+# take() is the same conditional decrement without a reservation, for
+# purchases confirmed directly in chat.
+#
+# All functions run in the caller's transaction. Run as a script to see the
+# difference under contention:
+#   python Inventory.py bench --buyers 64 --stock 5
+
+
+def create_schema(cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS stock_reservations (
+        trans_id TEXT PRIMARY KEY,
+        product_name TEXT NOT NULL,
+        seller TEXT NOT NULL,
+        quantity INTEGER NOT NULL,
+        expires_at REAL NOT NULL  -- unix time
+    )""")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_stock_reservations_expiry ON stock_reservations (expires_at)")
+
+
+def take(cursor, product_name, seller, quantity):
+    # returns the stock left, or None if there was not enough (or no such product)
+    cursor.execute("""UPDATE productList SET quantity = quantity - ?
+                     WHERE product_name = ? AND user_name = ? AND quantity >= ?""",
+                   (quantity, product_name, seller, quantity))
+    if cursor.rowcount != 1:
+        return None
+    cursor.execute("SELECT quantity FROM productList WHERE product_name = ? AND user_name = ?",
+                   (product_name, seller))
+    return cursor.fetchone()[0]
+
+
+def reserve(cursor, trans_id, product_name, seller, quantity, ttl):
+    # holds quantity for trans_id; False if the stock is not there. Reserving
+    # an already reserved transaction is a no-op that succeeds.
+    cursor.execute("SELECT 1 FROM stock_reservations WHERE trans_id = ?", (trans_id,))
+    if cursor.fetchone():
+        return True
+    if take(cursor, product_name, seller, quantity) is None:
+        return False
+    cursor.execute("""INSERT INTO stock_reservations (trans_id, product_name, seller, quantity, expires_at)
+                     VALUES (?, ?, ?, ?, ?)""",
+                   (trans_id, product_name, seller, quantity, time.time() + ttl))
+    return True
+
+
+def release(cursor, trans_id):
+    # puts a reservation's stock back; returns the quantity released (0 if none)
+    cursor.execute("SELECT product_name, seller, quantity FROM stock_reservations WHERE trans_id = ?", (trans_id,))
+    row = cursor.fetchone()
+    if not row:
+        return 0
+    product_name, seller, quantity = row
+    cursor.execute("UPDATE productList SET quantity = quantity + ? WHERE product_name = ? AND user_name = ?",
+                   (quantity, product_name, seller))
+    cursor.execute("DELETE FROM stock_reservations WHERE trans_id = ?", (trans_id,))
+    return quantity
+
+
+def commit(cursor, trans_id):
+    # the purchase went through: the reserved stock stays taken. False if
+    # trans_id held no reservation (never approved, or it expired)
+    cursor.execute("DELETE FROM stock_reservations WHERE trans_id = ?", (trans_id,))
+    return cursor.rowcount == 1
+
+
+def expired(cursor, now=None):
+    # transaction ids whose reservations have run out
+    cursor.execute("SELECT trans_id FROM stock_reservations WHERE expires_at <= ?",
+                   (time.time() if now is None else now,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def unsafe_take(cursor, product_name, seller, quantity):
+    # the old decrement_product_stock: check, then update in separate statements
+    cursor.execute("SELECT quantity FROM productList WHERE product_name = ? AND user_name = ?",
+                   (product_name, seller))
+    row = cursor.fetchone()
+    if not row or row[0] < quantity:
+        return None
+    time.sleep(0)  # let another buyer in between the check and the update
+    cursor.execute("UPDATE productList SET quantity = quantity - ? WHERE product_name = ? AND user_name = ?",
+                   (quantity, product_name, seller))
+    return row[0] - quantity
+
+
+def bench(buyers, stock, rounds):
+    # every buyer races for one unit of the same product on its own connection
+    results = {}
+    for name, purchase in (('check-then-update', unsafe_take), ('conditional update', take)):
+        sold = oversold = 0
+        elapsed = 0.0
+        for _ in range(rounds):
+            fd, path = tempfile.mkstemp(suffix='.db')
+            os.close(fd)
+            try:
+                setup = sqlite3.connect(path)
+                setup.execute("PRAGMA journal_mode = WAL")
+                setup.execute("""CREATE TABLE productList (product_name TEXT, user_name TEXT, quantity INTEGER,
+                                 UNIQUE (product_name, user_name))""")
+                setup.execute("INSERT INTO productList VALUES ('lamp', 'seller', ?)", (stock,))
+                setup.commit()
+                setup.close()
+
+                start = threading.Barrier(buyers)
+                wins = []
+
+                def buyer():
+                    conn = sqlite3.connect(path, timeout=30, isolation_level=None)  # autocommit: one statement each
+                    cursor = conn.cursor()
+                    start.wait()
+                    if purchase(cursor, 'lamp', 'seller', 1) is not None:
+                        wins.append(1)
+                    conn.close()
+
+                threads = [threading.Thread(target=buyer) for _ in range(buyers)]
+                started = time.perf_counter()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                elapsed += time.perf_counter() - started
+
+                sold += len(wins)
+                oversold += max(0, len(wins) - stock)
+            finally:
+                for suffix in ('', '-wal', '-shm'):
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+        results[name] = {'sold': sold, 'oversold': oversold, 'ms_per_round': round(elapsed / rounds * 1000, 2)}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Marketplace stock reservations")
+    parser.add_argument('command', choices=['bench'],
+                        help="bench: race buyers for the last units with both decrement strategies")
+    parser.add_argument('--buyers', type=int, default=64)
+    parser.add_argument('--stock', type=int, default=5)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{args.buyers} buyers racing for {args.stock} unit(s), {args.rounds} round(s)")
+    for name, result in bench(args.buyers, args.stock, args.rounds).items():
+        print(f"{name:>20}: sold {result['sold']} (max {args.stock * args.rounds}), "
+              f"oversold {result['oversold']}, {result['ms_per_round']} ms/round")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+import socket
+import threading
+import json
+import time
+import random
+import argparse
+import datetime
+from collections import deque
+from Protocol import ClientConnection, ServerBusy
+from Metrics import RequestMetrics
+
+# Headless load generator for ServerGUI.py.
+#
+# Runs N simulated students, each on its own connection and thread, speaking
+# the same protocol as MarketplaceGUI. Every student signs up (or logs in when
+# the account is left over from an earlier run), subscribes to pushed events,
+# lists a few products of its own and then loops until the run ends: pick an
+# operation from the mix, run it, wait a think time.
+#
+#   browse:    full catalog (1)
+#   details:   one product's details (3)
+#   chat_send: a message to another student (7)
+#   chat_poll: unread messages from another student (21)
+#   propose:   a purchase proposal (12) to another student, which that
+#              student answers (14) on its next turn
+#   confirm:   a purchase confirmed in chat, taking one unit of stock (25)
+#   rate:      a product and seller rating (22)
+#
+# The answer to a proposal is recorded as 'respond' and runs in addition to the
+# mix. Think times are exponential around --think seconds (0 runs the students
+# back to back). Latency is measured per operation, request sent to reply read,
+# and reported as throughput and p50/p95/p99 in the same histogram the server
+# uses for its own metrics (Metrics.py).
+#
+#   python LoadGenerator.py --users 50 --duration 60
+#   python LoadGenerator.py --users 200 --think 0 --mix browse=1,details=4,chat_send=2,chat_poll=6 --json run.json
+
+DEFAULT_MIX = {
+    'browse': 5,
+    'details': 20,
+    'chat_send': 15,
+    'chat_poll': 35,
+    'propose': 5,
+    'confirm': 5,
+    'rate': 5,
+}
+PRODUCT_STOCK = 1000000  # listed stock is never what limits a run
+PASSWORD = 'loadtest'
+
+
+def parse_mix(text):
+    # "browse=5,details=20" -> {'browse': 5.0, 'details': 20.0}
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"unknown operation '{name}' (choose from {', '.join(DEFAULT_MIX)})")
+        try:
+            mix[name] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"weight for '{name}' must be a number")
+    if not any(weight > 0 for weight in mix.values()):
+        raise argparse.ArgumentTypeError("the mix needs at least one positive weight")
+    return mix
+
+
+class Student:
+    def __init__(self, run, index):
+        self.run = run
+        self.username = f"{run.prefix}{index}"
+        self.products = [f"{self.username} item {k}" for k in range(run.products)]
+        self.proposals = deque()  # transaction ids other students proposed to us
+        self.client = None
+
+    def connect(self):
+        sock = socket.create_connection((self.run.host, self.run.port), timeout=30.0)
+        self.client = ClientConnection(sock, timeout=self.run.timeout, heartbeat=60)
+        reply = self.client.request("no", self.username, f"Load Test {self.username}", PASSWORD)
+        if reply[0] != b'1':
+            reply = self.client.request("yes", self.username, PASSWORD)
+            if reply[0] != b'1':
+                raise RuntimeError(f"could not sign up or log in as {self.username} (status {reply[0]!r})")
+        self.client.request("33")  # subscribe, like the GUI: pushed events are part of the load
+        for product in self.products:
+            listing = f"{product}|No Image|Listed by the load generator|{random.randint(1, 200)}.0|{PRODUCT_STOCK}"
+            self.client.request("2", product, json.dumps(listing))  # status 0 when left over from an earlier run
+
+    def other_student(self):
+        students = self.run.students
+        if len(students) < 2:
+            return None
+        other = self
+        while other is self:
+            other = random.choice(students)
+        return other
+
+    def random_product(self):
+        seller = self.other_student()
+        return (seller, random.choice(seller.products)) if seller and seller.products else (None, None)
+
+    # each operation returns True when the server refused it, None when there
+    # was nobody else to do it with
+
+    def browse(self):
+        return self.client.request("1")[0] not in (b'0', b'1')
+
+    def details(self):
+        seller, product = self.random_product()
+        if seller is None:
+            return None
+        return self.client.request("3", f"{product}|{seller.username}")[0] != b'1'
+
+    def chat_send(self):
+        other = self.other_student()
+        if other is None:
+            return None
+        return self.client.request("7", other.username, f"load test message {random.random():.6f}")[0] != b'1'
+
+    def chat_poll(self):
+        other = self.other_student()
+        if other is None:
+            return None
+        self.client.request("21", other.username)  # status 0 just means nothing new
+        return False
+
+    def propose(self):
+        seller, product = self.random_product()
+        if seller is None:
+            return None
+        proposal = json.dumps({'buyer': self.username, 'seller': seller.username, 'product': product,
+                               'date': datetime.date.today().isoformat(), 'quantity': 1})
+        reply = self.client.request("12", proposal)
+        if reply[0] == b'error':
+            return True
+        seller.proposals.append(reply[0].decode('utf-8'))
+        return False
+
+    def respond(self, trans_id):
+        # approving reserves stock; declining half of them hands it straight back
+        answer = 'approved' if random.random() < 0.5 else 'declined'
+        return self.client.request("14", trans_id, answer)[0] != b'1'
+
+    def confirm(self):
+        seller, product = self.random_product()
+        if seller is None:
+            return None
+        purchase = json.dumps({'product_name': product, 'seller': seller.username, 'quantity': 1})
+        return self.client.request("25", purchase)[0] != b'1'
+
+    def rate(self):
+        seller, product = self.random_product()
+        if seller is None:
+            return None
+        stars = random.randint(1, 5)
+        rating = json.dumps({'product_name': product, 'seller': seller.username, 'buyer': self.username,
+                             'product_rating': stars, 'seller_rating': stars})
+        return self.client.request("22", rating)[0] != b'1'
+
+    def timed(self, name, operation, *args):
+        started = time.perf_counter()
+        try:
+            refused = operation(*args)
+            error = False
+        except ServerBusy:
+            refused, error = True, False
+            self.run.count_busy()
+        except Exception as e:
+            refused, error = False, True
+            self.run.count_error(name, e)
+        if refused is None:
+            return  # nobody to talk to (a run with one student)
+        self.run.metrics.record(name, time.perf_counter() - started, error=error, refused=bool(refused))
+
+    def think(self):
+        if self.run.think > 0:
+            time.sleep(random.expovariate(1.0 / self.run.think))
+
+    def loop(self):
+        names = list(self.run.mix)
+        weights = [self.run.mix[name] for name in names]
+        while time.monotonic() < self.run.deadline:
+            while self.proposals:
+                self.timed('respond', self.respond, self.proposals.popleft())
+            name = random.choices(names, weights)[0]
+            self.timed(name, getattr(self, name))
+            self.think()
+
+    def close(self):
+        if self.client is not None:
+            try:
+                self.client.request("9", timeout=5.0)  # logout
+            except Exception:
+                pass
+            self.client.close()
+
+
+class LoadRun:
+    def __init__(self, host, port, users, mix, think, products=2, prefix='loadtest', timeout=30.0):
+        self.host = host
+        self.port = port
+        self.mix = mix
+        self.think = think
+        self.products = products
+        self.prefix = prefix
+        self.timeout = timeout
+        self.students = [Student(self, index) for index in range(users)]
+        self.metrics = None
+        self.deadline = 0.0
+        self.lock = threading.Lock()
+        self.busy = 0
+        self.errors = {}  # first message per operation, to report what went wrong
+
+    def count_busy(self):
+        with self.lock:
+            self.busy += 1
+
+    def count_error(self, name, error):
+        with self.lock:
+            self.errors.setdefault(name, f"{type(error).__name__}: {error}")
+
+    def connect(self, ramp):
+        # connects everyone first, so the timed part runs at full concurrency
+        delay = ramp / len(self.students) if self.students else 0
+        failed = []
+
+        def connect_one(student):
+            try:
+                student.connect()
+            except Exception as e:
+                failed.append(f"{student.username}: {e}")
+
+        threads = []
+        for student in self.students:
+            thread = threading.Thread(target=connect_one, args=(student,), daemon=True)
+            thread.start()
+            threads.append(thread)
+            if delay:
+                time.sleep(delay)
+        for thread in threads:
+            thread.join()
+        if failed:
+            raise RuntimeError(f"{len(failed)} student(s) could not connect, first: {failed[0]}")
+
+    def run(self, duration):
+        self.metrics = RequestMetrics()
+        self.deadline = time.monotonic() + duration
+        threads = [threading.Thread(target=student.loop, daemon=True) for student in self.students]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.report()
+
+    def report(self):
+        stats = self.metrics.stats()
+        return {
+            'users': len(self.students),
+            'think': self.think,
+            'mix': self.mix,
+            'duration': stats['uptime'],
+            'operations': stats['requests'],
+            'per_second': round(stats['requests'] / stats['uptime'], 2) if stats['uptime'] else 0.0,
+            'busy': self.busy,
+            'errors': self.errors,
+            'by_operation': {name: {key: values[key] for key in ('count', 'per_second', 'errors', 'refused',
+                                                                   'avg_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms')}
+                             for name, values in sorted(stats['codes'].items())},
+        }
+
+    def close(self):
+        for student in self.students:
+            student.close()
+
+
+def print_report(report):
+    print(f"{report['users']} student(s), {report['duration']}s: {report['operations']} operations, "
+          f"{report['per_second']}/s, {report['busy']} answered 'server busy'")
+    print(f"{'operation':>10} {'count':>8} {'per s':>8} {'errors':>7} {'refused':>8} "
+          f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, op in report['by_operation'].items():
+        print(f"{name:>10} {op['count']:>8} {op['per_second']:>8} {op['errors']:>7} {op['refused']:>8} "
+              f"{op['p50_ms']:>9} {op['p95_ms']:>9} {op['p99_ms']:>9} {op['max_ms']:>9}")
+    for name, message in report['errors'].items():
+        print(f"first {name} error: {message}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless load generator for the marketplace server")
+    parser.add_argument('--host', default=None, help="server address (default: this machine, like the GUI)")
+    parser.add_argument('--port', type=int, default=10001)
+    parser.add_argument('--users', type=int, default=20, help="simulated students, one connection each")
+    parser.add_argument('--duration', type=float, default=30.0, help="seconds of measured load")
+    parser.add_argument('--ramp', type=float, default=0.0, help="seconds over which the students connect")
+    parser.add_argument('--think', type=float, default=0.5,
+                        help="mean think time between a student's operations in seconds (0: none)")
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help="operation weights, e.g. browse=5,details=20,chat_send=15 "
+                             f"(operations: {', '.join(DEFAULT_MIX)})")
+    parser.add_argument('--products', type=int, default=2, help="products each student lists")
+    parser.add_argument('--prefix', default='loadtest', help="username prefix of the simulated students")
+    parser.add_argument('--timeout', type=float, default=30.0, help="seconds to wait for any one reply")
+    parser.add_argument('--seed', type=int, default=None, help="random seed, for repeatable operation sequences")
+    parser.add_argument('--json', default=None, help="also write the report to this file")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    host = args.host or socket.gethostbyname(socket.gethostname())
+    run = LoadRun(host, args.port, args.users, args.mix, args.think, args.products, args.prefix, args.timeout)
+    print(f"Connecting {args.users} student(s) to {host}:{args.port}...")
+    try:
+        run.connect(args.ramp)
+        print(f"Running for {args.duration}s")
+        report = run.run(args.duration)
+    finally:
+        run.close()
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(report, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
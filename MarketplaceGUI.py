@@ -7,7 +7,12 @@ import json
 import os
 from io import BytesIO
 import base64
+import zlib
 from ChatSystem import ChatWindow
+from Protocol import ClientConnection
+
+CATALOG_PAGE_SIZE = 24  # products per catalog request; more load as the list is scrolled
+HEARTBEAT_INTERVAL = 60  # seconds; well inside the server's idle timeout
 
 class MarketplaceGUI:
     def __init__(self, root):
@@ -17,19 +22,31 @@ class MarketplaceGUI:
         self.root.configure(bg="#1a1a2e")
         
         self.client = None
-        self.client_lock = threading.Lock()  # prevents race conditions on socket
         self.username = None
         self.current_user_port = None
         self.listening_server = None
         self.is_listening = False
         
         self.active_chats = {}
+        self.chat_histories = {}  # other user -> chat history loaded so far (ChatWindow)
         self.conversations = []
         self.unread_messages = {}
+        self.unread_total = 0
+        self.events_enabled = False  # True once the server pushes messages instead of us polling
+        self.pending_transactions = {}
+        self.last_transaction_check = {}
         self.current_product_context = None
         self.received_proposals = {}
         self.search_debounce_id = None  # timer for search delay
         
+        # full catalog kept after it has been paged through once; later visits
+        # only fetch what changed since catalog_version
+        self.catalog_cache = {}  # (product_name, seller) -> product
+        self.catalog_version = None
+        self.catalog_complete = False
+        self.catalog_etag = ""  # of the last full snapshot received (request 38)
+        self.catalog_images = {}  # image hash -> base64 for the snapshot's cards (request 44)
+        
         self.bg_dark = "#1a1a2e"
         self.bg_medium = "#16213e"  # Navigation and header background
         self.bg_light = "#0f3460"  # Button secondary color
@@ -89,12 +106,13 @@ class MarketplaceGUI:
         """
         try:
             # Create TCP socket for reliable communication
-            self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client.settimeout(30.0)  # 30 second timeout for server operations
+            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            client_socket.settimeout(30.0)  # 30 second timeout for server operations
             
             # Connect to server on local machine at specified port
             server_address = socket.gethostbyname(socket.gethostname())
-            self.client.connect((server_address, port))
+            client_socket.connect((server_address, port))
+            self.client = ClientConnection(client_socket, heartbeat=HEARTBEAT_INTERVAL)
             
             # Move to authentication screen on successful connection
             self.show_auth_screen()
@@ -149,47 +167,23 @@ class MarketplaceGUI:
                     messagebox.showerror("Error", "Not connected to server")
                     return
                 
-                with self.client_lock:
-                    self.client.send("yes".encode('utf-8'))
-                    self.client.send(username.encode('utf-8'))
-                    
-                    try:
-                        response = self.client.recv(1024).decode('utf-8')
-                    except:
-                        messagebox.showerror("Connection Error", "Lost connection to server")
-                        return
-                    
-                    if not response or not bool(int(response)):
-                        messagebox.showerror("Error", "Username not found")
-                        return
-                    
-                    self.client.send(password.encode('utf-8'))
-                    
-                    try:
-                        response = self.client.recv(1024).decode('utf-8')
-                    except:
-                        messagebox.showerror("Connection Error", "Lost connection to server")
-                        return
-                    
-                    if not response or not bool(int(response)):
-                        # Wrong password OR already logged in
-                        messagebox.showerror("Login Error", "Invalid password or user already logged in from another device")
-                        try:
-                            self.client.close()
-                        except:
-                            pass
-                        self.client = None
-                        self.show_login_screen()
-                        return
-                    
-                    self.client.send("1".encode('utf-8'))
-                    login_msg = self.client.recv(4096)
-                    
-                    if not login_msg:
-                        messagebox.showerror("Error", "Server connection lost")
-                        return
+                try:
+                    reply = self.client.request("yes", username, password)
+                except Exception:
+                    messagebox.showerror("Connection Error", "Lost connection to server")
+                    return
+                
+                if reply[0] == b'0':
+                    messagebox.showerror("Error", "Username not found")
+                    return
+                
+                if reply[0] != b'1':
+                    # Wrong password OR already logged in
+                    messagebox.showerror("Login Error", "Invalid password or user already logged in from another device")
+                    return
                 
                 self.username = username
+                self.subscribe_events()
                 self.show_marketplace()
             except socket.error as e:
                 messagebox.showerror("Connection Error", f"Lost connection to server: {str(e)}")
@@ -256,39 +250,23 @@ class MarketplaceGUI:
                     messagebox.showerror("Error", "Not connected to server")
                     return
                 
-                with self.client_lock:
-                    self.client.send("no".encode('utf-8'))
-                    
-                    self.client.send(username.encode('utf-8'))
-                    
-                    try:
-                        response = self.client.recv(1024).decode('utf-8')
-                    except:
-                        messagebox.showerror("Connection Error", "Lost connection to server")
-                        return
-                    
-                    if not response or not bool(int(response)):
-                        messagebox.showerror("Error", "Username already exists")
-                        return
-                    
-                    data = f"{name}|{password}"
-                    self.client.send(data.encode('utf-8'))
-                    
-                    try:
-                        response = self.client.recv(4096).decode('utf-8')
-                    except:
-                        messagebox.showerror("Connection Error", "Lost connection to server")
-                        return
-                    
-                    if not response:
-                        messagebox.showerror("Error", "Server connection lost")
-                        return
-                    
-                    # Send confirmation signal like login does
-                    self.client.send("1".encode('utf-8'))
+                try:
+                    reply = self.client.request("no", username, name, password)
+                except Exception:
+                    messagebox.showerror("Connection Error", "Lost connection to server")
+                    return
+                
+                if reply[0] == b'0':
+                    messagebox.showerror("Error", "Username already exists")
+                    return
+                
+                if reply[0] != b'1':
+                    messagebox.showerror("Error", "Error creating account")
+                    return
                 
                 messagebox.showinfo("Success", "Account created successfully!")
                 self.username = username
+                self.subscribe_events()
                 self.show_marketplace()
             except socket.error as e:
                 messagebox.showerror("Connection Error", f"Lost connection to server: {str(e)}")
@@ -383,7 +361,6 @@ class MarketplaceGUI:
                 bg=self.bg_dark,
                 fg=self.text_secondary).pack(side=tk.LEFT, padx=10)
         
-        self.all_products_data = None
         self.show_browse_products(embedded=True)
     
     def show_browse_products(self, embedded=False):
@@ -402,134 +379,237 @@ class MarketplaceGUI:
             back_btn = self.create_nav_button(header_frame, "← Back", self.show_marketplace)
             back_btn.pack(side=tk.RIGHT)
         
-        # Get products from server (or use cached data)
+        if not self.client:
+            messagebox.showerror("Error", "Not connected to server")
+            return
+        
+        # a search re-renders the list, so drop the previous one first
+        if getattr(self, 'browse_frame', None) is not None and self.browse_frame.winfo_exists():
+            self.browse_frame.destroy()
+        
+        # Create scrollable product list
+        canvas_frame = tk.Frame(self.root, bg=self.bg_dark)
+        canvas_frame.pack(fill=tk.BOTH, expand=True, padx=20, pady=(0, 20))
+        self.browse_frame = canvas_frame
+        
+        canvas = tk.Canvas(canvas_frame, bg=self.bg_dark, highlightthickness=0)
+        scrollbar = ttk.Scrollbar(canvas_frame, orient="vertical", command=canvas.yview)
+        scrollable_frame = tk.Frame(canvas, bg=self.bg_dark)
+        
+        scrollable_frame.bind(
+            "<Configure>",
+            lambda e: canvas.configure(scrollregion=canvas.bbox("all"))
+        )
+        
+        def on_scroll(first, last):
+            scrollbar.set(first, last)
+            # near the bottom (or the page doesn't fill the view yet): fetch the next page
+            if float(last) > 0.9:
+                self.load_next_catalog_page()
+        
+        canvas.create_window((0, 0), window=scrollable_frame, anchor="nw")
+        canvas.configure(yscrollcommand=on_scroll)
+        
+        canvas.pack(side="left", fill="both", expand=True)
+        scrollbar.pack(side="right", fill="y")
+        
+        self.product_list = scrollable_frame
+        self.catalog_generation = 0
+        self.reset_product_list()
+    
+    def reset_product_list(self):
+        """Start the list over: the whole catalog, or search results for the search box"""
+        for widget in self.product_list.winfo_children():
+            widget.destroy()
+        self.catalog_generation += 1  # pages still in flight for the old list are dropped
+        self.catalog_query = self.search_var.get().strip() if hasattr(self, 'search_var') else ""
+        self.catalog_cursor = ""
+        self.catalog_done = False
+        self.catalog_loading = False
+        self.catalog_local = None  # sorted cached products when paging locally
+        self.displayed_count = 0
+        if not self.catalog_query and self.catalog_complete:
+            self.sync_catalog()
+        else:
+            self.load_next_catalog_page()
+    
+    def sync_catalog(self):
+        """Bring the cached catalog up to date with only the changes since our version"""
+        self.catalog_loading = True
+        generation = self.catalog_generation
+        since_version = self.catalog_version
+        
+        def fetch():
+            changes, version, replace = None, None, False
+            try:
+                # reply: 1, changes, version - or 2, version when we are too far behind
+                reply = self.client.request("37", since_version)
+                if reply[0] == b'1':
+                    changes = json.loads(reply[1].decode('utf-8'))
+                    version = int(reply[2])
+                elif reply[0] == b'2':
+                    snapshot = self.fetch_catalog_snapshot()
+                    if snapshot:
+                        changes, version = snapshot
+                        replace = True
+            except Exception as e:
+                print(f"Error syncing catalog: {e}")
+            self.root.after(0, lambda: self.apply_catalog_changes(generation, changes, version, replace))
+        
+        threading.Thread(target=fetch, daemon=True).start()
+    
+    def fetch_catalog_snapshot(self):
+        """Download the whole catalog in one compressed reply; None if ours is still current or on error"""
+        # reply: 3 (not modified), 2 (too large, page it instead) or 1, etag, version, encoding, products
+        reply = self.client.request("38", self.catalog_etag, "zlib")
+        if reply[0] != b'1':
+            return None
+        body = zlib.decompress(reply[4]) if reply[3] == b'zlib' else reply[4]
+        rows = json.loads(body.decode('utf-8'))
+        images = self.fetch_catalog_images({row[4] for row in rows if row[4]})
+        self.catalog_etag = reply[1].decode('utf-8')
+        changes = []
+        for product_name, seller, rating, price, image_hash in rows:
+            product = (product_name, seller, rating, price, images.get(image_hash))
+            changes.append({'product_name': product_name, 'seller': seller, 'op': 'upsert', 'product': product})
+        return changes, int(reply[2])
+    
+    def fetch_catalog_images(self, hashes):
+        """Card images by hash, asking the server only for those not already held"""
+        images = {digest: self.catalog_images[digest] for digest in hashes if digest in self.catalog_images}
+        missing = sorted(hashes - images.keys())
+        while missing:
+            # reply: 1, {hash: base64 or null} for as many of the hashes as fit
+            reply = self.client.request("44", *missing[:100])
+            if reply[0] != b'1':
+                raise ValueError("Server rejected image request")
+            images.update(json.loads(reply[1].decode('utf-8')))
+            missing = [digest for digest in missing if digest not in images]
+        self.catalog_images = images  # images no longer in the catalog are dropped
+        return images
+    
+    def apply_catalog_changes(self, generation, changes, version, replace=False):
+        if replace:
+            self.catalog_cache = {}
+            self.catalog_complete = True
+        if changes is None:
+            # resync: forget the cache and page the catalog from the server again
+            self.catalog_cache = {}
+            self.catalog_complete = False
+            self.catalog_version = None
+        else:
+            for change in changes:
+                key = (change['product_name'], change['seller'])
+                if change['op'] == 'delete':
+                    self.catalog_cache.pop(key, None)
+                else:
+                    self.catalog_cache[key] = change['product']
+            self.catalog_version = version
+        
+        if generation != self.catalog_generation or not self.product_list.winfo_exists():
+            return
+        self.catalog_loading = False
+        if self.catalog_complete:
+            # same order as the server pages
+            self.catalog_local = [self.catalog_cache[key] for key in sorted(self.catalog_cache)]
+        self.load_next_catalog_page()
+    
+    def load_next_catalog_page(self):
+        """Fetch the next page of the catalog (or of the search results) in the background"""
+        if self.catalog_loading or self.catalog_done or not self.client:
+            return
+        
+        if self.catalog_local is not None:
+            # catalog is cached and synced: page through it without asking the server
+            start = self.catalog_cursor or 0
+            page = self.catalog_local[start:start + CATALOG_PAGE_SIZE]
+            end = start + len(page)
+            self.add_catalog_page(self.catalog_generation, page, end if end < len(self.catalog_local) else "")
+            return
+        
+        self.catalog_loading = True
+        generation = self.catalog_generation
+        query = self.catalog_query
+        cursor = self.catalog_cursor
+        
+        def fetch():
+            try:
+                # reply: status, products, cursor of the next page ("" on the last page)
+                if query:
+                    reply = self.client.request("36", query, CATALOG_PAGE_SIZE, cursor)  # ranked search
+                else:
+                    reply = self.client.request("35", CATALOG_PAGE_SIZE, cursor)
+                if reply[0] != b'1':
+                    raise ValueError("Server rejected catalog request")
+                products = json.loads(reply[1].decode('utf-8'))
+                next_cursor = reply[2].decode('utf-8') if len(reply) > 2 else ""
+                if not query:
+                    self.cache_catalog_page(cursor, products, next_cursor, int(reply[3]) if len(reply) > 3 else None)
+                self.root.after(0, lambda: self.add_catalog_page(generation, products, next_cursor))
+            except Exception as e:
+                print(f"Error loading products: {e}")
+                self.root.after(0, lambda: self.add_catalog_page(generation, [], ""))
+        
+        threading.Thread(target=fetch, daemon=True).start()
+    
+    def cache_catalog_page(self, cursor, products, next_cursor, version):
+        # the first page's version is where delta sync picks up; changes made
+        # while later pages load are replayed by the next sync
+        if not cursor:
+            self.catalog_cache = {}
+            self.catalog_complete = False
+            self.catalog_version = version
+        for product in products:
+            self.catalog_cache[(product[0], product[1])] = product
+        if not next_cursor and self.catalog_version is not None:
+            self.catalog_complete = True
+    
+    def add_catalog_page(self, generation, products, next_cursor):
+        """Append one page of products to the browse list"""
+        if generation != self.catalog_generation or not self.product_list.winfo_exists():
+            return  # the search changed or the user navigated away while the page was loading
+        
+        self.catalog_cursor = next_cursor
+        self.catalog_done = not next_cursor
+        self.catalog_loading = False
+        
+        for product in products:
+            self.add_product_card(product)
+        
+        if self.catalog_done and self.displayed_count == 0:
+            self.show_empty_catalog()
+    
+    def add_product_card(self, product):
         try:
-            if not self.client:
-                messagebox.showerror("Error", "Not connected to server")
-                return
-            
-            with self.client_lock:
-                self.client.send("1".encode('utf-8'))
-                
-                # Check for history response
-                history_check = self.client.recv(1024).decode('utf-8')
-                if history_check == '1':
-                    # Server is sending history, receive it
-                    length = int.from_bytes(self.client.recv(16), 'big')
-                    history_data = b""
-                    while len(history_data) < length:
-                        packet = self.client.recv(4096)
-                        if not packet:
-                            break
-                        history_data += packet
-                
-                # Send ready signal for products
-                self.client.send("ready".encode('utf-8'))
-                
-                # Now receive products
-                length = int.from_bytes(self.client.recv(16), 'big')
-                products_data = b""
-                while len(products_data) < length:
-                    packet = self.client.recv(4096)
-                    if not packet:
-                        break
-                    products_data += packet
-            
-            if not products_data:
-                products_dict = {}
-            else:
-                try:
-                    products_dict = json.loads(products_data.decode('utf-8', errors='ignore'))
-                except Exception as decode_error:
-                    print(f"Error decoding products: {decode_error}")
-                    products_dict = {}
-            
-            # Store for search filtering
-            self.all_products_data = products_dict
-            
-            # Create scrollable product list
-            canvas_frame = tk.Frame(self.root, bg=self.bg_dark)
-            canvas_frame.pack(fill=tk.BOTH, expand=True, padx=20, pady=(0, 20))
-            
-            canvas = tk.Canvas(canvas_frame, bg=self.bg_dark, highlightthickness=0)
-            scrollbar = ttk.Scrollbar(canvas_frame, orient="vertical", command=canvas.yview)
-            scrollable_frame = tk.Frame(canvas, bg=self.bg_dark)
-            
-            scrollable_frame.bind(
-                "<Configure>",
-                lambda e: canvas.configure(scrollregion=canvas.bbox("all"))
-            )
-            
-            canvas.create_window((0, 0), window=scrollable_frame, anchor="nw")
-            canvas.configure(yscrollcommand=scrollbar.set)
-            
-            # Check if products exist
-            # Filter products by search query
-            search_query = self.search_var.get().lower().strip() if hasattr(self, 'search_var') else ""
-            
-            has_products = False
-            displayed_count = 0
-            
-            if products_dict and isinstance(products_dict, dict):
-                for seller, products in products_dict.items():
-                    if products and len(products) > 0:
-                        for product in products:
-                            try:
-                                if len(product) >= 4:
-                                    product_name = product[0]
-                                    # Check if matches search
-                                    if (not search_query or 
-                                        search_query in product_name.lower() or 
-                                        search_query in seller.lower()):
-                                        has_products = True
-                                        displayed_count += 1
-                            except:
-                                pass
-            
-            if not has_products or displayed_count == 0:
-                empty_frame = tk.Frame(scrollable_frame, bg=self.bg_dark)
-                empty_frame.pack(pady=50, padx=20)
-                tk.Label(empty_frame, 
-                        text="📦 No products available yet", 
-                        font=('Segoe UI', 16, 'bold'),
-                        bg=self.bg_dark,
-                        fg=self.text_secondary).pack(pady=10)
-                tk.Label(empty_frame, 
-                        text="Be the first to list an item!", 
-                        font=('Segoe UI', 12),
-                        bg=self.bg_dark,
-                        fg=self.text_secondary).pack(pady=5)
-            else:
-                for seller, products in products_dict.items():
-                    if products:
-                        for product in products:
-                            try:
-                                if len(product) >= 4:
-                                    product_name, rating, price, image_b64 = product[0], product[1], product[2], product[3]
-                                    # Apply search filter
-                                    if (not search_query or 
-                                        search_query in product_name.lower() or 
-                                        search_query in seller.lower()):
-                                        self.create_product_card(scrollable_frame, product_name, seller, 
-                                                                float(rating) if rating else 0, 
-                                                                float(price) if price else 0, 
-                                                                image_b64)
-                                elif len(product) >= 2:  # Fallback for old format
-                                    product_name, rating = product[0], product[1]
-                                    if (not search_query or 
-                                        search_query in product_name.lower() or 
-                                        search_query in seller.lower()):
-                                        self.create_product_card(scrollable_frame, product_name, seller, 
-                                                                float(rating) if rating else 0, 0, None)
-                            except Exception as e:
-                                print(f"Error creating product card: {e}")
-                                continue
-            
-            canvas.pack(side="left", fill="both", expand=True)
-            scrollbar.pack(side="right", fill="y")
-            
+            product_name, seller, rating, price, image_b64 = product
+            self.create_product_card(self.product_list, product_name, seller,
+                                    float(rating) if rating else 0,
+                                    float(price) if price else 0,
+                                    image_b64)
+            self.displayed_count += 1
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to load products: {str(e)}")
+            print(f"Error creating product card: {e}")
+    
+    def show_empty_catalog(self):
+        empty_frame = tk.Frame(self.product_list, bg=self.bg_dark)
+        empty_frame.pack(pady=50, padx=20)
+        if self.catalog_query:
+            tk.Label(empty_frame, 
+                    text="🔍 No products match your search", 
+                    font=('Segoe UI', 16, 'bold'),
+                    bg=self.bg_dark,
+                    fg=self.text_secondary).pack(pady=10)
+            return
+        tk.Label(empty_frame, 
+                text="📦 No products available yet", 
+                font=('Segoe UI', 16, 'bold'),
+                bg=self.bg_dark,
+                fg=self.text_secondary).pack(pady=10)
+        tk.Label(empty_frame, 
+                text="Be the first to list an item!", 
+                font=('Segoe UI', 12),
+                bg=self.bg_dark,
+                fg=self.text_secondary).pack(pady=5)
     
     def create_product_card(self, parent, product_name, seller, rating, price=0, image_b64=None):
         card = tk.Frame(parent, bg=self.card_bg, relief="flat", borderwidth=0)
@@ -631,30 +711,16 @@ class MarketplaceGUI:
                 self.show_marketplace()
                 return
                 
-            # Send product details command
-            with self.client_lock:
-                self.client.send("3".encode('utf-8'))
-                # Send product name and seller together (format: "product_name|seller")
-                data_to_send = f"{product_name}|{seller}"
-                data_padded = data_to_send.encode('utf-8').ljust(1024, b'\0')
-                self.client.send(data_padded)
-                response = self.client.recv(1024).decode('utf-8')
-                
-                if not bool(int(response)):
-                    messagebox.showerror("Error", "Product not found")
-                    self.show_marketplace()
-                    return
-                
-                product_data = self.client.recv(4096).decode('utf-8')
-                self.client.send("11".encode('utf-8'))
-                
-                length = int.from_bytes(self.client.recv(16), 'big')
-                image_data = b""
-                while len(image_data) < length:
-                    chunk = self.client.recv(4096)
-                    if not chunk:
-                        break
-                    image_data += chunk
+            # Send product name and seller together (format: "product_name|seller")
+            reply = self.client.request("3", f"{product_name}|{seller}")
+            
+            if reply[0] != b'1':
+                messagebox.showerror("Error", "Product not found")
+                self.show_marketplace()
+                return
+            
+            product_data = reply[1].decode('utf-8')
+            image_data = reply[2]
             
             parts = product_data.split("|")
             if len(parts) != 4:
@@ -751,12 +817,9 @@ class MarketplaceGUI:
                 def delete_product():
                     if messagebox.askyesno("Delete Product", f"Are you sure you want to delete '{product_name}'?"):
                         try:
-                            self.client.send("23".encode('utf-8'))
-                            product_padded = product_name.encode('utf-8').ljust(1024, b'\0')
-                            self.client.send(product_padded)
-                            response = self.client.recv(1).decode('utf-8')
+                            reply = self.client.request("23", product_name)
                             
-                            if response == '1':
+                            if reply[0] == b'1':
                                 messagebox.showinfo("Success", "Product deleted successfully!")
                                 self.show_marketplace()
                             else:
@@ -782,13 +845,9 @@ class MarketplaceGUI:
                             return
                         
                         # Check if already purchased from this seller
-                        with self.client_lock:
-                            self.client.send("24".encode('utf-8'))
-                            # Send product name and seller (format: "product_name|seller")
-                            data_to_send = f"{product_name}|{seller_name}"
-                            product_padded = data_to_send.encode('utf-8').ljust(1024, b'\0')
-                            self.client.send(product_padded)
-                            already_purchased = self.client.recv(1).decode('utf-8') == '1'
+                        # Send product name and seller (format: "product_name|seller")
+                        reply = self.client.request("24", f"{product_name}|{seller_name}")
+                        already_purchased = reply[0] == b'1'
                         
                         # Store product context for the proposal dialog
                         self.current_product_context = {
@@ -961,24 +1020,11 @@ class MarketplaceGUI:
                         image_data = "No Image"
                 
                 # Send sell command with all product data
-                with self.client_lock:
-                    self.client.send("2".encode('utf-8'))
-                    
-                    # Send product name (padded to 1024 bytes)
-                    product_name_padded = product_name.encode('utf-8').ljust(1024, b'\0')
-                    self.client.send(product_name_padded)
-                    response = self.client.recv(1024).decode('utf-8')  # Server always allows
-                    
-                    # Send product data
-                    data = f"{product_name}|{image_data}|{description}|{price}|{quantity}"
-                    data_json = json.dumps(data)
-                    
-                    self.client.send(len(data_json).to_bytes(4, 'big'))
-                    self.client.sendall(data_json.encode('utf-8'))
-                    
-                    response = self.client.recv(1024).decode('utf-8')
+                data = f"{product_name}|{image_data}|{description}|{price}|{quantity}"
+                data_json = json.dumps(data)
+                reply = self.client.request("2", product_name, data_json)
                 
-                if bool(int(response)):
+                if reply[0] == b'1':
                     messagebox.showinfo("Success", "Product listed successfully! If this product already existed, stock has been added.")
                     self.show_marketplace()
                 else:
@@ -1024,28 +1070,14 @@ class MarketplaceGUI:
                 self.show_marketplace()
                 return
                 
-            # Send history command with lock to prevent concurrent access
-            with self.client_lock:
-                self.client.send("4".encode('utf-8'))
-                prev = self.client.recv(1).decode('utf-8')  # Only receive 1 byte
-                
-                if prev == "1":
-                    length = int.from_bytes(self.client.recv(16), 'big')
-                    history_data = b""
-                    while len(history_data) < length:
-                        packet = self.client.recv(4096)
-                        if not packet:
-                            break
-                        history_data += packet
-                    
-                    if not history_data:
-                        history = {}
-                    else:
-                        history = json.loads(history_data.decode('utf-8'))
-                else:
-                    history = {}
+            # Send history command
+            reply = self.client.request("4")
+            
+            if reply[0] == b'1' and reply[1]:
+                history = json.loads(reply[1].decode('utf-8'))
+            else:
+                history = {}
             
-            # Display history outside lock
             if history and any(history.values()):  # Check if there are any items
                 tk.Label(content_frame, text="Your Selling History:", 
                         font=('Segoe UI', 14, 'bold'),
@@ -1083,29 +1115,12 @@ class MarketplaceGUI:
         self.search_debounce_id = self.root.after(300, self.filter_products)
     
     def filter_products(self):
-        if not hasattr(self, 'all_products_data') or not self.all_products_data:
+        if getattr(self, 'product_list', None) is None or not self.product_list.winfo_exists():
             return
         
-        search_query = self.search_var.get().lower().strip()
-        
-        # Just reload the products view (more efficient)
-        if hasattr(self, 'all_products_data'):
-            # Store current data
-            temp_data = self.all_products_data
-            # Call show_browse_products which will use the cached data
-            self.show_browse_products(embedded=True)
-    
-    def check_new_messages_for_user(self, username):
-        """Check if user has sent new messages since last interaction"""
-        try:
-            with self.client_lock:
-                self.client.send("29".encode('utf-8'))  # New command to check new messages
-                user_padded = username.encode('utf-8').ljust(1024, b'\0')
-                self.client.send(user_padded)
-                response = self.client.recv(1).decode('utf-8')
-                return response == '1'
-        except:
-            return False
+        # The server ranks and pages the matches; an empty box goes back to the catalog
+        if self.search_var.get().strip() != self.catalog_query:
+            self.reset_product_list()
     
 
     
@@ -1183,29 +1198,25 @@ class MarketplaceGUI:
         # Load current profile data
         def load_current_profile():
             try:
-                with self.client_lock:
-                    self.client.send("18".encode('utf-8'))
-                    user_padded = self.username.encode('utf-8').ljust(1024, b'\0')
-                    self.client.send(user_padded)
-                    response = self.client.recv(4096).decode('utf-8')
-                    
-                    if response.startswith("profile:"):
-                        profile = json.loads(response[8:])
-                        if profile.get('real_name'):
-                            name_entry.insert(0, profile['real_name'])
-                        if profile.get('bio'):
-                            bio_text.insert("1.0", profile['bio'])
-                        if profile.get('profile_picture'):
-                            try:
-                                img_data = base64.b64decode(profile['profile_picture'])
-                                img = Image.open(BytesIO(img_data))
-                                img.thumbnail((150, 150))
-                                photo = ImageTk.PhotoImage(img)
-                                self.pfp_label.config(image=photo, text="")
-                                self.pfp_label.image = photo
-                                self.profile_pic_data = profile['profile_picture']
-                            except:
-                                pass
+                reply = self.client.request("18", self.username)
+                
+                if reply[0] == b'1':
+                    profile = json.loads(reply[1].decode('utf-8'))
+                    if profile.get('real_name'):
+                        name_entry.insert(0, profile['real_name'])
+                    if profile.get('bio'):
+                        bio_text.insert("1.0", profile['bio'])
+                    if profile.get('profile_picture'):
+                        try:
+                            img_data = base64.b64decode(profile['profile_picture'])
+                            img = Image.open(BytesIO(img_data))
+                            img.thumbnail((150, 150))
+                            photo = ImageTk.PhotoImage(img)
+                            self.pfp_label.config(image=photo, text="")
+                            self.pfp_label.image = photo
+                            self.profile_pic_data = profile['profile_picture']
+                        except:
+                            pass
             except Exception as e:
                 print(f"Error loading profile: {e}")
         
@@ -1222,23 +1233,19 @@ class MarketplaceGUI:
             
             def do_save():
                 try:
-                    with self.client_lock:
-                        self.client.send("31".encode('utf-8'))  # Update profile command
-                        profile_data = json.dumps({
-                            'username': self.username,
-                            'real_name': real_name,
-                            'bio': bio,
-                            'profile_picture': self.profile_pic_data
-                        })
-                        self.client.send(len(profile_data).to_bytes(16, 'big'))
-                        self.client.sendall(profile_data.encode('utf-8'))
-                        response = self.client.recv(1).decode('utf-8')
-                        
-                        if response == '1':
-                            self.root.after(0, lambda: messagebox.showinfo("Success", "Profile updated!"))
-                            self.root.after(0, lambda: profile_window.destroy())
-                        else:
-                            self.root.after(0, lambda: messagebox.showerror("Error", "Failed to update profile"))
+                    profile_data = json.dumps({
+                        'username': self.username,
+                        'real_name': real_name,
+                        'bio': bio,
+                        'profile_picture': self.profile_pic_data
+                    })
+                    reply = self.client.request("31", profile_data)  # Update profile command
+                    
+                    if reply[0] == b'1':
+                        self.root.after(0, lambda: messagebox.showinfo("Success", "Profile updated!"))
+                        self.root.after(0, lambda: profile_window.destroy())
+                    else:
+                        self.root.after(0, lambda: messagebox.showerror("Error", "Failed to update profile"))
                 except Exception as e:
                     self.root.after(0, lambda: messagebox.showerror("Error", str(e)))
             
@@ -1292,28 +1299,18 @@ class MarketplaceGUI:
         
         def load_products():
             try:
-                with self.client_lock:
-                    self.client.send("11".encode('utf-8'))
-                    user_padded = self.username.encode('utf-8').ljust(1024, b'\0')
-                    self.client.send(user_padded)
+                reply = self.client.request("11", self.username)
+                
+                if reply[0] == b'1':
+                    data = reply[1]
                     
-                    response = self.client.recv(1).decode('utf-8')
-                    if response == '1':
-                        length = int.from_bytes(self.client.recv(16), 'big')
-                        data = b""
-                        while len(data) < length:
-                            packet = self.client.recv(4096)
-                            if not packet:
-                                break
-                            data += packet
-                        
-                        if data:
-                            products = json.loads(data.decode('utf-8'))
-                            self.root.after(0, lambda: self.display_my_products(scrollable_frame, loading_label, products))
-                        else:
-                            self.root.after(0, lambda: loading_label.config(text="No products listed"))
+                    if data:
+                        products = json.loads(data.decode('utf-8'))
+                        self.root.after(0, lambda: self.display_my_products(scrollable_frame, loading_label, products))
                     else:
-                        self.root.after(0, lambda: loading_label.config(text="Failed to load products"))
+                        self.root.after(0, lambda: loading_label.config(text="No products listed"))
+                else:
+                    self.root.after(0, lambda: loading_label.config(text="Failed to load products"))
             except Exception as e:
                 print(f"Error loading products: {e}")
                 self.root.after(0, lambda: loading_label.config(text=f"Error: {e}"))
@@ -1482,27 +1479,15 @@ class MarketplaceGUI:
         # Load current description
         def load_description():
             try:
-                with self.client_lock:
-                    self.client.send("3".encode('utf-8'))
-                    # Send product name and seller (seller is current user for editing own product)
-                    data_to_send = f"{product['name']}|{self.username}"
-                    prod_padded = data_to_send.encode('utf-8').ljust(1024, b'\0')
-                    self.client.send(prod_padded)
-                    response = self.client.recv(1).decode('utf-8')
-                    
-                    if response == '1':
-                        length = int.from_bytes(self.client.recv(16), 'big')
-                        data = b""
-                        while len(data) < length:
-                            packet = self.client.recv(4096)
-                            if not packet:
-                                break
-                            data += packet
-                        
-                        if data:
-                            prod_details = json.loads(data.decode('utf-8'))
-                            if prod_details.get('description'):
-                                self.root.after(0, lambda: desc_text.insert("1.0", prod_details['description']))
+                # Send product name and seller (seller is current user for editing own product)
+                reply = self.client.request("3", f"{product['name']}|{self.username}")
+                
+                if reply[0] == b'1':
+                    # "seller|description|price|quantity" - description may itself contain '|'
+                    _, details = reply[1].decode('utf-8').split('|', 1)
+                    description = details.rsplit('|', 2)[0]
+                    if description:
+                        self.root.after(0, lambda: desc_text.insert("1.0", description))
             except Exception as e:
                 print(f"Error loading description: {e}")
         
@@ -1521,25 +1506,21 @@ class MarketplaceGUI:
                 
                 def do_update():
                     try:
-                        with self.client_lock:
-                            self.client.send("32".encode('utf-8'))  # Update product command
-                            update_data = json.dumps({
-                                'product_name': product['name'],
-                                'quantity': new_stock,
-                                'price': new_price,
-                                'description': new_description,
-                                'image': base64.b64encode(new_image_data[0]).decode('utf-8') if new_image_data[0] else None
-                            })
-                            self.client.send(len(update_data).to_bytes(16, 'big'))
-                            self.client.sendall(update_data.encode('utf-8'))
-                            response = self.client.recv(1).decode('utf-8')
-                            
-                            if response == '1':
-                                self.root.after(0, lambda: messagebox.showinfo("Success", "Product updated!"))
-                                self.root.after(0, lambda: dialog.destroy())
-                                self.root.after(0, lambda: self.show_my_products_manager())
-                            else:
-                                self.root.after(0, lambda: messagebox.showerror("Error", "Failed to update product"))
+                        update_data = json.dumps({
+                            'product_name': product['name'],
+                            'quantity': new_stock,
+                            'price': new_price,
+                            'description': new_description,
+                            'image': base64.b64encode(new_image_data[0]).decode('utf-8') if new_image_data[0] else None
+                        })
+                        reply = self.client.request("32", update_data)  # Update product command
+                        
+                        if reply[0] == b'1':
+                            self.root.after(0, lambda: messagebox.showinfo("Success", "Product updated!"))
+                            self.root.after(0, lambda: dialog.destroy())
+                            self.root.after(0, lambda: self.show_my_products_manager())
+                        else:
+                            self.root.after(0, lambda: messagebox.showerror("Error", "Failed to update product"))
                     except Exception as e:
                         self.root.after(0, lambda: messagebox.showerror("Error", str(e)))
                 
@@ -1584,18 +1565,13 @@ class MarketplaceGUI:
                     fg=self.text_secondary).pack(pady=20)
             self.root.update()
             
-            with self.client_lock:
-                self.client.send("10".encode('utf-8'))  # Command 10: Get conversations
-                length = int.from_bytes(self.client.recv(16), 'big')
-                conv_data = b""
-                while len(conv_data) < length:
-                    packet = self.client.recv(4096)
-                    if not packet:
-                        break
-                    conv_data += packet
-                
-                if conv_data:
-                    self.conversations = json.loads(conv_data.decode('utf-8'))
+            # Command 39: conversations with their last message and unread count
+            reply = self.client.request("39")
+            if reply[0] == b'1':
+                self.conversations = json.loads(reply[1].decode('utf-8'))
+                self.unread_messages = {conv['partner']: conv['unread']
+                                        for conv in self.conversations if conv['unread'] > 0}
+                self.unread_total = sum(self.unread_messages.values())
             
             # Remove loading indicator
             loading_frame.destroy()
@@ -1627,8 +1603,8 @@ class MarketplaceGUI:
                         bg=self.bg_dark,
                         fg=self.text_secondary).pack(pady=5)
             else:
-                for conv_user in self.conversations:
-                    self.create_conversation_card(scrollable_frame, conv_user)
+                for conversation in self.conversations:
+                    self.create_conversation_card(scrollable_frame, conversation)
             
             canvas.pack(side="left", fill="both", expand=True, padx=20, pady=20)
             scrollbar.pack(side="right", fill="y")
@@ -1636,8 +1612,9 @@ class MarketplaceGUI:
         except Exception as e:
             messagebox.showerror("Error", f"Failed to load conversations: {str(e)}")
     
-    def create_conversation_card(self, parent, username):
+    def create_conversation_card(self, parent, conversation):
         """Create a conversation card for the messages inbox"""
+        username = conversation['partner']
         card = tk.Frame(parent, bg=self.card_bg, relief="flat", borderwidth=0)
         card.pack(fill=tk.X, pady=8, padx=10)
         
@@ -1648,11 +1625,10 @@ class MarketplaceGUI:
         left_frame = tk.Frame(content, bg=self.card_bg)
         left_frame.pack(side=tk.LEFT, fill=tk.X, expand=True)
         
-        # Check for new messages since last login
-        has_new = self.check_new_messages_for_user(username)
+        unread = conversation['unread']
         
         username_text = f"👤 {username}"
-        if has_new:
+        if unread > 0:
             username_text = f"🔴 {username}"
         
         tk.Label(left_frame, text=username_text, 
@@ -1660,17 +1636,18 @@ class MarketplaceGUI:
                 bg=self.card_bg,
                 fg=self.text_light).pack(anchor="w", pady=2)
         
-        unread = self.unread_messages.get(username, 0)
+        # Last message in the conversation
+        prefix = "You: " if conversation['last_sender'] == self.username else ""
+        tk.Label(left_frame, text=f"{prefix}{conversation['snippet']}",
+                font=('Segoe UI', 10),
+                bg=self.card_bg,
+                fg=self.text_secondary).pack(anchor="w", pady=2)
+        
         if unread > 0:
             tk.Label(left_frame, text=f"📩 {unread} unread message{'s' if unread > 1 else ''}", 
                     font=('Segoe UI', 10),
                     bg=self.card_bg,
                     fg=self.accent).pack(anchor="w", pady=2)
-        elif has_new:
-            tk.Label(left_frame, text="New messages since last login", 
-                    font=('Segoe UI', 10),
-                    bg=self.card_bg,
-                    fg=self.accent).pack(anchor="w", pady=2)
         
         # Open chat button
         open_btn = tk.Button(content, text="Open Chat →",
@@ -1692,49 +1669,98 @@ class MarketplaceGUI:
             while self.client and self.username:
                 try:
                     # Check for unread messages
-                    with self.client_lock:
-                        self.client.send("5".encode('utf-8'))
-                        response = self.client.recv(1).decode('utf-8')
-                        
-                        if response == '1':
-                            length = int.from_bytes(self.client.recv(16), 'big')
-                            data = b""
-                            while len(data) < length:
-                                packet = self.client.recv(4096)
-                                if not packet:
-                                    break
-                                data += packet
-                            
-                            if data:
-                                unread = json.loads(data.decode('utf-8'))
-                                total_unread = sum(unread.values())
-                                
-                                # Update button text with badge
-                                if total_unread > 0:
-                                    self.root.after(0, lambda: self.messages_btn.config(
-                                        text=f"Messages ({total_unread})",
-                                        bg="#ef4444"  # Red to indicate new messages
-                                    ))
-                                else:
-                                    self.root.after(0, lambda: self.messages_btn.config(
-                                        text="Messages",
-                                        bg=self.accent
-                                    ))
+                    reply = self.client.request("5")
+                    
+                    if reply[0] == b'1' and reply[1]:
+                        unread = json.loads(reply[1].decode('utf-8'))
+                        self.unread_messages = {}
+                        for _, sender, _, _ in unread:
+                            self.unread_messages[sender] = self.unread_messages.get(sender, 0) + 1
+                    else:
+                        self.unread_messages = {}
+                    self.unread_total = sum(self.unread_messages.values())
+                    self.root.after(0, self.update_messages_badge)
                 except:
                     pass
                 
+                # With events on, this first count is enough; new messages are pushed
+                if self.events_enabled:
+                    break
+                
                 # Check every 5 seconds
                 import time
                 time.sleep(5)
         
         threading.Thread(target=check_messages, daemon=True).start()
     
+    def update_messages_badge(self):
+        """Show the unread count on the Messages button"""
+        try:
+            if self.unread_total > 0:
+                self.messages_btn.config(
+                    text=f"Messages ({self.unread_total})",
+                    bg="#ef4444"  # Red to indicate new messages
+                )
+            else:
+                self.messages_btn.config(
+                    text="Messages",
+                    bg=self.accent
+                )
+        except tk.TclError:
+            pass  # nav bar not on screen right now
+    
+    def subscribe_events(self):
+        """Ask the server to push messages, presence and transactions to us.
+        
+        Falls back to polling if the server does not support events.
+        """
+        self.client.on_event = self.on_server_event
+        try:
+            reply = self.client.request("33")  # Command 33: Subscribe to events
+            self.events_enabled = reply[0] == b'1'
+        except Exception:
+            self.events_enabled = False
+    
+    def on_server_event(self, event, payload):
+        # called on the connection's reader thread; Tk work must happen on the main loop
+        self.root.after(0, lambda: self.handle_server_event(event, payload))
+    
+    def handle_server_event(self, event, payload):
+        """Route a pushed event to the open chat window or the Messages badge"""
+        if event == "message":
+            sender = payload['sender']
+            chat = self.active_chats.get(sender)
+            if chat:
+                chat.receive_message(payload)
+            else:
+                self.unread_messages[sender] = self.unread_messages.get(sender, 0) + 1
+                self.unread_total += 1
+                self.update_messages_badge()
+        
+        elif event == "presence":
+            chat = self.active_chats.get(payload['user'])
+            if chat:
+                chat.update_status(payload['online'])
+        
+        elif event == "transaction":
+            other_user = payload['seller'] if payload['buyer'] == self.username else payload['buyer']
+            chat = self.active_chats.get(other_user)
+            if payload['status'] == 'pending':
+                self.pending_transactions[payload['id']] = payload
+            if chat:
+                self.show_transaction_notification(payload, chat.chat_display)
+    
+    def clear_unread(self, other_user):
+        """Drop the badge count for a conversation that has been read"""
+        self.unread_total -= self.unread_messages.pop(other_user, 0)
+        self.unread_total = max(self.unread_total, 0)
+        self.update_messages_badge()
+    
     def logout(self):
         # Unregister from server
         try:
             if self.client and self.username:
-                with self.client_lock:
-                    self.client.send("9".encode('utf-8'))  # Logout command
+                self.client.request("9")  # Logout command
         except:
             pass
         
@@ -1745,6 +1771,8 @@ class MarketplaceGUI:
             pass
         self.client = None
         self.username = None
+        self.events_enabled = False
+        self.chat_histories = {}
         self.show_login_screen()
     
 
@@ -1792,27 +1820,15 @@ class MarketplaceGUI:
         
         # Get user info and products
         try:
-            with self.client_lock:
-                self.client.send("18".encode('utf-8'))
-                # Pad username to 1024 bytes
-                username_padded = username.encode('utf-8').ljust(1024, b'\0')
-                self.client.send(username_padded)
-                
-                # Check if profile exists
-                success = self.client.recv(1).decode('utf-8')
-                if success != '1':
-                    messagebox.showerror("Error", "Profile not found")
-                    self.show_marketplace()
-                    return
-                
-                # Receive length-prefixed data
-                length = int.from_bytes(self.client.recv(16), 'big')
-                profile_data = b""
-                while len(profile_data) < length:
-                    chunk = self.client.recv(4096)
-                    if not chunk:
-                        break
-                    profile_data += chunk
+            reply = self.client.request("18", username)
+            
+            # Check if profile exists
+            if reply[0] != b'1':
+                messagebox.showerror("Error", "Profile not found")
+                self.show_marketplace()
+                return
+            
+            profile_data = reply[1]
             
             if profile_data:
                 try:
@@ -2045,23 +2061,14 @@ class MarketplaceGUI:
         
         # Get current profile data
         try:
-            with self.client_lock:
-                self.client.send("18".encode('utf-8'))
-                self.client.send(self.username.encode('utf-8').ljust(1024, b'\0'))
-                
-                success = self.client.recv(1).decode('utf-8')
-                if success != '1':
-                    messagebox.showerror("Error", "Could not load profile data")
-                    dialog.destroy()
-                    return
-                
-                length = int.from_bytes(self.client.recv(16), 'big')
-                profile_data = b""
-                while len(profile_data) < length:
-                    chunk = self.client.recv(4096)
-                    if not chunk:
-                        break
-                    profile_data += chunk
+            reply = self.client.request("18", self.username)
+            
+            if reply[0] != b'1':
+                messagebox.showerror("Error", "Could not load profile data")
+                dialog.destroy()
+                return
+            
+            profile_data = reply[1]
             
             if not profile_data:
                 messagebox.showerror("Error", "Could not load profile data")
@@ -2149,22 +2156,16 @@ class MarketplaceGUI:
                 return
             
             try:
-                with self.client_lock:
-                    self.client.send("19".encode('utf-8'))  # Command 19: Update profile
-                    
-                    profile_data = {
-                        'real_name': new_name,
-                        'bio': new_bio,
-                        'profile_picture': selected_image[0]
-                    }
-                    
-                    profile_json = json.dumps(profile_data)
-                    self.client.send(len(profile_json).to_bytes(16, 'big'))
-                    self.client.sendall(profile_json.encode('utf-8'))
-                    
-                    result = self.client.recv(1024).decode('utf-8')
+                profile_data = {
+                    'real_name': new_name,
+                    'bio': new_bio,
+                    'profile_picture': selected_image[0]
+                }
+                
+                profile_json = json.dumps(profile_data)
+                reply = self.client.request("19", profile_json)  # Command 19: Update profile
                 
-                if result == '1':
+                if reply[0] == b'1':
                     messagebox.showinfo("Success", "Profile updated successfully!")
                     dialog.destroy()
                     self.show_user_profile(self.username)
@@ -2284,24 +2285,18 @@ class MarketplaceGUI:
                     return
                 
                 # Send update command (32) to server
-                with self.client_lock:
-                    self.client.send("32".encode('utf-8'))
-                    
-                    update_data = {
-                        'product_name': product['product_name'],
-                        'quantity': quantity,
-                        'price': price,
-                        'description': description,
-                        'image': selected_image[0]
-                    }
-                    
-                    update_json = json.dumps(update_data)
-                    self.client.send(len(update_json).to_bytes(16, 'big'))
-                    self.client.sendall(update_json.encode('utf-8'))
-                    
-                    result = self.client.recv(1024).decode('utf-8')
-                
-                if result == '1':
+                update_data = {
+                    'product_name': product['product_name'],
+                    'quantity': quantity,
+                    'price': price,
+                    'description': description,
+                    'image': selected_image[0]
+                }
+                
+                update_json = json.dumps(update_data)
+                reply = self.client.request("32", update_json)
+                
+                if reply[0] == b'1':
                     messagebox.showinfo("Success", "Product updated successfully!")
                     dialog.destroy()
                     self.show_user_profile(self.username)
@@ -2441,13 +2436,9 @@ class MarketplaceGUI:
         """Send proposal message via server"""
         def do_send():
             try:
-                with self.client_lock:
-                    self.client.send("7".encode('utf-8'))
-                    self.client.send(recipient.encode('utf-8').ljust(1024, b'\0'))
-                    self.client.send(message.encode('utf-8').ljust(4096, b'\0'))
-                    response = self.client.recv(1024).decode('utf-8')
+                reply = self.client.request("7", recipient, message)
                 
-                if response == '1':
+                if reply[0] == b'1':
                     self.root.after(0, lambda: self.update_chat_after_proposal(chat_display, message))
                 else:
                     self.root.after(0, lambda: messagebox.showerror("Error", "Failed to send proposal"))
@@ -2533,21 +2524,16 @@ class MarketplaceGUI:
             
             def do_submit():
                 try:
-                    with self.client_lock:
-                        # Command 22: Submit ratings
-                        self.client.send("22".encode('utf-8'))
-                        rating_data = json.dumps({
-                            'product_name': product_name,
-                            'seller': seller,
-                            'buyer': self.username,
-                            'product_rating': product_rating,
-                            'seller_rating': seller_rating
-                        })
-                        self.client.send(len(rating_data).to_bytes(16, 'big'))
-                        self.client.sendall(rating_data.encode('utf-8'))
-                        response = self.client.recv(1024).decode('utf-8')
+                    rating_data = json.dumps({
+                        'product_name': product_name,
+                        'seller': seller,
+                        'buyer': self.username,
+                        'product_rating': product_rating,
+                        'seller_rating': seller_rating
+                    })
+                    reply = self.client.request("22", rating_data)  # Command 22: Submit ratings
                     
-                    if response == '1':
+                    if reply[0] == b'1':
                         self.root.after(0, lambda: self.rating_submitted(dialog, chat_display, product_rating, seller_rating))
                     else:
                         self.root.after(0, lambda: messagebox.showinfo("Info", "Rating saved locally"))
@@ -2599,28 +2585,16 @@ class MarketplaceGUI:
                 return  # Skip check if we checked within last 5 seconds
         
         try:
-            with self.client_lock:
-                self.client.send("13".encode('utf-8'))  # Command 13: Check transactions
-                self.client.send(other_user.encode('utf-8'))
+            reply = self.client.request("13", other_user)  # Command 13: Check transactions
+            
+            if reply[0] == b'1' and reply[1]:
+                transactions = json.loads(reply[1].decode('utf-8'))
                 
-                response = self.client.recv(1024).decode('utf-8')
-                if response == '1':
-                    length = int.from_bytes(self.client.recv(16), 'big')
-                    trans_data = b""
-                    while len(trans_data) < length:
-                        packet = self.client.recv(4096)
-                        if not packet:
-                            break
-                        trans_data += packet
-                    
-                    if trans_data:
-                        transactions = json.loads(trans_data.decode('utf-8'))
-                        
-                        for trans in transactions:
-                            trans_id = trans['id']
-                            if trans_id not in self.pending_transactions:
-                                self.pending_transactions[trans_id] = trans
-                                self.show_transaction_notification(trans, chat_display)
+                for trans in transactions:
+                    trans_id = trans['id']
+                    if trans_id not in self.pending_transactions:
+                        self.pending_transactions[trans_id] = trans
+                        self.show_transaction_notification(trans, chat_display)
             
             # Update cache time
             self.last_transaction_check[cache_key] = current_time
@@ -2714,20 +2688,22 @@ class MarketplaceGUI:
                                f"The seller declined this purchase proposal.\n\n",
                                "system")
         
+        elif status == 'expired':
+            chat_display.insert(tk.END,
+                               f"\n[PURCHASE EXPIRED]\n"
+                               f"Product: {product}\n"
+                               f"The purchase was not completed in time and the stock was released.\n\n",
+                               "system")
+        
         chat_display.config(state=tk.DISABLED)
         chat_display.see(tk.END)
     
     def respond_to_transaction(self, trans_id, response, chat_display):
         """Respond to a purchase transaction"""
         try:
-            with self.client_lock:
-                self.client.send("14".encode('utf-8'))  # Command 14: Respond to transaction
-                self.client.send(trans_id.encode('utf-8'))
-                self.client.send(response.encode('utf-8'))
-                
-                result = self.client.recv(1024).decode('utf-8')
+            reply = self.client.request("14", trans_id, response)  # Command 14: Respond to transaction
             
-            if result == '1':
+            if reply[0] == b'1':
                 chat_display.config(state=tk.NORMAL)
                 if response == 'approved':
                     chat_display.insert(tk.END,
@@ -2743,6 +2719,10 @@ class MarketplaceGUI:
                 # Remove from pending
                 if trans_id in self.pending_transactions:
                     del self.pending_transactions[trans_id]
+            elif reply[0] == b'2':
+                # the stock is reserved when approving; someone else bought it first
+                self.root.after(0, lambda: messagebox.showwarning(
+                    "Out of Stock", "There is not enough stock left to approve this purchase."))
         except Exception as e:
             messagebox.showerror("Error", f"Failed to respond: {str(e)}")
     
@@ -2812,16 +2792,10 @@ class MarketplaceGUI:
             buyer_rating = int(buyer_rating_var.get())
             
             try:
-                with self.client_lock:
-                    self.client.send("15".encode('utf-8'))  # Command 15: Complete purchase & rate
-                    self.client.send(trans_id.encode('utf-8').ljust(1024, b'\0'))
-                    self.client.send(product_name.encode('utf-8').ljust(1024, b'\0'))
-                    self.client.send(str(product_rating).encode('utf-8').ljust(1024, b'\0'))
-                    self.client.send(str(buyer_rating).encode('utf-8').ljust(1024, b'\0'))
-                    
-                    result = self.client.recv(1024).decode('utf-8')
+                # Command 15: Complete purchase & rate
+                reply = self.client.request("15", trans_id, product_name, product_rating, buyer_rating)
                 
-                if result == '1':
+                if reply[0] == b'1':
                     messagebox.showinfo("Success", "Purchase completed! Thank you for your ratings.")
                     
                     chat_display.config(state=tk.NORMAL)
@@ -0,0 +1,211 @@
+import os
+import threading
+import time
+import bisect
+from collections import deque
+
+# Per-request-code instrumentation for the server.
+#
+# Every request the server answers is recorded under its request code: how many
+# there were, how many raised an error, how many were refused (status 0, which
+# for some codes just means "nothing found"), bytes received and sent, and how
+# long it took from the frame arriving to the reply being written. The time is
+# split into SQLite (waiting for a pooled connection, statements, fetches,
+# commits and group-commit waits) and socket I/O (writing the reply); the rest
+# is Python work and time queued for a worker.
+#
+# Latencies go into a fixed histogram with four buckets per doubling (each
+# bucket about 19% wide) from 50 microseconds to about a minute, so recording is
+# a bisect and an increment and the percentiles are read off the bucket counts.
+#
+# stats() is what the metrics request returns; prometheus() renders the same
+# counters in the Prometheus text format, which write_prometheus() drops into a
+# file for a node_exporter textfile collector or anything else that scrapes it.
+#
+# MetricsHistory is a ring buffer of periodic samples (rates worked out from
+# totals() between two samples, plus whatever gauges the server adds) for live
+# views such as the dashboard: they read the ring, never the request path.
+
+BUCKET_BOUNDS = tuple(0.00005 * 2 ** (step / 4) for step in range(81))  # seconds, last ~56s
+EXPORTED_BOUNDS = BUCKET_BOUNDS[::4]  # one le per doubling keeps the export short
+MAX_CODES = 64  # anything past this is counted under 'other'
+PREFIX = 'marketplace'
+
+
+class CodeMetrics:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.refused = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.db = 0.0
+        self.io = 0.0
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)  # the last one is +Inf
+
+    def percentile(self, fraction):
+        # linear interpolation inside the bucket holding the wanted rank
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, hits in enumerate(self.buckets):
+            if hits and seen + hits >= rank:
+                lower = BUCKET_BOUNDS[index - 1] if index else 0.0
+                upper = BUCKET_BOUNDS[index] if index < len(BUCKET_BOUNDS) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / hits, self.max)
+            seen += hits
+        return self.max
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.codes = {}
+        self.started = time.time()
+
+    def record(self, code, seconds, bytes_in=0, bytes_out=0, error=False, refused=False, db_seconds=0.0,
+               io_seconds=0.0):
+        with self.lock:
+            metrics = self.codes.get(code)
+            if metrics is None:
+                if len(self.codes) >= MAX_CODES:
+                    code = 'other'  # a client sending junk codes cannot grow this without bound
+                metrics = self.codes.setdefault(code, CodeMetrics())
+            metrics.count += 1
+            metrics.errors += bool(error)
+            metrics.refused += bool(refused)
+            metrics.bytes_in += bytes_in
+            metrics.bytes_out += bytes_out
+            metrics.total += seconds
+            metrics.max = max(metrics.max, seconds)
+            metrics.db += db_seconds
+            metrics.io += io_seconds
+            metrics.buckets[bisect.bisect_left(BUCKET_BOUNDS, seconds)] += 1
+
+    def stats(self):
+        with self.lock:
+            uptime = time.time() - self.started
+            codes = {}
+            for code, metrics in sorted(self.codes.items(), key=lambda item: -item[1].total):
+                count = metrics.count
+                codes[code] = {
+                    'count': count,
+                    'errors': metrics.errors,
+                    'refused': metrics.refused,
+                    'per_second': round(count / uptime, 3) if uptime else 0.0,
+                    'bytes_in': metrics.bytes_in,
+                    'bytes_out': metrics.bytes_out,
+                    'avg_ms': round(metrics.total / count * 1000, 3),
+                    'p50_ms': round(metrics.percentile(0.50) * 1000, 3),
+                    'p95_ms': round(metrics.percentile(0.95) * 1000, 3),
+                    'p99_ms': round(metrics.percentile(0.99) * 1000, 3),
+                    'max_ms': round(metrics.max * 1000, 3),
+                    'db_ms': round(metrics.db * 1000, 3),
+                    'io_ms': round(metrics.io * 1000, 3),
+                    'total_ms': round(metrics.total * 1000, 3),
+                }
+            return {
+                'uptime': round(uptime, 1),
+                'requests': sum(code['count'] for code in codes.values()),
+                'codes': codes,  # most total time first
+            }
+
+    def totals(self):
+        # {code: (count, errors, seconds, db seconds)}, cheap enough to take every second
+        with self.lock:
+            return {code: (m.count, m.errors, m.total, m.db) for code, m in self.codes.items()}
+
+    def prometheus(self, gauges=None):
+        # gauges: extra {name: value} sampled by the caller (connections, queue depth, ...)
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+
+        with self.lock:
+            codes = sorted(self.codes.items())
+            family('requests_total', 'counter', "Requests answered, by request code.")
+            lines += [f'{PREFIX}_requests_total{{code="{code}"}} {m.count}' for code, m in codes]
+            family('request_errors_total', 'counter', "Requests that raised an error.")
+            lines += [f'{PREFIX}_request_errors_total{{code="{code}"}} {m.errors}' for code, m in codes]
+            family('request_refused_total', 'counter', "Requests answered with status 0.")
+            lines += [f'{PREFIX}_request_refused_total{{code="{code}"}} {m.refused}' for code, m in codes]
+            family('request_received_bytes_total', 'counter', "Request frame bytes received.")
+            lines += [f'{PREFIX}_request_received_bytes_total{{code="{code}"}} {m.bytes_in}' for code, m in codes]
+            family('request_sent_bytes_total', 'counter', "Reply frame bytes sent.")
+            lines += [f'{PREFIX}_request_sent_bytes_total{{code="{code}"}} {m.bytes_out}' for code, m in codes]
+            family('request_db_seconds_total', 'counter', "Time requests spent in SQLite.")
+            lines += [f'{PREFIX}_request_db_seconds_total{{code="{code}"}} {m.db:.6f}' for code, m in codes]
+            family('request_io_seconds_total', 'counter', "Time spent writing replies to the socket.")
+            lines += [f'{PREFIX}_request_io_seconds_total{{code="{code}"}} {m.io:.6f}' for code, m in codes]
+
+            family('request_duration_seconds', 'histogram', "Time from request received to reply sent.")
+            for code, metrics in codes:
+                cumulative = 0
+                bucket = 0
+                for bound in EXPORTED_BOUNDS:
+                    while bucket < len(BUCKET_BOUNDS) and BUCKET_BOUNDS[bucket] <= bound:
+                        cumulative += metrics.buckets[bucket]
+                        bucket += 1
+                    lines.append(f'{PREFIX}_request_duration_seconds_bucket{{code="{code}",le="{bound:.6g}"}} {cumulative}')
+                lines.append(f'{PREFIX}_request_duration_seconds_bucket{{code="{code}",le="+Inf"}} {metrics.count}')
+                lines.append(f'{PREFIX}_request_duration_seconds_sum{{code="{code}"}} {metrics.total:.6f}')
+                lines.append(f'{PREFIX}_request_duration_seconds_count{{code="{code}"}} {metrics.count}')
+
+        for name, value in (gauges or {}).items():
+            family(name, 'gauge', name.replace('_', ' ').capitalize() + ".")
+            lines.append(f"{PREFIX}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path, gauges=None):
+        # written beside the target and renamed over it, so a scraper never reads half a file
+        temporary = f"{path}.tmp"
+        with open(temporary, 'w') as out:
+            out.write(self.prometheus(gauges))
+        os.replace(temporary, path)
+
+
+class MetricsHistory:
+    def __init__(self, size=300):
+        self.lock = threading.Lock()
+        self.samples = deque(maxlen=size)
+        self.previous = None  # (time, totals) of the last sample
+
+    def sample(self, metrics, gauges):
+        # turns the request totals since the last sample into rates and appends
+        # them with gauges; returns the new sample
+        now = time.monotonic()
+        totals = metrics.totals()
+        rates = {}
+        count_delta = seconds = db_seconds = 0
+        elapsed = now - self.previous[0] if self.previous else 0.0
+        if elapsed > 0:
+            before = self.previous[1]
+            for code, (count, _, total, db) in totals.items():
+                old = before.get(code, (0, 0, 0.0, 0.0))
+                if count > old[0]:
+                    rates[code] = {'per_second': (count - old[0]) / elapsed,
+                                   'avg_ms': (total - old[2]) / (count - old[0]) * 1000}
+                    count_delta += count - old[0]
+                    seconds += total - old[2]
+                    db_seconds += db - old[3]
+        self.previous = (now, totals)
+        entry = {
+            'time': time.time(),
+            'requests_per_second': count_delta / elapsed if elapsed > 0 else 0.0,
+            'avg_ms': seconds / count_delta * 1000 if count_delta else 0.0,
+            'db_ms': db_seconds / count_delta * 1000 if count_delta else 0.0,  # per request
+            'rates': rates,  # per code, only codes seen since the last sample
+            **gauges,
+        }
+        with self.lock:
+            self.samples.append(entry)
+        return entry
+
+    def latest(self, count=1):
+        with self.lock:
+            return list(self.samples)[-count:]
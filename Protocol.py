@@ -0,0 +1,324 @@
+import json
+import asyncio
+import select
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeout
+
+# Wire format shared by ServerGUI, MarketplaceGUI and ChatSystem.
+#
+# Every message is one frame:
+#   version (1 byte) | kind (1 byte) | request id (4 bytes) | payload length (4 bytes) | payload
+#
+# The payload is a list of fields, each with its own 4-byte length prefix, so a
+# request is [code, arg, arg, ...] and a reply is [status, data, ...]. Fields can
+# hold text or raw bytes (images) and never need padding.
+#
+# Events are frames the server pushes without being asked (new chat messages,
+# presence changes, transaction updates). They use request id 0 and carry
+# [event name, json payload].
+#
+# An overloaded server answers a request with the status SERVER_BUSY instead
+# of running it, and turns away a connection it has no room for with a "busy"
+# event before closing it. Clients send HEARTBEAT_CODE while otherwise quiet
+# so the server can tell an idle client from a dead one.
+
+PROTOCOL_VERSION = 1
+
+KIND_REQUEST = 0
+KIND_RESPONSE = 1
+KIND_EVENT = 2
+
+EVENT_REQUEST_ID = 0
+
+SERVER_BUSY = b'busy'
+BUSY_EVENT = "busy"
+HEARTBEAT_CODE = "41"
+
+HEADER = struct.Struct('!BBII')
+FIELD_LENGTH = struct.Struct('!I')
+
+MAX_PAYLOAD = 64 * 1024 * 1024  # a full catalog with images still fits
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class ServerBusy(Exception):
+    """The server turned the request or the connection away because it is overloaded."""
+
+
+def encode_field(value):
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value)
+    if value is None:
+        return b''
+    return str(value).encode('utf-8')
+
+
+def encode_frame(kind, request_id, fields):
+    payload = b''.join(FIELD_LENGTH.pack(len(data)) + data
+                       for data in (encode_field(field) for field in fields))
+    if len(payload) > MAX_PAYLOAD:
+        raise ProtocolError(f"Payload too large: {len(payload)} bytes")
+    return HEADER.pack(PROTOCOL_VERSION, kind, request_id, len(payload)) + payload
+
+
+def decode_header(header):
+    version, kind, request_id, length = HEADER.unpack(header)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    if length > MAX_PAYLOAD:
+        raise ProtocolError(f"Payload too large: {length} bytes")
+    return kind, request_id, length
+
+
+def decode_fields(payload):
+    fields = []
+    offset = 0
+    while offset < len(payload):
+        if offset + FIELD_LENGTH.size > len(payload):
+            raise ProtocolError("Truncated field header")
+        (size,) = FIELD_LENGTH.unpack_from(payload, offset)
+        offset += FIELD_LENGTH.size
+        if offset + size > len(payload):
+            raise ProtocolError("Truncated field")
+        fields.append(payload[offset:offset + size])
+        offset += size
+    return fields
+
+
+def field_text(field):
+    return field.decode('utf-8') if field else ""
+
+
+def wait_readable(sock, timeout):
+    # True once sock has data (or EOF) to read, False after timeout seconds.
+    # poll where there is one: select() cannot watch descriptors past 1023
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        return bool(poller.poll(timeout * 1000))
+    return bool(select.select([sock], [], [], timeout)[0])
+
+
+def recv_timed_out(data):
+    # nothing of the frame read yet: the caller may just wait again
+    if data:
+        return ProtocolError("Timed out mid-frame")
+    return socket.timeout("No data received in time")
+
+
+def recv_exact(sock, size, timeout=None):
+    # None on a clean close before any byte arrived, error if cut off mid-way.
+    # timeout bounds the wait for each chunk without putting a timeout on the
+    # socket, which would cut off slow sends as well
+    data = bytearray()
+    while len(data) < size:
+        if timeout is not None and not wait_readable(sock, timeout):
+            raise recv_timed_out(data)
+        chunk = sock.recv(min(size - len(data), 65536))
+        if not chunk:
+            if not data:
+                return None
+            raise ProtocolError("Connection closed mid-frame")
+        data += chunk
+    return bytes(data)
+
+
+def recv_frame(sock, timeout=None):
+    header = recv_exact(sock, HEADER.size, timeout)
+    if header is None:
+        return None
+    kind, request_id, length = decode_header(header)
+    try:
+        payload = recv_exact(sock, length, timeout) if length else b''
+    except socket.timeout:
+        raise ProtocolError("Timed out mid-frame")
+    if payload is None:
+        raise ProtocolError("Connection closed mid-frame")
+    return kind, request_id, decode_fields(payload)
+
+
+def frame_size(fields):
+    # bytes on the wire for a frame of already received (bytes) fields
+    return HEADER.size + sum(FIELD_LENGTH.size + len(field) for field in fields)
+
+
+def send_frame(sock, kind, request_id, fields):
+    # returns the number of bytes sent
+    frame = encode_frame(kind, request_id, fields)
+    sock.sendall(frame)
+    return len(frame)
+
+
+async def recv_exact_async(loop, sock, size, timeout=None):
+    data = bytearray()
+    while len(data) < size:
+        try:
+            # a sock_recv cancelled before it returned has taken nothing from the socket
+            chunk = await asyncio.wait_for(loop.sock_recv(sock, min(size - len(data), 65536)), timeout)
+        except asyncio.TimeoutError:
+            raise recv_timed_out(data)
+        if not chunk:
+            if not data:
+                return None
+            raise ProtocolError("Connection closed mid-frame")
+        data += chunk
+    return bytes(data)
+
+
+async def recv_frame_async(loop, sock, timeout=None):
+    header = await recv_exact_async(loop, sock, HEADER.size, timeout)
+    if header is None:
+        return None
+    kind, request_id, length = decode_header(header)
+    try:
+        payload = await recv_exact_async(loop, sock, length, timeout) if length else b''
+    except socket.timeout:
+        raise ProtocolError("Timed out mid-frame")
+    if payload is None:
+        raise ProtocolError("Connection closed mid-frame")
+    return kind, request_id, decode_fields(payload)
+
+
+async def send_frame_async(loop, sock, kind, request_id, fields):
+    frame = encode_frame(kind, request_id, fields)
+    await loop.sock_sendall(sock, frame)
+    return len(frame)
+
+
+class ClientConnection:
+    """Multiplexed client side of a framed connection to the marketplace server.
+
+    Any number of threads may call request() at the same time. Each request
+    carries its own id and a reader thread hands every reply to the future
+    waiting on that id, so replies can arrive in any order and a slow catalog
+    download does not hold up chat polling.
+
+    Pushed events go to on_event(name, payload), called on the reader thread.
+    With heartbeat set, a heartbeat request goes out whenever nothing else was
+    sent for that many seconds, keeping the connection inside the server's
+    idle timeout.
+    """
+
+    def __init__(self, sock, timeout=30.0, on_event=None, heartbeat=None):
+        self.sock = sock
+        self.on_event = on_event
+        self.sock.settimeout(None)  # the reader blocks; timeouts are per request
+        self.timeout = timeout
+        self.send_lock = threading.Lock()  # only keeps frames from interleaving
+        self.pending_lock = threading.Lock()
+        self.pending = {}  # request id -> Future
+        self.next_request_id = 0
+        self.closed = False
+        self.busy_reason = None  # set when the server turned the connection away
+        self.last_sent = time.monotonic()
+
+        self.reader = threading.Thread(target=self.read_replies, daemon=True)
+        self.reader.start()
+        if heartbeat:
+            threading.Thread(target=self.send_heartbeats, args=(heartbeat,), daemon=True).start()
+
+    def send_request(self, code, *args):
+        future = Future()
+        with self.pending_lock:
+            if self.closed:
+                if self.busy_reason is not None:
+                    raise ServerBusy(f"Server busy: {self.busy_reason}")
+                raise ConnectionError("Not connected to server")
+            self.next_request_id = self.next_request_id % 0xFFFFFFFF + 1  # 0 is never used
+            future.request_id = self.next_request_id
+            self.pending[future.request_id] = future
+
+        try:
+            with self.send_lock:
+                send_frame(self.sock, KIND_REQUEST, future.request_id, [code, *args])
+                self.last_sent = time.monotonic()
+        except Exception:
+            self.forget(future)
+            raise
+        return future
+
+    def request(self, code, *args, timeout=None):
+        future = self.send_request(code, *args)
+        try:
+            reply = future.result(timeout if timeout is not None else self.timeout)
+        except FutureTimeout:
+            self.forget(future)
+            raise TimeoutError(f"No reply to request '{code}'")
+        if reply and reply[0] == SERVER_BUSY:
+            raise ServerBusy(f"Server busy, request '{code}' was not run")
+        return reply
+
+    def send_heartbeats(self, interval):
+        while not self.closed:
+            time.sleep(min(interval, 5.0))
+            if time.monotonic() - self.last_sent < interval:
+                continue
+            try:
+                self.send_request(HEARTBEAT_CODE)  # the reply is just dropped
+            except Exception:
+                break
+
+    def forget(self, future):
+        with self.pending_lock:
+            self.pending.pop(future.request_id, None)
+
+    def read_replies(self):
+        error = ConnectionError("Server closed the connection")
+        try:
+            while True:
+                frame = recv_frame(self.sock)
+                if frame is None:
+                    break
+                kind, request_id, fields = frame
+                if kind == KIND_RESPONSE:
+                    with self.pending_lock:
+                        future = self.pending.pop(request_id, None)
+                    if future:
+                        future.set_result(fields)
+                elif kind == KIND_EVENT and fields:
+                    if field_text(fields[0]) == BUSY_EVENT:
+                        payload = json.loads(field_text(fields[1])) if len(fields) > 1 else {}
+                        self.busy_reason = payload.get('reason') or "try again later"
+                        error = ServerBusy(f"Server busy: {self.busy_reason}")
+                        continue
+                    self.dispatch_event(fields)
+        except Exception as e:
+            if not self.closed:
+                error = e
+        finally:
+            with self.pending_lock:
+                self.closed = True
+                waiting = list(self.pending.values())
+                self.pending.clear()
+            for future in waiting:
+                future.set_exception(error)
+
+    def dispatch_event(self, fields):
+        handler = self.on_event
+        if handler is None:
+            return
+        name = field_text(fields[0])
+        try:
+            payload = json.loads(field_text(fields[1])) if len(fields) > 1 and fields[1] else {}
+        except ValueError:
+            return
+        try:
+            handler(name, payload)
+        except Exception as e:
+            print(f"Error handling '{name}' event: {e}")
+
+    def close(self):
+        with self.pending_lock:
+            self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
@@ -0,0 +1,161 @@
+import re
+import json
+import time
+import threading
+from collections import deque
+
+# Opt-in slow query log for the server's pooled connections.
+#
+# Every cursor handed out by DatabasePool is a TimedCursor. With a log attached
+# (pool.statement_log) each statement is timed from execute() to its last fetch
+# and reported here when it finishes. Statements over threshold are kept in a
+# ring of recent entries with:
+#
+#   - the SQL as written and its normalized form (literals and IN lists folded)
+#   - the shape of its parameters, never their values (passwords go through here)
+#   - the request code and username being served, set per thread by the server
+#   - the thread, so group-commit batches show up as such
+#
+# Every statement, slow or not, also adds to a per-normalized-statement total,
+# and top() ranks those by total time, so a cheap query run ten thousand times
+# shows up next to a slow one run once. running_now() lists statements that are
+# inside SQLite right now and have been for longer than the threshold: what to
+# look at while the server is stalled rather than after.
+
+MAX_STATEMENTS = 500  # distinct normalized statements tracked; the rest are lumped together
+MAX_NORMALIZED = 2000  # SQL texts whose normalized form is remembered
+OTHER = "(other statements)"
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+PLACEHOLDER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+WHITESPACE = re.compile(r"\s+")
+
+
+def normalize(sql):
+    sql = STRING_LITERAL.sub("?", sql)
+    sql = NUMBER_LITERAL.sub("?", sql)
+    sql = PLACEHOLDER_LIST.sub("(?, ...)", sql)
+    return WHITESPACE.sub(" ", sql).strip()
+
+
+def value_shape(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return f"bytes[{len(value)}]"
+    if isinstance(value, str):
+        return f"str[{len(value)}]"
+    return type(value).__name__
+
+
+def params_shape(params, many=False):
+    # "(str[5], int)", "{name: str[3]}", or "120 x (str[5], int)" for executemany
+    if many:
+        if not isinstance(params, (list, tuple)):
+            return "rows"  # an iterator; counting it would use it up
+        return f"{len(params)} x {params_shape(params[0])}" if params else "0 rows"
+    if params is None:
+        return "()"
+    if isinstance(params, dict):
+        return "{" + ", ".join(f"{key}: {value_shape(value)}" for key, value in params.items()) + "}"
+    return "(" + ", ".join(value_shape(value) for value in params) + ")"
+
+
+class StatementTotals:
+    def __init__(self):
+        self.count = 0
+        self.slow = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.codes = {}  # request code -> count
+
+
+class SlowQueryLog:
+    def __init__(self, threshold=0.05, recent=200, path=None):
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.recent = deque(maxlen=recent)
+        self.statements = {}
+        self.in_flight = {}  # thread id -> (sql, started, thread name)
+        self.normalized = {}  # sql -> normalize(sql); the server runs the same few hundred texts
+        self.context = threading.local()
+        self.out = open(path, 'a', buffering=1) if path else None  # JSON lines, one per slow statement
+
+    def set_context(self, code=None, username=None):
+        # the request the current thread is serving; None clears it
+        self.context.code = code
+        self.context.username = username
+
+    def running(self, sql, started):
+        self.in_flight[threading.get_ident()] = (sql, started, threading.current_thread().name)
+
+    def idle(self):
+        self.in_flight.pop(threading.get_ident(), None)
+
+    def record(self, sql, params, seconds, many=False):
+        code = getattr(self.context, 'code', None)
+        normalized = self.normalized.get(sql)
+        if normalized is None:
+            normalized = normalize(sql)
+            if len(self.normalized) < MAX_NORMALIZED:
+                self.normalized[sql] = normalized
+        slow = seconds >= self.threshold
+        with self.lock:
+            totals = self.statements.get(normalized)
+            if totals is None:
+                if len(self.statements) >= MAX_STATEMENTS:
+                    normalized = OTHER
+                totals = self.statements.setdefault(normalized, StatementTotals())
+            totals.count += 1
+            totals.total += seconds
+            totals.max = max(totals.max, seconds)
+            if code is not None:
+                totals.codes[code] = totals.codes.get(code, 0) + 1
+            if not slow:
+                return
+            totals.slow += 1
+            entry = {
+                'at': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'ms': round(seconds * 1000, 3),
+                'sql': WHITESPACE.sub(" ", sql).strip(),
+                'normalized': normalized,
+                'params': params_shape(params, many),
+                'code': code,
+                'username': getattr(self.context, 'username', None),
+                'thread': threading.current_thread().name,
+            }
+            self.recent.append(entry)
+            if self.out is not None:
+                self.out.write(json.dumps(entry) + "\n")
+
+    def top(self, count=20):
+        with self.lock:
+            ranked = sorted(self.statements.items(), key=lambda item: -item[1].total)[:count]
+            return [{
+                'normalized': normalized,
+                'count': totals.count,
+                'slow': totals.slow,
+                'total_ms': round(totals.total * 1000, 3),
+                'avg_ms': round(totals.total / totals.count * 1000, 3),
+                'max_ms': round(totals.max * 1000, 3),
+                'codes': dict(sorted(totals.codes.items(), key=lambda item: -item[1])[:5]),
+            } for normalized, totals in ranked]
+
+    def running_now(self):
+        now = time.perf_counter()
+        return [{'sql': WHITESPACE.sub(" ", sql).strip(), 'ms': round((now - started) * 1000, 3), 'thread': name}
+                for sql, started, name in list(self.in_flight.values()) if now - started >= self.threshold]
+
+    def report(self, top=20, recent=50):
+        with self.lock:
+            latest = list(self.recent)[-recent:]
+        return {
+            'threshold_ms': self.threshold * 1000,
+            'running': self.running_now(),
+            'recent': latest[::-1],  # newest first
+            'top': self.top(top),
+        }
+
+    def close(self):
+        if self.out is not None:
+            self.out.close()
+            self.out = None
@@ -0,0 +1,152 @@
+import sqlite3
+import argparse
+
+# Rating aggregates kept up to date by the database.
+#
+# Ratings are still recorded one row each (product_ratings, buyer_ratings), but
+# reads never average those rows. Triggers on the rating tables add every new
+# rating to a running sum and count in the same transaction as the insert:
+#
+#   product_rating_totals: per (product, seller); productList.rating and
+#                          numberOfRating are refreshed from it, so catalog
+#                          queries keep reading the columns they always have
+#   user_rating_totals:    per user, case-insensitive; the profile average
+#
+# Each update is a single UPSERT statement, so two ratings for the same product
+# can never overwrite each other the way a read-modify-write in Python could.
+#
+# A product's totals cover its current listing only. Deleting a listing drops
+# its totals and marks its rating rows retired, and a rating for a listing that
+# does not exist is retired as it arrives, so rebuild() (which totals the rows
+# that are not retired) always agrees with the triggers.
+#
+# Run as a script to recompute the aggregates from the rating rows:
+#   python RatingStore.py rebuild marketplace.db
+
+
+def create_schema(cursor):
+    # returns True when the aggregate tables were new and have been filled
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'user_rating_totals'")
+    is_new = cursor.fetchone() is None
+
+    cursor.execute("""CREATE TABLE IF NOT EXISTS product_rating_totals (
+        product_name TEXT NOT NULL,
+        seller TEXT NOT NULL,
+        rating_sum INTEGER NOT NULL,
+        rating_count INTEGER NOT NULL,
+        PRIMARY KEY (product_name, seller)
+    )""")
+    cursor.execute("""CREATE TABLE IF NOT EXISTS user_rating_totals (
+        username TEXT PRIMARY KEY COLLATE NOCASE,
+        rating_sum INTEGER NOT NULL,
+        rating_count INTEGER NOT NULL
+    )""")
+
+    cursor.execute("SELECT 1 FROM pragma_table_info('product_ratings') WHERE name = 'retired'")
+    if cursor.fetchone() is None:
+        # ratings already in the table count if their product is still listed
+        cursor.execute("ALTER TABLE product_ratings ADD COLUMN retired INTEGER NOT NULL DEFAULT 0")
+        cursor.execute("""UPDATE product_ratings SET retired = 1
+                         WHERE NOT EXISTS (SELECT 1 FROM productList WHERE product_name = product_ratings.product_name
+                                                                      AND user_name = product_ratings.seller)""")
+    cursor.execute("""CREATE INDEX IF NOT EXISTS idx_product_ratings_listing
+                     ON product_ratings (product_name, seller) WHERE retired = 0""")
+
+    # recreated on every start: older databases have versions without the listing checks
+    cursor.execute("DROP TRIGGER IF EXISTS product_rating_total")
+    cursor.execute("""CREATE TRIGGER product_rating_total AFTER INSERT ON product_ratings
+        WHEN EXISTS (SELECT 1 FROM productList WHERE product_name = new.product_name AND user_name = new.seller)
+        BEGIN
+        INSERT INTO product_rating_totals (product_name, seller, rating_sum, rating_count)
+            VALUES (new.product_name, new.seller, new.rating, 1)
+            ON CONFLICT (product_name, seller) DO UPDATE
+            SET rating_sum = rating_sum + excluded.rating_sum, rating_count = rating_count + 1;
+        UPDATE productList SET
+            rating = (SELECT CAST(rating_sum AS REAL) / rating_count FROM product_rating_totals
+                      WHERE product_name = new.product_name AND seller = new.seller),
+            numberOfRating = (SELECT rating_count FROM product_rating_totals
+                              WHERE product_name = new.product_name AND seller = new.seller)
+            WHERE product_name = new.product_name AND user_name = new.seller;
+    END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS user_rating_total AFTER INSERT ON buyer_ratings BEGIN
+        INSERT INTO user_rating_totals (username, rating_sum, rating_count)
+            VALUES (new.buyer, new.rating, 1)
+            ON CONFLICT (username) DO UPDATE
+            SET rating_sum = rating_sum + excluded.rating_sum, rating_count = rating_count + 1;
+    END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS product_rating_unlisted AFTER INSERT ON product_ratings
+        WHEN NOT EXISTS (SELECT 1 FROM productList WHERE product_name = new.product_name AND user_name = new.seller)
+        BEGIN
+        UPDATE product_ratings SET retired = 1 WHERE id = new.id;
+    END""")
+    # a product listed again under the same name starts unrated, as it always has
+    cursor.execute("DROP TRIGGER IF EXISTS product_rating_total_delete")
+    cursor.execute("""CREATE TRIGGER product_rating_total_delete AFTER DELETE ON productList BEGIN
+        DELETE FROM product_rating_totals WHERE product_name = old.product_name AND seller = old.user_name;
+        UPDATE product_ratings SET retired = 1
+            WHERE product_name = old.product_name AND seller = old.user_name AND retired = 0;
+    END""")
+
+    if is_new:
+        rebuild(cursor)
+    return is_new
+
+
+def rebuild(cursor):
+    # recomputes every aggregate from the rating rows the triggers count (those
+    # of current listings, i.e. not retired); returns (products, users) rated
+    cursor.execute("DELETE FROM product_rating_totals")
+    cursor.execute("""INSERT INTO product_rating_totals (product_name, seller, rating_sum, rating_count)
+                     SELECT product_ratings.product_name, seller, SUM(product_ratings.rating), COUNT(*)
+                     FROM product_ratings
+                     JOIN productList ON productList.product_name = product_ratings.product_name
+                                     AND productList.user_name = product_ratings.seller
+                     WHERE retired = 0
+                     GROUP BY product_ratings.product_name, seller""")
+    products = cursor.rowcount
+    cursor.execute("""UPDATE productList SET
+                     rating = (SELECT CAST(rating_sum AS REAL) / rating_count FROM product_rating_totals
+                               WHERE product_name = productList.product_name AND seller = productList.user_name),
+                     numberOfRating = (SELECT rating_count FROM product_rating_totals
+                                       WHERE product_name = productList.product_name AND seller = productList.user_name)
+                     WHERE EXISTS (SELECT 1 FROM product_rating_totals
+                                   WHERE product_name = productList.product_name AND seller = productList.user_name)""")
+    cursor.execute("""UPDATE productList SET rating = 0, numberOfRating = 0
+                     WHERE numberOfRating != 0 AND NOT EXISTS (SELECT 1 FROM product_rating_totals
+                         WHERE product_name = productList.product_name AND seller = productList.user_name)""")
+
+    cursor.execute("DELETE FROM user_rating_totals")
+    cursor.execute("""INSERT INTO user_rating_totals (username, rating_sum, rating_count)
+                     SELECT buyer, SUM(rating), COUNT(*) FROM buyer_ratings
+                     GROUP BY buyer COLLATE NOCASE""")
+    users = cursor.rowcount
+    return products, users
+
+
+def user_rating(cursor, username):
+    # average of every rating the user received, 0.0 if never rated
+    cursor.execute("""SELECT CAST(rating_sum AS REAL) / rating_count FROM user_rating_totals
+                     WHERE username = ?""", (username,))
+    row = cursor.fetchone()
+    return row[0] if row and row[0] else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Marketplace rating aggregates maintenance")
+    parser.add_argument('command', choices=['rebuild'],
+                        help="rebuild: recompute product and user rating totals from the rating rows")
+    parser.add_argument('database', nargs='?', default='marketplace.db')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.database)
+    cursor = conn.cursor()
+    create_schema(cursor)
+    products, users = rebuild(cursor)
+    conn.commit()
+    print(f"Rebuilt rating totals for {products} product(s) and {users} user(s)")
+    cursor.close()
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
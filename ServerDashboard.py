@@ -0,0 +1,157 @@
+import tkinter as tk
+from tkinter import ttk
+
+# Live dashboard for the server (python ServerGUI.py --dashboard).
+#
+# The window only reads the server's MetricsHistory ring (Metrics.py), which a
+# sampler thread fills once a second; nothing here touches the request path or
+# the database, so an open dashboard costs the server one sample per second.
+# Closing the window stops the server.
+
+REFRESH_MS = 1000
+GRAPH_SAMPLES = 120  # two minutes at one sample a second
+RATE_WINDOW = 10  # samples averaged for the per-command table
+
+TILES = (
+    ('connections', "Connections"),
+    ('online', "Online users"),
+    ('active_chats', "Open chats"),
+    ('requests_per_second', "Requests/s"),
+    ('avg_ms', "Avg latency (ms)"),
+    ('db_ms', "SQLite per request (ms)"),
+    ('pending_requests', "Queued requests"),
+    ('threads', "Threads"),
+    ('rss_mb', "Memory (MiB)"),
+    ('catalog', "Catalog"),
+)
+
+
+class ServerDashboard:
+    def __init__(self, root, history):
+        self.root = root
+        self.history = history
+
+        self.bg_dark = "#1a1a2e"  # same palette as MarketplaceGUI
+        self.card_bg = "#16213e"
+        self.accent = "#e94560"
+        self.text_light = "#ffffff"
+        self.text_secondary = "#b8b8b8"
+        self.db_color = "#4fc3f7"
+
+        self.root.title("Marketplace Server")
+        self.root.geometry("1000x700")
+        self.root.configure(bg=self.bg_dark)
+
+        style = ttk.Style()
+        style.theme_use('clam')
+        style.configure('TFrame', background=self.bg_dark)
+        style.configure('TLabel', font=('Segoe UI', 10), background=self.bg_dark, foreground=self.text_light)
+        style.configure('Treeview', background=self.card_bg, fieldbackground=self.card_bg,
+                        foreground=self.text_light, rowheight=22)
+        style.configure('Treeview.Heading', background=self.bg_dark, foreground=self.text_light)
+
+        self.values = {}
+        tiles = ttk.Frame(self.root, padding=10)
+        tiles.pack(fill=tk.X)
+        for index, (key, title) in enumerate(TILES):
+            tile = tk.Frame(tiles, bg=self.card_bg, padx=12, pady=8)
+            tile.grid(row=index // 5, column=index % 5, padx=5, pady=5, sticky="nsew")
+            tiles.columnconfigure(index % 5, weight=1)
+            tk.Label(tile, text=title, bg=self.card_bg, fg=self.text_secondary, font=('Segoe UI', 9)).pack(anchor="w")
+            self.values[key] = tk.Label(tile, text="-", bg=self.card_bg, fg=self.text_light,
+                                        font=('Segoe UI', 16, 'bold'))
+            self.values[key].pack(anchor="w")
+
+        ttk.Label(self.root, text="Requests/s (red) and SQLite ms per request (blue), last two minutes",
+                  foreground=self.text_secondary, padding=(15, 0)).pack(anchor="w")
+        self.graph = tk.Canvas(self.root, height=150, bg=self.card_bg, highlightthickness=0)
+        self.graph.pack(fill=tk.X, padx=15, pady=5)
+
+        lower = ttk.Frame(self.root, padding=10)
+        lower.pack(fill=tk.BOTH, expand=True)
+        lower.columnconfigure(0, weight=3)
+        lower.columnconfigure(1, weight=1)
+        lower.rowconfigure(1, weight=1)
+
+        ttk.Label(lower, text="Requests by command").grid(row=0, column=0, sticky="w")
+        self.commands = ttk.Treeview(lower, columns=('code', 'rate', 'latency'), show='headings')
+        for column, heading, width in (('code', "Command", 120), ('rate', "Requests/s", 120),
+                                       ('latency', "Avg ms", 120)):
+            self.commands.heading(column, text=heading)
+            self.commands.column(column, width=width, anchor="e" if column != 'code' else "w")
+        self.commands.grid(row=1, column=0, sticky="nsew", padx=(0, 10))
+
+        ttk.Label(lower, text="Online users").grid(row=0, column=1, sticky="w")
+        self.users = tk.Listbox(lower, bg=self.card_bg, fg=self.text_light, borderwidth=0,
+                                highlightthickness=0, font=('Segoe UI', 10))
+        self.users.grid(row=1, column=1, sticky="nsew")
+
+        self.refresh()
+
+    def refresh(self):
+        samples = self.history.latest(GRAPH_SAMPLES)
+        if samples:
+            self.show_tiles(samples[-1])
+            self.show_commands(samples[-RATE_WINDOW:])
+            self.show_users(samples[-1].get('online_users', []))
+            self.draw_graph(samples)
+        self.root.after(REFRESH_MS, self.refresh)
+
+    def show_tiles(self, sample):
+        for key, label in self.values.items():
+            value = sample.get(key)
+            if key == 'catalog':
+                products, size_kb = sample.get('catalog_products'), sample.get('catalog_kb')
+                text = "-" if products is None else f"{products} ({size_kb:.0f} KiB)"
+            elif value is None:
+                text = "-"
+            elif isinstance(value, float):
+                text = f"{value:.1f}" if value >= 10 else f"{value:.2f}"
+            else:
+                text = str(value)
+            label.config(text=text)
+
+    def show_commands(self, samples):
+        # rates averaged over the window; a code missing from a sample had no requests in it
+        totals = {}
+        for sample in samples:
+            for code, rate in sample['rates'].items():
+                count, busy = totals.get(code, (0.0, 0.0))
+                totals[code] = (count + rate['per_second'], busy + rate['per_second'] * rate['avg_ms'])
+        rows = sorted(totals.items(), key=lambda item: -item[1][0])
+        self.commands.delete(*self.commands.get_children())
+        for code, (rate_sum, busy) in rows:
+            self.commands.insert('', tk.END, values=(code, f"{rate_sum / len(samples):.2f}",
+                                                     f"{busy / rate_sum:.2f}" if rate_sum else "-"))
+
+    def show_users(self, usernames):
+        if list(self.users.get(0, tk.END)) != usernames:
+            self.users.delete(0, tk.END)
+            for username in usernames:
+                self.users.insert(tk.END, username)
+
+    def draw_graph(self, samples):
+        self.graph.delete('all')
+        width = self.graph.winfo_width()
+        height = int(self.graph['height'])
+        if width < 10 or len(samples) < 2:
+            return
+        step = width / (GRAPH_SAMPLES - 1)
+        offset = width - step * (len(samples) - 1)  # newest sample at the right edge
+        for key, color in (('requests_per_second', self.accent), ('db_ms', self.db_color)):
+            values = [sample.get(key) or 0.0 for sample in samples]
+            top = max(values) or 1.0
+            points = []
+            for index, value in enumerate(values):
+                points += [offset + index * step, height - 10 - (height - 20) * value / top]
+            self.graph.create_line(*points, fill=color, width=2)
+            self.graph.create_text(8 if color == self.accent else width - 8, 10, fill=color,
+                                   anchor="nw" if color == self.accent else "ne",
+                                   text=f"max {top:.1f}", font=('Segoe UI', 8))
+
+
+def open_dashboard(history):
+    # raises tk.TclError when there is no display to open the window on
+    root = tk.Tk()
+    ServerDashboard(root, history)
+    return root
@@ -3,6 +3,27 @@ import threading
 import json
 import sqlite3
 import base64
+import asyncio
+import argparse
+import re
+import time
+import zlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from DatabasePool import DatabasePool, STORAGE_PROFILES
+from GroupCommit import GroupCommitWriter
+from ImageStore import (create_schema as create_image_schema, put_image, encoded_image, source_hash,
+                        migrate_blobs, backfill_thumbnails)
+from RatingStore import create_schema as create_rating_schema, user_rating
+import Inventory
+from Admission import AdmissionControl
+from Metrics import RequestMetrics, MetricsHistory
+from QueryLog import SlowQueryLog
+from Protocol import (KIND_RESPONSE, KIND_EVENT, EVENT_REQUEST_ID, SERVER_BUSY, BUSY_EVENT, HEARTBEAT_CODE,
+                      MAX_PAYLOAD, ProtocolError, field_text, frame_size, recv_frame, send_frame, recv_frame_async,
+                      send_frame_async)
+
+SNIPPET_LENGTH = 80  # characters of the last message kept per conversation
 
 conn = sqlite3.connect('marketplace.db')
 cursor = conn.cursor()
@@ -88,6 +109,154 @@ cursor.execute("""CREATE TABLE IF NOT EXISTS buyer_ratings (
     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
 )""")
 
+# Migration: images moved out of productList/infoList into the content-addressed images table
+create_image_schema(cursor)
+moved_images = migrate_blobs(cursor)
+if moved_images:
+    # not a bare VACUUM: it can renumber the productList rowids product_search is keyed on
+    print(f"Moved {moved_images} image(s) into the image store - run python ImageStore.py vacuum "
+          f"with the server stopped to reclaim the space (it rebuilds the search index too)")
+rendered_thumbnails = backfill_thumbnails(cursor)
+if rendered_thumbnails:
+    print(f"Rendered {rendered_thumbnails} missing thumbnail(s)")
+
+# Indexes for the hot lookups; run python ServerGUI.py --check-indexes to see the plans
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_unread ON chat_messages (receiver, is_read, sender, timestamp)")
+# history pages walk one direction of a conversation in id order
+cursor.execute("DROP INDEX IF EXISTS idx_chat_pair")
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_pair_id ON chat_messages (sender, receiver, id)")
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_buyer ON transactions (buyer, seller, created_at)")
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_seller ON transactions (seller, created_at)")
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_buyers_purchase ON buyers (buyer_username, product_name, seller_username)")
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_buyers_seller ON buyers (seller_username)")
+# the in-stock catalog is a full read: a quantity index only adds a lookup per row
+cursor.execute("DROP INDEX IF EXISTS idx_products_quantity")
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_seller ON productList (user_name COLLATE NOCASE, quantity)")
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_buyer_ratings_buyer ON buyer_ratings (buyer COLLATE NOCASE, rating)")
+
+# Full-text product search. product_search mirrors productList (external
+# content, keyed by rowid) and the triggers keep it in sync for every writer.
+# Builds without FTS5 fall back to LIKE in search_products().
+try:
+    cursor.execute("SELECT 1 FROM product_search LIMIT 1")
+    search_index_exists = True
+except sqlite3.OperationalError:
+    search_index_exists = False
+try:
+    cursor.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS product_search USING fts5(
+        product_name, description, user_name,
+        content='productList', content_rowid='rowid'
+    )""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS product_search_insert AFTER INSERT ON productList BEGIN
+        INSERT INTO product_search (rowid, product_name, description, user_name)
+        VALUES (new.rowid, new.product_name, new.description, new.user_name);
+    END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS product_search_delete AFTER DELETE ON productList BEGIN
+        INSERT INTO product_search (product_search, rowid, product_name, description, user_name)
+        VALUES ('delete', old.rowid, old.product_name, old.description, old.user_name);
+    END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS product_search_update
+        AFTER UPDATE OF product_name, description, user_name ON productList BEGIN
+        INSERT INTO product_search (product_search, rowid, product_name, description, user_name)
+        VALUES ('delete', old.rowid, old.product_name, old.description, old.user_name);
+        INSERT INTO product_search (rowid, product_name, description, user_name)
+        VALUES (new.rowid, new.product_name, new.description, new.user_name);
+    END""")
+    if not search_index_exists:
+        cursor.execute("INSERT INTO product_search (product_search) VALUES ('rebuild')")
+    FULL_TEXT_SEARCH = True
+except sqlite3.OperationalError as e:
+    print(f"FTS5 not available ({e}) - product search falls back to LIKE")
+    FULL_TEXT_SEARCH = False
+
+# Catalog change log: every product write bumps the catalog version (the
+# AUTOINCREMENT id), so clients holding version N can fetch just the products
+# changed after it. Only the newest 10000 changes are kept; a client further
+# behind than that is told to resync.
+cursor.execute("""CREATE TABLE IF NOT EXISTS catalog_changes (
+    version INTEGER PRIMARY KEY AUTOINCREMENT,
+    product_name TEXT NOT NULL,
+    user_name TEXT NOT NULL,
+    op TEXT NOT NULL  -- 'upsert', 'delete' or 'stock'
+)""")
+cursor.execute("""CREATE TRIGGER IF NOT EXISTS catalog_change_insert AFTER INSERT ON productList BEGIN
+    INSERT INTO catalog_changes (product_name, user_name, op) VALUES (new.product_name, new.user_name, 'upsert');
+END""")
+cursor.execute("""CREATE TRIGGER IF NOT EXISTS catalog_change_delete AFTER DELETE ON productList BEGIN
+    INSERT INTO catalog_changes (product_name, user_name, op) VALUES (old.product_name, old.user_name, 'delete');
+END""")
+cursor.execute("""CREATE TRIGGER IF NOT EXISTS catalog_change_update AFTER UPDATE ON productList
+    WHEN old.price IS NOT new.price OR old.description IS NOT new.description
+      OR old.image_hash IS NOT new.image_hash OR old.rating IS NOT new.rating BEGIN
+    INSERT INTO catalog_changes (product_name, user_name, op) VALUES (new.product_name, new.user_name, 'upsert');
+END""")
+cursor.execute("""CREATE TRIGGER IF NOT EXISTS catalog_change_stock AFTER UPDATE OF quantity ON productList
+    WHEN old.quantity IS NOT new.quantity
+     AND old.price IS new.price AND old.description IS new.description
+     AND old.image_hash IS new.image_hash AND old.rating IS new.rating BEGIN
+    INSERT INTO catalog_changes (product_name, user_name, op) VALUES (new.product_name, new.user_name, 'stock');
+END""")
+cursor.execute("""CREATE TRIGGER IF NOT EXISTS catalog_changes_trim AFTER INSERT ON catalog_changes BEGIN
+    DELETE FROM catalog_changes WHERE version <= new.version - 10000;
+END""")
+
+# One row per (user, chat partner) for the Messages screen: the latest message
+# and how many from the partner are unread. The triggers keep it current for
+# every insert and read receipt, so the screen never scans chat_messages.
+cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'conversations'")
+conversations_are_new = cursor.fetchone() is None
+cursor.execute("""CREATE TABLE IF NOT EXISTS conversations (
+    username TEXT NOT NULL,
+    partner TEXT NOT NULL,
+    last_message_id INTEGER NOT NULL,
+    last_sender TEXT NOT NULL,
+    snippet TEXT NOT NULL,
+    last_timestamp DATETIME,
+    unread INTEGER NOT NULL DEFAULT 0,  -- messages from partner to username still unread
+    PRIMARY KEY (username, partner)
+)""")
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversations_recent ON conversations (username, last_message_id)")
+cursor.execute(f"""CREATE TRIGGER IF NOT EXISTS conversation_message AFTER INSERT ON chat_messages BEGIN
+    INSERT INTO conversations (username, partner, last_message_id, last_sender, snippet, last_timestamp)
+        VALUES (new.sender, new.receiver, new.id, new.sender, substr(new.message, 1, {SNIPPET_LENGTH}), new.timestamp)
+        ON CONFLICT (username, partner) DO UPDATE SET last_message_id = excluded.last_message_id,
+            last_sender = excluded.last_sender, snippet = excluded.snippet, last_timestamp = excluded.last_timestamp;
+    INSERT INTO conversations (username, partner, last_message_id, last_sender, snippet, last_timestamp, unread)
+        VALUES (new.receiver, new.sender, new.id, new.sender, substr(new.message, 1, {SNIPPET_LENGTH}), new.timestamp,
+                new.is_read = 0)
+        ON CONFLICT (username, partner) DO UPDATE SET last_message_id = excluded.last_message_id,
+            last_sender = excluded.last_sender, snippet = excluded.snippet, last_timestamp = excluded.last_timestamp,
+            unread = unread + excluded.unread;
+END""")
+cursor.execute("""CREATE TRIGGER IF NOT EXISTS conversation_read AFTER UPDATE OF is_read ON chat_messages
+    WHEN old.is_read = 0 AND new.is_read = 1 BEGIN
+    UPDATE conversations SET unread = unread - 1 WHERE username = new.receiver AND partner = new.sender;
+END""")
+if conversations_are_new:
+    cursor.execute(f"""INSERT INTO conversations (username, partner, last_message_id, last_sender, snippet,
+                                                  last_timestamp, unread)
+                      SELECT username, partner, MAX(id), sender, substr(message, 1, {SNIPPET_LENGTH}), timestamp,
+                             SUM(unread)
+                      FROM (SELECT sender AS username, receiver AS partner, id, sender, message, timestamp,
+                                   0 AS unread FROM chat_messages
+                            UNION ALL
+                            SELECT receiver, sender, id, sender, message, timestamp, is_read = 0 FROM chat_messages)
+                      GROUP BY username, partner""")
+
+# Stock held for approved purchase proposals (Inventory.py)
+Inventory.create_schema(cursor)
+
+# Rating aggregates, maintained by triggers on the rating tables (RatingStore.py)
+if create_rating_schema(cursor):
+    print("Computed rating totals from existing ratings")
+
+# Migration: case-insensitive username key (lookups use "username = ? COLLATE NOCASE")
+try:
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_info_username_nocase ON infoList (username COLLATE NOCASE)")
+except sqlite3.IntegrityError:
+    print("Usernames differing only in case exist - creating a non-unique username index")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_info_username_nocase ON infoList (username COLLATE NOCASE)")
+
 conn.commit()
 cursor.close()
 conn.close()
@@ -95,24 +264,160 @@ conn.close()
 online_users = {}
 active_chats = {}
 
+LOGOUT_CODE = "9"
+SUBSCRIBE_CODE = "33"
+
+reservation_ttl = 48 * 3600  # seconds an approved proposal holds its stock; --reservation-hours
+
+CHAT_PAGE_SIZE = 50
+MAX_CHAT_PAGE_SIZE = 200
+MAX_MESSAGE_ID = (1 << 63) - 1
+
+CATALOG_PAGE_SIZE = 24
+MAX_CATALOG_PAGE_SIZE = 100
+
+# The whole catalog serialized once per catalog version and shared by every
+# full-catalog request (1 and 38). ETags carry the server start time as well,
+# since thumbnails backfilled before the change log exists change the cards
+# without a new version; later backfills log the products they touch.
+#
+# Snapshot rows name each card image by hash instead of carrying it, so the
+# snapshot grows by a row per product rather than an image per product, and
+# clients fetch the images they do not already hold with command 44. Only the
+# compressed body is kept; command 1's by-seller layout, which still inlines
+# images for older clients, is built the first time it is asked for.
+CATALOG_EPOCH = format(int(time.time()), 'x')
+NOT_MODIFIED = b'3'
+TOO_LARGE = b'2'  # the snapshot would not fit in a frame: page the catalog with 35 instead
+MAX_SNAPSHOT_BYTES = MAX_PAYLOAD - 1024 * 1024  # leaves room for the reply's other fields
+MAX_IMAGES_PER_REQUEST = 200  # command 44
+IMAGE_REPLY_BYTES = 4 * 1024 * 1024  # base64 per command 44 reply; the client asks again for the rest
+catalog_snapshot = None
+catalog_snapshot_lock = threading.Lock()
+
+db_pool = None  # opened in main(); helpers used without main() get a default pool
+
+# readers beyond one per request worker, for the threads outside the worker
+# pool that read: the reservation sweep looks up each transaction it pushes,
+# and in threaded mode logins and logouts run on the connection's own thread
+BACKGROUND_READERS = 4
+
+def get_pool():
+    global db_pool
+    if db_pool is None:
+        db_pool = DatabasePool('marketplace.db')
+    return db_pool
+
 def get_connection():
-    # new connection each time - SQLite isn't thread-safe with shared connections
-    connection = sqlite3.connect('marketplace.db')
-    return connection
+    # the pooled writer connection; close() hands it back. Writes are
+    # serialized, so keep the work between here and close() short
+    return get_pool().write()
+
+def get_read_connection():
+    # a pooled reader for helpers that only SELECT
+    return get_pool().reader()
+
+chat_writer = None  # started in main(), like db_pool
+
+admission = AdmissionControl()  # unlimited until main() applies the configured limits
+request_metrics = RequestMetrics()  # per request code; Metrics.py
+metrics_history = MetricsHistory()  # sampled once a second for --dashboard
+query_log = None  # SlowQueryLog when --slow-query-ms is given (QueryLog.py)
+slow_query_top = 20
+
+def get_chat_writer():
+    # group-commits chat inserts and read receipts (GroupCommit.py); callers
+    # must not hold the writer connection while they wait on it
+    global chat_writer
+    if chat_writer is None:
+        chat_writer = GroupCommitWriter(get_pool())
+    return chat_writer
+
+# The lookups behind logins, polls, chat and the catalog. check_query_plans()
+# runs EXPLAIN QUERY PLAN on each and flags any that would scan a table, apart
+# from FULL_READS, which read (nearly) every row anyway.
+HOT_QUERIES = {
+    'user_exists': ("SELECT * FROM infoList WHERE username = ? COLLATE NOCASE", ('a',)),
+    'verify_password': ("SELECT password FROM infoList WHERE username = ? COLLATE NOCASE", ('a',)),
+    'get_user_profile': ("""SELECT real_name, COALESCE(thumbnails.thumb_hash, picture_hash), bio FROM infoList
+                            LEFT JOIN thumbnails ON thumbnails.hash = picture_hash AND thumbnails.size = 'avatar'
+                            WHERE username = ? COLLATE NOCASE""", ('a',)),
+    'get_user_profile ratings': ("""SELECT CAST(rating_sum AS REAL) / rating_count FROM user_rating_totals
+                                    WHERE username = ?""", ('a',)),
+    'get_user_profile products': ("""SELECT product_name, price, rating, numberOfRating, quantity FROM productList
+                                     WHERE user_name = ? COLLATE NOCASE AND quantity > 0""", ('a',)),
+    'build_catalog_snapshot': ("""SELECT product_name, user_name, rating, price, COALESCE(thumbnails.thumb_hash, image_hash)
+                                  FROM productList
+                                  LEFT JOIN thumbnails ON thumbnails.hash = image_hash AND thumbnails.size = 'card'
+                                  WHERE quantity > 0""", ()),
+    'get_product_page': ("""SELECT product_name, user_name, rating, price, COALESCE(thumbnails.thumb_hash, image_hash)
+                            FROM productList
+                            LEFT JOIN thumbnails ON thumbnails.hash = image_hash AND thumbnails.size = 'card'
+                            WHERE quantity > 0 AND (product_name, user_name) > (?, ?)
+                            ORDER BY product_name, user_name LIMIT ?""", ('a', 'b', 25)),
+    'get_catalog_changes': ("""SELECT catalog_changes.product_name, catalog_changes.user_name, MAX(version), quantity
+                               FROM catalog_changes
+                               LEFT JOIN productList ON productList.product_name = catalog_changes.product_name
+                                                    AND productList.user_name = catalog_changes.user_name
+                               WHERE version > ? AND version <= ?
+                               GROUP BY catalog_changes.product_name, catalog_changes.user_name""", (1, 2)),
+    'get_seller_products': ("""SELECT product_name, rating, price, COALESCE(thumbnails.thumb_hash, image_hash), quantity
+                               FROM productList
+                               LEFT JOIN thumbnails ON thumbnails.hash = image_hash AND thumbnails.size = 'card'
+                               WHERE user_name = ? COLLATE NOCASE AND user_name = ?""", ('a', 'a')),
+    'command 5 (unread)': ("SELECT id, sender, message, timestamp FROM chat_messages WHERE receiver = ? AND is_read = 0 ORDER BY timestamp", ('a',)),
+    'command 21 (new from user)': ("""SELECT sender, message, timestamp FROM chat_messages
+                                      WHERE sender = ? AND receiver = ? AND is_read = 0 ORDER BY timestamp ASC""", ('a', 'b')),
+    'read_unread_counts': ("SELECT partner, unread FROM conversations WHERE username = ? AND unread > 0", ('a',)),
+    'get_chat_page (older)': ("""SELECT id, sender, message, timestamp FROM chat_messages
+                                 WHERE sender = ? AND receiver = ? AND id < ?
+                                 UNION ALL
+                                 SELECT id, sender, message, timestamp FROM chat_messages
+                                 WHERE sender = ? AND receiver = ? AND id < ?
+                                 ORDER BY id DESC LIMIT ?""", ('a', 'b', 10, 'b', 'a', 10, 51)),
+    'get_chat_page (newer)': ("""SELECT id, sender, message, timestamp FROM chat_messages
+                                 WHERE sender = ? AND receiver = ? AND id > ?
+                                 UNION ALL
+                                 SELECT id, sender, message, timestamp FROM chat_messages
+                                 WHERE sender = ? AND receiver = ? AND id > ?
+                                 ORDER BY id ASC LIMIT ?""", ('a', 'b', 10, 'b', 'a', 10, 51)),
+    'get_conversation_summaries': ("""SELECT partner, last_message_id, last_sender, snippet, last_timestamp, unread
+                                      FROM conversations WHERE username = ?
+                                      ORDER BY last_message_id DESC""", ('a',)),
+    'get_user_transactions': ("""SELECT id, buyer, seller, product, date, quantity, status FROM transactions
+                                 WHERE buyer = ? OR seller = ? ORDER BY created_at DESC""", ('a', 'a')),
+    'get_user_transactions with user': ("""SELECT id, buyer, seller, product, date, quantity, status FROM transactions
+                                           WHERE (buyer = ? AND seller = ?) OR (buyer = ? AND seller = ?)
+                                           ORDER BY created_at DESC""", ('a', 'b', 'b', 'a')),
+    'check_already_purchased': ("""SELECT COUNT(*) FROM buyers
+                                   WHERE buyer_username = ? AND product_name = ? AND seller_username = ?""", ('a', 'p', 'b')),
+    'get_user_purchase_history': ("SELECT product_name, buyer_username FROM buyers WHERE seller_username = ?", ('a',)),
+}
+
+FULL_READS = {'build_catalog_snapshot'}
+
+def check_query_plans(connection):
+    # returns [(name, plan lines, ok)]; a plan step starting with SCAN reads a whole table or index
+    results = []
+    for name, (query, params) in HOT_QUERIES.items():
+        plan = [row[3] for row in connection.execute(f"EXPLAIN QUERY PLAN {query}", params)]
+        ok = name in FULL_READS or not any(step.startswith('SCAN ') for step in plan)
+        results.append((name, plan, ok))
+    return results
 
 def user_exists(username):
-    conn = get_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT * FROM infoList WHERE LOWER(username) = LOWER(?)", (username,))
+    cursor.execute("SELECT * FROM infoList WHERE username = ? COLLATE NOCASE", (username,))
     user_record = cursor.fetchone()
     cursor.close()
     conn.close()
     return user_record is not None
 
 def verify_password(username, password):
-    conn = get_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT password FROM infoList WHERE LOWER(username) = LOWER(?)", (username,))
+    cursor.execute("SELECT password FROM infoList WHERE username = ? COLLATE NOCASE", (username,))
     result = cursor.fetchone()
     cursor.close()
     conn.close()
@@ -133,31 +438,273 @@ def create_user(username, password, real_name):
         conn.close()
         return False
 
-def get_all_products():
-    conn = get_connection()
+def build_catalog_snapshot(cursor, version):
+    # rows are catalog page tuples with the card image's hash in place of the image
+    cursor.execute("""SELECT product_name, user_name, rating, price, COALESCE(thumbnails.thumb_hash, image_hash)
+                     FROM productList
+                     LEFT JOIN thumbnails ON thumbnails.hash = image_hash AND thumbnails.size = 'card'
+                     WHERE quantity > 0""")
+    rows = sorted(cursor.fetchall(), key=lambda row: (row[0], row[1]))  # page order, without scanning in key order
+    body = json.dumps(rows).encode('utf-8')
+    return {
+        'version': version,
+        'etag': f"{CATALOG_EPOCH}.{version}",
+        'compressed': zlib.compress(body, 6),
+        'size': len(body),  # uncompressed, for clients that do not take zlib
+        'by_seller': None,  # command 1's layout, see get_catalog_by_seller()
+        'products': len(rows),
+    }
+
+def build_catalog_by_seller(snapshot):
+    # command 1's {seller: [(product_name, rating, price, image base64)]}. Its
+    # clients only know inline images, so they get them until the reply would
+    # outgrow MAX_SNAPSHOT_BYTES; products past that are sent without one
+    conn = get_read_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT product_name, user_name, rating, price, image FROM productList WHERE quantity > 0")
-    products = cursor.fetchall()
+    by_seller = {}
+    size = 0
+    for product_name, user_name, rating, price, image_hash in json.loads(zlib.decompress(snapshot['compressed'])):
+        image_b64 = encoded_image(cursor, image_hash)
+        size += len(product_name) + len(user_name) + 64
+        if image_b64 is not None:
+            if size + len(image_b64) > MAX_SNAPSHOT_BYTES:
+                image_b64 = None
+            else:
+                size += len(image_b64)
+        by_seller.setdefault(user_name, []).append((product_name, rating, price, image_b64))
+    cursor.close()
+    conn.close()
+    return json.dumps(by_seller).encode('utf-8')
+
+def get_catalog_by_seller():
+    snapshot = get_catalog_snapshot()
+    with catalog_snapshot_lock:
+        if snapshot['by_seller'] is None:
+            snapshot['by_seller'] = build_catalog_by_seller(snapshot)
+        return snapshot['by_seller']
+
+def get_images(hashes):
+    # {hash: base64 or None if unknown} for a prefix of hashes: at least one,
+    # then as many as fit in IMAGE_REPLY_BYTES
+    conn = get_read_connection()
+    cursor = conn.cursor()
+    images = {}
+    size = 0
+    for digest in hashes[:MAX_IMAGES_PER_REQUEST]:
+        image_b64 = encoded_image(cursor, digest)
+        if images and image_b64 is not None and size + len(image_b64) > IMAGE_REPLY_BYTES:
+            break
+        images[digest] = image_b64
+        size += len(image_b64 or '')
+    cursor.close()
+    conn.close()
+    return images
+
+def get_catalog_snapshot():
+    # any product write bumps the catalog version, so a snapshot built for an
+    # older version is simply replaced; concurrent misses build it only once
+    global catalog_snapshot
+    conn = get_read_connection()
+    cursor = conn.cursor()
+    try:
+        # one read transaction, so the rows are exactly those of the version
+        # the snapshot (and its ETag) is labelled with
+        if not conn.in_transaction:
+            cursor.execute("BEGIN")
+        version = get_catalog_version(cursor)
+        snapshot = catalog_snapshot
+        if snapshot is None or snapshot['version'] != version:
+            with catalog_snapshot_lock:
+                snapshot = catalog_snapshot
+                if snapshot is None or snapshot['version'] != version:
+                    snapshot = build_catalog_snapshot(cursor, version)
+                    catalog_snapshot = snapshot
+        return snapshot
+    finally:
+        cursor.close()
+        conn.close()  # ends the read transaction
+
+def encode_catalog_cursor(product_name, seller):
+    # opaque to clients: the last (product_name, user_name) key of a page
+    return base64.urlsafe_b64encode(json.dumps([product_name, seller]).encode('utf-8')).decode('ascii')
+
+def decode_catalog_cursor(cursor_text):
+    # (product_name, user_name), or None for a cursor this server did not hand out
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor_text.encode('ascii')))
+    except ValueError:  # bad base64 (binascii.Error), bad JSON, non-ASCII text
+        return None
+    if not isinstance(key, list) or len(key) != 2 or not all(isinstance(part, str) for part in key):
+        return None
+    return tuple(key)
+
+def get_catalog_version(cursor):
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM catalog_changes")
+    return cursor.fetchone()[0]
+
+def get_catalog_changes(since_version):
+    # returns (changes, version); changes is None when since_version is too old
+    # (or from another database) and the client has to page the catalog again
+    conn = get_read_connection()
+    cursor = conn.cursor()
+    version = get_catalog_version(cursor)
+    cursor.execute("SELECT MIN(version) FROM catalog_changes")
+    oldest = cursor.fetchone()[0]
+    if since_version > version or (oldest is not None and since_version < oldest - 1):
+        cursor.close()
+        conn.close()
+        return None, version
+    
+    # one entry per product, carrying its current state: a product that was
+    # changed several times, or sold out, is reported once
+    cursor.execute("""SELECT catalog_changes.product_name, catalog_changes.user_name, MAX(version),
+                            rating, price, COALESCE(thumbnails.thumb_hash, image_hash), quantity
+                     FROM catalog_changes
+                     LEFT JOIN productList ON productList.product_name = catalog_changes.product_name
+                                          AND productList.user_name = catalog_changes.user_name
+                     LEFT JOIN thumbnails ON thumbnails.hash = image_hash AND thumbnails.size = 'card'
+                     WHERE version > ? AND version <= ?
+                     GROUP BY catalog_changes.product_name, catalog_changes.user_name
+                     ORDER BY MAX(version)""",
+                  (since_version, version))
+    changes = []
+    for product_name, user_name, changed_at, rating, price, image_hash, quantity in cursor.fetchall():
+        change = {'version': changed_at, 'product_name': product_name, 'seller': user_name}
+        if quantity is None or quantity <= 0:
+            change['op'] = 'delete'
+        else:
+            change['op'] = 'upsert'
+            change['product'] = (product_name, user_name, rating, price, encoded_image(cursor, image_hash))
+        changes.append(change)
     cursor.close()
     conn.close()
+    return changes, version
+
+def get_product_page(page_size, cursor_text=""):
+    # keyset pagination in (product_name, user_name) order, which is unique and
+    # stable while products come and go; returns (products, next cursor or None,
+    # catalog version the page is at least as new as), or None for a bad cursor
+    page_size = max(1, min(page_size, MAX_CATALOG_PAGE_SIZE))
+    after = decode_catalog_cursor(cursor_text) if cursor_text else ("", "")
+    if after is None:
+        return None
     
-    result = {}
-    for product_name, user_name, rating, price, image in products:
-        if user_name not in result:
-            result[user_name] = []
-        image_b64 = base64.b64encode(image).decode('utf-8') if image else None
-        result[user_name].append((product_name, rating, price, image_b64))
+    conn = get_read_connection()
+    cursor = conn.cursor()
+    version = get_catalog_version(cursor)
+    cursor.execute("""SELECT product_name, user_name, rating, price, COALESCE(thumbnails.thumb_hash, image_hash)
+                     FROM productList
+                     LEFT JOIN thumbnails ON thumbnails.hash = image_hash AND thumbnails.size = 'card'
+                     WHERE quantity > 0 AND (product_name, user_name) > (?, ?)
+                     ORDER BY product_name, user_name
+                     LIMIT ?""",
+                  (after[0], after[1], page_size + 1))
+    rows = cursor.fetchall()
     
-    return result
+    products = []
+    for product_name, user_name, rating, price, image_hash in rows[:page_size]:
+        products.append((product_name, user_name, rating, price, encoded_image(cursor, image_hash)))
+    cursor.close()
+    conn.close()
+    
+    next_cursor = None
+    if len(rows) > page_size:
+        last = products[-1]
+        next_cursor = encode_catalog_cursor(last[0], last[1])
+    return products, next_cursor, version
+
+def search_terms(text):
+    # each word must match as a prefix: 'red lam' -> "red"* "lam"*
+    words = re.findall(r'\w+', text)
+    return ' '.join(f'"{word}"*' for word in words)
+
+def encode_search_cursor(key):
+    # opaque to clients, like the catalog cursor: the last sort key of a page,
+    # (rank, rowid) for full-text search or (product_name, user_name) for LIKE
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode('utf-8')).decode('ascii')
+
+def decode_search_cursor(cursor_text):
+    # the sort key, or None for a cursor this server did not hand out
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor_text.encode('ascii')))
+    except ValueError:
+        return None
+    types = ((int, float), int) if FULL_TEXT_SEARCH else (str, str)
+    if (not isinstance(key, list) or len(key) != 2 or isinstance(key[1], bool)
+            or not all(isinstance(part, kind) for part, kind in zip(key, types))):
+        return None
+    return tuple(key)
+
+def search_products(query, page_size, cursor_text=""):
+    # ranked full-text search over name (weighted highest), seller and
+    # description. Pages are keyset pages like the catalog's, so products added
+    # or removed ahead of the cursor do not shift the pages after it. Returns
+    # (products, next cursor), or (None, None) for a bad cursor
+    page_size = max(1, min(page_size, MAX_CATALOG_PAGE_SIZE))
+    after = None
+    if cursor_text:
+        after = decode_search_cursor(cursor_text)
+        if after is None:
+            return None, None
+    terms = search_terms(query)
+    if not terms:
+        return [], None
+    
+    conn = get_read_connection()
+    cursor = conn.cursor()
+    if FULL_TEXT_SEARCH:
+        # bm25 scores move with the corpus statistics whenever a product is
+        # added or removed, so the page starts after the cursor row's current
+        # score, and after the score it had only when it no longer matches
+        after_clause = "" if after is None else """ AND (hits.rank, hits.rowid) >
+                          (COALESCE((SELECT rank FROM hits WHERE rowid = ?), ?), ?)"""
+        cursor.execute(f"""WITH hits AS (SELECT rowid, bm25(product_search, 10.0, 1.0, 5.0) AS rank
+                                        FROM product_search WHERE product_search MATCH ?)
+                          SELECT productList.product_name, productList.user_name, rating, price,
+                                 COALESCE(thumbnails.thumb_hash, image_hash), hits.rank, hits.rowid
+                          FROM hits
+                          JOIN productList ON productList.rowid = hits.rowid
+                          LEFT JOIN thumbnails ON thumbnails.hash = image_hash AND thumbnails.size = 'card'
+                          WHERE quantity > 0{after_clause}
+                          ORDER BY hits.rank, hits.rowid
+                          LIMIT ?""",
+                      (terms, *((after[1], after[0], after[1]) if after else ()), page_size + 1))
+    else:
+        pattern = f"%{query.strip()}%"
+        after_clause = "" if after is None else " AND (product_name, user_name) > (?, ?)"
+        cursor.execute(f"""SELECT product_name, user_name, rating, price, COALESCE(thumbnails.thumb_hash, image_hash),
+                                 product_name, user_name
+                          FROM productList
+                          LEFT JOIN thumbnails ON thumbnails.hash = image_hash AND thumbnails.size = 'card'
+                          WHERE quantity > 0 AND (product_name LIKE ? OR user_name LIKE ? OR description LIKE ?){after_clause}
+                          ORDER BY product_name, user_name
+                          LIMIT ?""",
+                      (pattern, pattern, pattern, *(after or ()), page_size + 1))
+    rows = cursor.fetchall()
+    
+    products = []
+    for product_name, user_name, rating, price, image_hash, _, _ in rows[:page_size]:
+        products.append((product_name, user_name, rating, price, encoded_image(cursor, image_hash)))
+    cursor.close()
+    conn.close()
+    
+    next_cursor = encode_search_cursor(rows[page_size - 1][5:]) if len(rows) > page_size else None
+    return products, next_cursor
 
 def get_product_info(product_name, seller=None):
-    conn = get_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     if seller:
-        cursor.execute("SELECT user_name, image, description, price, quantity FROM productList WHERE product_name = ? AND user_name = ?",
+        cursor.execute("""SELECT user_name, images.data, description, price, quantity FROM productList
+                         LEFT JOIN thumbnails ON thumbnails.hash = image_hash AND thumbnails.size = 'detail'
+                         LEFT JOIN images ON images.hash = COALESCE(thumbnails.thumb_hash, image_hash)
+                         WHERE product_name = ? AND user_name = ?""",
                       (product_name, seller))
     else:
-        cursor.execute("SELECT user_name, image, description, price, quantity FROM productList WHERE product_name = ?",
+        cursor.execute("""SELECT user_name, images.data, description, price, quantity FROM productList
+                         LEFT JOIN thumbnails ON thumbnails.hash = image_hash AND thumbnails.size = 'detail'
+                         LEFT JOIN images ON images.hash = COALESCE(thumbnails.thumb_hash, image_hash)
+                         WHERE product_name = ?""",
                       (product_name,))
     result = cursor.fetchone()
     cursor.close()
@@ -165,7 +712,7 @@ def get_product_info(product_name, seller=None):
     return result
 
 def product_exists(product_name, seller=None):
-    conn = get_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     if seller:
         cursor.execute("SELECT * FROM productList WHERE product_name = ? AND user_name = ?", (product_name, seller))
@@ -183,24 +730,25 @@ def add_product(product_name, username, image, description, price, quantity):
         cursor.execute("SELECT quantity FROM productList WHERE product_name = ? AND user_name = ?",
                       (product_name, username))
         existing = cursor.fetchone()
+        image_hash = put_image(cursor, image, ('card', 'detail'))
         
         if existing:
             # restock instead of error - just add to quantity
             new_quantity = existing[0] + quantity
             cursor.execute("""UPDATE productList 
-                             SET quantity = ?, image = COALESCE(?, image),  -- keeps old image if no new one
+                             SET quantity = ?, image_hash = COALESCE(?, image_hash),  -- keeps old image if no new one
                                  description = ?, price = ? 
                              WHERE product_name = ? AND user_name = ?""",
-                          (new_quantity, image, description, price, product_name, username))
+                          (new_quantity, image_hash, description, price, product_name, username))
             conn.commit()
             cursor.close()
             conn.close()
             return True
         else:
             cursor.execute("""INSERT INTO productList 
-                             (product_name, user_name, image, description, price, quantity) 
+                             (product_name, user_name, image_hash, description, price, quantity) 
                              VALUES (?, ?, ?, ?, ?, ?)""",
-                          (product_name, username, image, description, price, quantity))
+                          (product_name, username, image_hash, description, price, quantity))
             cursor.execute("INSERT INTO userPr (username, product_name) VALUES (?, ?)",
                           (username, product_name))
             conn.commit()
@@ -214,7 +762,7 @@ def add_product(product_name, username, image, description, price, quantity):
         return False
 
 def get_user_purchase_history(username):
-    conn = get_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT product_name, buyer_username FROM buyers WHERE seller_username = ?", (username,))
     purchases = cursor.fetchall()
@@ -225,23 +773,94 @@ def get_user_purchase_history(username):
     result[username] = [(f"{product_name} - bought by {buyer}") for product_name, buyer in purchases]
     return result
 
+# Unread counts per user and sender, held in memory so the chat polls (5, 21,
+# 29) of users with nothing new never reach SQLite. A user's counts are read
+# from the conversations table at login (or their first poll) and dropped at
+# logout. Everything that changes them runs on the group-commit thread, in
+# order with the chat writes themselves: message inserts and read receipts
+# adjust the counts, and reconcile_unread_counts() periodically re-reads them
+# in case a failed batch left them off.
+unread_counts = {}  # username -> {sender: unread count}
+unread_lock = threading.Lock()
+unread_stats = {'hits': 0, 'loads': 0, 'reconciles': 0}
+
+def read_unread_counts(cursor, username):
+    cursor.execute("SELECT partner, unread FROM conversations WHERE username = ? AND unread > 0", (username,))
+    return dict(cursor.fetchall())
+
+def load_unread_counts(cursor, username):
+    # group-commit operation. Only kept for a user still online: a load queued
+    # at login can run after that user has logged out and been forgotten
+    counts = read_unread_counts(cursor, username)
+    with unread_lock:
+        if username in online_users:
+            unread_counts[username] = counts
+        unread_stats['loads'] += 1
+    return dict(counts)
+
+def reconcile_unread_counts(cursor):
+    # group-commit operation; returns how many users were checked
+    with unread_lock:
+        usernames = list(unread_counts)
+    for username in usernames:
+        counts = read_unread_counts(cursor, username)
+        with unread_lock:
+            if username in unread_counts:  # not logged out meanwhile
+                unread_counts[username] = counts
+    with unread_lock:
+        unread_stats['reconciles'] += 1
+    return len(usernames)
+
+def get_unread_counts(username):
+    # {sender: count} of the user's unread messages
+    with unread_lock:
+        counts = unread_counts.get(username)
+        if counts is not None:
+            unread_stats['hits'] += 1
+            return dict(counts)
+    return get_chat_writer().call(load_unread_counts, username)
+
+def forget_unread_counts(username):
+    with unread_lock:
+        unread_counts.pop(username, None)
+
+def unread_cache_stats():
+    with unread_lock:
+        return dict(unread_stats, users=len(unread_counts))
+
+def reconcile_unread_loop(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            get_chat_writer().call(reconcile_unread_counts)
+        except Exception as e:
+            print(f"Error reconciling unread counts: {e}")
+
+def insert_message(cursor, sender, receiver, message):
+    # runs on the group-commit thread, inside that batch's transaction
+    cursor.execute("INSERT INTO chat_messages (sender, receiver, message) VALUES (?, ?, ?)",
+                  (sender, receiver, message))
+    message_id = cursor.lastrowid
+    cursor.execute("SELECT timestamp FROM chat_messages WHERE id = ?", (message_id,))
+    timestamp = cursor.fetchone()[0]
+    with unread_lock:
+        counts = unread_counts.get(receiver)
+        if counts is not None:
+            counts[sender] = counts.get(sender, 0) + 1
+    return {'id': message_id, 'sender': sender, 'receiver': receiver,
+            'message': message, 'timestamp': timestamp}
+
 def store_message(sender, receiver, message):
-    conn = get_connection()
-    cursor = conn.cursor()
+    # returns the stored row as a dict (used for the push event) once it is
+    # committed, None on failure
     try:
-        cursor.execute("INSERT INTO chat_messages (sender, receiver, message) VALUES (?, ?, ?)",
-                      (sender, receiver, message))
-        conn.commit()
-        cursor.close()
-        conn.close()
-        return True
-    except:
-        cursor.close()
-        conn.close()
-        return False
+        return get_chat_writer().call(insert_message, sender, receiver, message)
+    except Exception as e:
+        print(f"Error storing message from {sender} to {receiver}: {e}")
+        return None
 
 def get_unread_messages(username):
-    conn = get_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT id, sender, message, timestamp FROM chat_messages WHERE receiver = ? AND is_read = 0 ORDER BY timestamp",
                   (username,))
@@ -250,42 +869,116 @@ def get_unread_messages(username):
     conn.close()
     return messages
 
-def mark_messages_read(username, sender=None):
-    conn = get_connection()
-    cursor = conn.cursor()
+def update_read_receipts(cursor, username, sender, up_to_id):
+    query = "UPDATE chat_messages SET is_read = 1 WHERE receiver = ? AND is_read = 0"
+    params = [username]
+    if sender:
+        query += " AND sender = ?"
+        params.append(sender)
+    if up_to_id is not None:
+        query += " AND id <= ?"  # only what the reader was actually shown
+        params.append(up_to_id)
     if sender:
-        cursor.execute("UPDATE chat_messages SET is_read = 1 WHERE receiver = ? AND sender = ?",
-                      (username, sender))
+        cursor.execute(query, params)
+        marked = {sender: cursor.rowcount}
     else:
-        cursor.execute("UPDATE chat_messages SET is_read = 1 WHERE receiver = ?", (username,))
-    conn.commit()
-    cursor.close()
-    conn.close()
+        # what is about to be marked, per sender, so messages newer than
+        # up_to_id stay counted (same group-commit transaction as the UPDATE)
+        cursor.execute(query.replace("UPDATE chat_messages SET is_read = 1",
+                                     "SELECT sender, COUNT(*) FROM chat_messages") + " GROUP BY sender", params)
+        marked = dict(cursor.fetchall())
+        cursor.execute(query, params)
+    with unread_lock:
+        counts = unread_counts.get(username)
+        if counts is not None:
+            for partner, read in marked.items():
+                remaining = counts.get(partner, 0) - read
+                if remaining > 0:
+                    counts[partner] = remaining
+                else:
+                    counts.pop(partner, None)
+    return cursor.rowcount
+
+def mark_messages_read(username, sender=None, up_to_id=None):
+    # returns once the receipt is committed (group commit, like store_message)
+    get_chat_writer().call(update_read_receipts, username, sender, up_to_id)
 
 def get_chat_history(user1, user2, limit=50):
-    conn = get_connection()
+    messages, _ = get_chat_page(user1, user2, page_size=limit)
+    return [message[1:] for message in messages]
+
+def get_chat_page(user1, user2, before_id=None, after_id=None, page_size=CHAT_PAGE_SIZE):
+    # one page of the conversation as [id, sender, message, timestamp], oldest
+    # first. With after_id: the messages right after it, and whether newer ones
+    # remain. Otherwise: the messages right before before_id (or the latest),
+    # and whether older ones remain.
+    page_size = max(1, min(page_size, MAX_CHAT_PAGE_SIZE))
+    newer = after_id is not None
+    if newer:
+        condition, order, bound = "id > ?", "ASC", after_id
+    else:
+        condition, order, bound = "id < ?", "DESC", before_id if before_id is not None else MAX_MESSAGE_ID
+    
+    # each direction is a range of idx_chat_pair_id; the merge stops at the limit
+    branch = f"SELECT id, sender, message, timestamp FROM chat_messages WHERE sender = ? AND receiver = ? AND {condition}"
+    directions = [(user1, user2)] if user1 == user2 else [(user1, user2), (user2, user1)]
+    query = " UNION ALL ".join(branch for _ in directions) + f" ORDER BY id {order} LIMIT ?"
+    params = [value for sender, receiver in directions for value in (sender, receiver, bound)] + [page_size + 1]
+    
+    conn = get_read_connection()
     cursor = conn.cursor()
-    cursor.execute("""SELECT sender, message, timestamp FROM chat_messages 
-                     WHERE (sender = ? AND receiver = ?) OR (sender = ? AND receiver = ?)
-                     ORDER BY timestamp DESC LIMIT ?""",
-                  (user1, user2, user2, user1, limit))
-    messages = cursor.fetchall()
+    cursor.execute(query, params)
+    rows = cursor.fetchall()
     cursor.close()
     conn.close()
-    return list(reversed(messages))  # DESC order needs flip for chronological  # DESC order needs flip for chronological  # DESC order needs flip for chronological
+    
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+    if not newer:
+        rows.reverse()
+    return [list(row) for row in rows], more
 
-def register_online_user(username, client_socket, address, port):
+def register_online_user(username, session, port):
     online_users[username] = {
-        'socket': client_socket,
+        'socket': session.socket,
+        'session': session,
         'port': port,
-        'address': address
+        'address': session.address
     }
     print(f"User {username} is now online (P2P port: {port})")
+    get_chat_writer().submit(load_unread_counts, username)  # ready before the first poll
+    push_presence(username, True)
 
 def unregister_online_user(username):
     if username in online_users:
         del online_users[username]
+        forget_unread_counts(username)
         print(f"User {username} is now offline")
+        push_presence(username, False)
+
+def push_event(username, event, payload):
+    # best effort: only subscribed sessions get events, the rest keep polling
+    info = online_users.get(username)
+    session = info.get('session') if info else None
+    if session is None or not session.subscribed:
+        return False
+    try:
+        session.send(KIND_EVENT, EVENT_REQUEST_ID, [event, json.dumps(payload)])
+        return True
+    except OSError:
+        return False
+
+def push_presence(username, online):
+    # tell everyone with a chat window open on this user
+    watchers = [viewer for viewer, others in list(active_chats.items()) if username in others]
+    for viewer in watchers:
+        push_event(viewer, "presence", {'user': username, 'online': online})
+
+def push_transaction(trans_id):
+    transaction = get_transaction(trans_id)
+    if transaction:
+        push_event(transaction['buyer'], "transaction", transaction)
+        push_event(transaction['seller'], "transaction", transaction)
 
 def get_user_connection_info(username):
     if username in online_users:
@@ -293,34 +986,39 @@ def get_user_connection_info(username):
     return None
 
 def get_conversations(username):
-    conn = get_connection()
+    # chat partners, most recent conversation first
+    return [summary['partner'] for summary in get_conversation_summaries(username)]
+
+def get_conversation_summaries(username):
+    conn = get_read_connection()
     cursor = conn.cursor()
-    
-    # CASE gets the 'other person' in each message
-    cursor.execute("""SELECT DISTINCT 
-                     CASE WHEN sender = ? THEN receiver ELSE sender END as conversation_partner
-                     FROM chat_messages 
-                     WHERE sender = ? OR receiver = ?""",
-                  (username, username, username))
-    
-    conversation_list = [row[0] for row in cursor.fetchall()]
+    cursor.execute("""SELECT partner, last_message_id, last_sender, snippet, last_timestamp, unread
+                     FROM conversations WHERE username = ?
+                     ORDER BY last_message_id DESC""",
+                  (username,))
+    summaries = [{'partner': partner, 'last_message_id': message_id, 'last_sender': sender,
+                  'snippet': snippet, 'timestamp': timestamp, 'unread': unread}
+                 for partner, message_id, sender, snippet, timestamp, unread in cursor.fetchall()]
     cursor.close()
     conn.close()
-    return conversation_list
+    return summaries
 
 def get_seller_products(seller):
-    conn = get_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT product_name, rating, price, image, quantity FROM productList WHERE user_name = ?",
-                  (seller,))
+    cursor.execute("""SELECT product_name, rating, price, COALESCE(thumbnails.thumb_hash, image_hash), quantity
+                     FROM productList
+                     LEFT JOIN thumbnails ON thumbnails.hash = image_hash AND thumbnails.size = 'card'
+                     WHERE user_name = ? COLLATE NOCASE AND user_name = ?""",
+                  (seller, seller))  # an exact match, found through the case-insensitive seller index
     products = cursor.fetchall()
-    cursor.close()
-    conn.close()
     
     result = []
-    for product_name, rating, price, image, quantity in products:
-        image_b64 = base64.b64encode(image).decode('utf-8') if image else None
+    for product_name, rating, price, image_hash, quantity in products:
+        image_b64 = encoded_image(cursor, image_hash)
         result.append((product_name, rating, price, image_b64, quantity))
+    cursor.close()
+    conn.close()
     return result
 
 def delete_product(product_name, username):
@@ -353,34 +1051,17 @@ def decrement_product_stock(product_name, seller, quantity=1):
     conn = get_connection()
     cursor = conn.cursor()
     try:
-        cursor.execute("SELECT quantity FROM productList WHERE product_name = ? AND user_name = ?", 
-                      (product_name, seller))
-        check_result = cursor.fetchone()
-        if not check_result:
-            print(f"ERROR: Product '{product_name}' not found for seller '{seller}'")
-            cursor.close()
-            conn.close()
-            return None
-        
-        current_stock = check_result[0]
-        if current_stock < quantity:
-            print(f"ERROR: Insufficient stock for '{product_name}' by '{seller}'. Current: {current_stock}, Requested: {quantity}")
+        # check and decrement in one statement; allows reaching 0 stock
+        remaining = Inventory.take(cursor, product_name, seller, quantity)
+        if remaining is None:
+            print(f"ERROR: Insufficient stock (or no product) for '{product_name}' by '{seller}', requested {quantity}")
             cursor.close()
             conn.close()
             return None
-        
-        # Allow decrement even if it results in 0 stock
-        
-        cursor.execute("UPDATE productList SET quantity = quantity - ? WHERE product_name = ? AND user_name = ?",
-                      (quantity, product_name, seller))
         conn.commit()
-        
-        cursor.execute("SELECT quantity FROM productList WHERE product_name = ? AND user_name = ?", 
-                      (product_name, seller))
-        result = cursor.fetchone()
         cursor.close()
         conn.close()
-        return result[0] if result else None  # Return None on error, 0 is valid
+        return remaining  # 0 is valid
     except Exception as e:
         print(f"Error decrementing stock: {e}")
         cursor.close()
@@ -388,7 +1069,7 @@ def decrement_product_stock(product_name, seller, quantity=1):
         return None  # Return None to indicate error
 
 def check_already_purchased(buyer, product_name, seller):
-    conn = get_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT COUNT(*) FROM buyers WHERE buyer_username = ? AND product_name = ? AND seller_username = ?",
                   (buyer, product_name, seller))
@@ -419,7 +1100,7 @@ def create_transaction(buyer, seller, product, date, quantity):
         return None
 
 def get_user_transactions(username, other_user=None):
-    conn = get_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     
     if other_user:
@@ -453,52 +1134,122 @@ def get_user_transactions(username, other_user=None):
         })
     return result
 
+def get_transaction(trans_id):
+    conn = get_read_connection()
+    cursor = conn.cursor()
+    cursor.execute("""SELECT id, buyer, seller, product, date, quantity, status 
+                     FROM transactions WHERE id = ?""", (trans_id,))
+    trans = cursor.fetchone()
+    cursor.close()
+    conn.close()
+    
+    if not trans:
+        return None
+    trans_id, buyer, seller, product, date, quantity, status = trans
+    return {
+        'id': trans_id,
+        'buyer': buyer,
+        'seller': seller,
+        'product': product,
+        'date': date,
+        'quantity': quantity,
+        'status': status
+    }
+
+# status a response may move a transaction to -> statuses it may move from
+TRANSACTION_TRANSITIONS = {
+    'approved': ('pending',),
+    'declined': ('pending', 'approved'),
+}
+
 def update_transaction_status(trans_id, status):
+    # approving reserves the proposal's stock and fails (returns None) when it
+    # is no longer there; declining gives back anything reserved. A transaction
+    # that is not in a state it can move from (already completed, declined or
+    # expired) is left alone and False returned
+    allowed = TRANSACTION_TRANSITIONS.get(status)
+    if allowed is None:
+        return False
     conn = get_connection()
     cursor = conn.cursor()
     try:
-        cursor.execute("UPDATE transactions SET status = ? WHERE id = ?",
-                      (status, trans_id))
+        # the status check and the change are one statement, so two responses
+        # to the same proposal cannot both reserve or release its stock
+        cursor.execute(f"""UPDATE transactions SET status = ?
+                          WHERE id = ? AND status IN ({', '.join('?' * len(allowed))})""",
+                       (status, trans_id, *allowed))
+        if cursor.rowcount != 1:
+            return False
+        if status == 'approved':
+            cursor.execute("SELECT seller, product, quantity FROM transactions WHERE id = ?", (trans_id,))
+            trans = cursor.fetchone()
+            if not Inventory.reserve(cursor, trans_id, trans[1], trans[0], trans[2], reservation_ttl):
+                return None  # closing without a commit rolls the status change back
+        else:
+            Inventory.release(cursor, trans_id)
         conn.commit()
+        return True
+    except Exception as e:
+        print(f"Error updating transaction {trans_id}: {e}")
+        return False
+    finally:
         cursor.close()
         conn.close()
-        return True
-    except:
+
+def expire_reservations():
+    # releases reservations whose buyer never completed the purchase and marks
+    # those transactions expired; returns their ids
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        trans_ids = Inventory.expired(cursor)
+        for trans_id in trans_ids:
+            Inventory.release(cursor, trans_id)
+            cursor.execute("UPDATE transactions SET status = 'expired' WHERE id = ? AND status = 'approved'",
+                          (trans_id,))
+        conn.commit()
+        return trans_ids
+    finally:
         cursor.close()
         conn.close()
-        return False
+
+def expire_reservations_loop(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            for trans_id in expire_reservations():
+                print(f"Reservation for transaction {trans_id} expired")
+                push_transaction(trans_id)
+        except Exception as e:
+            print(f"Error expiring reservations: {e}")
 
 def complete_purchase(trans_id, product_name, product_rating, buyer_rating):
     conn = get_connection()
     cursor = conn.cursor()
     try:
-        cursor.execute("SELECT buyer, seller, quantity FROM transactions WHERE id = ?", (trans_id,))
+        cursor.execute("SELECT buyer, seller, quantity, status FROM transactions WHERE id = ?", (trans_id,))
         trans = cursor.fetchone()
-        if not trans:
+        if not trans or trans[3] in ('completed', 'declined'):
             cursor.close()
             conn.close()
             return False
         
-        buyer, seller, quantity = trans
+        buyer, seller, quantity, _ = trans
+        
+        # the stock was reserved when the seller approved; without a reservation
+        # (it expired) the purchase only goes through if the stock is still there
+        if not Inventory.commit(cursor, trans_id) and Inventory.take(cursor, product_name, seller, quantity) is None:
+            print(f"Cannot complete transaction {trans_id}: '{product_name}' by '{seller}' is out of stock")
+            cursor.close()
+            conn.close()
+            return False
         
         cursor.execute("UPDATE transactions SET status = 'completed' WHERE id = ?", (trans_id,))
         
         cursor.execute("INSERT INTO buyers (seller_username, product_name, buyer_username, rating) VALUES (?, ?, ?, ?)",
                       (seller, product_name, buyer, product_rating))
         
-        cursor.execute("SELECT rating, numberOfRating FROM productList WHERE product_name = ? AND user_name = ?", 
-                      (product_name, seller))
-        prod = cursor.fetchone()
-        if prod:
-            current_rating, num_ratings = prod
-            new_num_ratings = num_ratings + 1
-            new_rating = ((current_rating * num_ratings) + product_rating) / new_num_ratings
-            cursor.execute("UPDATE productList SET rating = ?, numberOfRating = ? WHERE product_name = ? AND user_name = ?",
-                          (new_rating, new_num_ratings, product_name, seller))
-        
-        cursor.execute("UPDATE productList SET quantity = quantity - ? WHERE product_name = ? AND user_name = ?",
-                      (quantity, product_name, seller))
-        
+        # the rating triggers update the product's and both users' averages
         cursor.execute("INSERT INTO product_ratings (product_name, seller, buyer, rating) VALUES (?, ?, ?, ?)",
                       (product_name, seller, buyer, product_rating))
         
@@ -520,10 +1271,12 @@ def complete_purchase(trans_id, product_name, product_rating, buyer_rating):
         return False
 
 def get_user_profile(username):
-    conn = get_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     try:
-        cursor.execute("SELECT real_name, profile_picture, bio FROM infoList WHERE LOWER(username) = LOWER(?)", (username,))
+        cursor.execute("""SELECT real_name, COALESCE(thumbnails.thumb_hash, picture_hash), bio FROM infoList
+                         LEFT JOIN thumbnails ON thumbnails.hash = picture_hash AND thumbnails.size = 'avatar'
+                         WHERE username = ? COLLATE NOCASE""", (username,))
         user_info = cursor.fetchone()
         if not user_info:
             cursor.close()
@@ -531,24 +1284,22 @@ def get_user_profile(username):
             return None
         
         real_name = str(user_info[0]) if user_info[0] else "User"
-        profile_picture_blob = user_info[1] if len(user_info) > 1 else None
+        picture_hash = user_info[1] if len(user_info) > 1 else None
         bio = str(user_info[2]) if (len(user_info) > 2 and user_info[2]) else ""
         
         profile_picture = None
-        if profile_picture_blob:
+        if picture_hash:
             try:
-                profile_picture = base64.b64encode(profile_picture_blob).decode('utf-8')
+                profile_picture = encoded_image(cursor, picture_hash)
             except Exception as e:
                 print(f"Error encoding profile picture: {e}")
                 profile_picture = None
         
-        cursor.execute("SELECT AVG(rating) FROM buyer_ratings WHERE LOWER(buyer) = LOWER(?)", (username,))
-        avg_rating_result = cursor.fetchone()
-        avg_rating = avg_rating_result[0] if avg_rating_result and avg_rating_result[0] else 0.0
+        avg_rating = user_rating(cursor, username)
         
         cursor.execute("""SELECT product_name, price, rating, numberOfRating, quantity 
                          FROM productList 
-                         WHERE LOWER(user_name) = LOWER(?) AND quantity > 0""", (username,))
+                         WHERE user_name = ? COLLATE NOCASE AND quantity > 0""", (username,))
         current_products = []
         try:
             for row in cursor.fetchall():
@@ -566,7 +1317,7 @@ def get_user_profile(username):
         
         cursor.execute("""SELECT product_name, price, rating, numberOfRating, quantity 
                          FROM productList 
-                         WHERE LOWER(user_name) = LOWER(?) AND quantity = 0""", (username,))
+                         WHERE user_name = ? COLLATE NOCASE AND quantity = 0""", (username,))
         previous_products = []
         try:
             for row in cursor.fetchall():
@@ -603,14 +1354,16 @@ def update_user_profile(username, real_name, bio, profile_picture_b64):
     conn = get_connection()
     cursor = conn.cursor()
     try:
-        profile_picture_blob = None
+        picture_hash = None
         if profile_picture_b64:
-            profile_picture_blob = base64.b64decode(profile_picture_b64)
+            picture_hash = put_image(cursor, base64.b64decode(profile_picture_b64), ('avatar',))
+            # the edit dialog sends back the avatar it was shown; keep the original behind it
+            picture_hash = source_hash(cursor, picture_hash)
         
         cursor.execute("""UPDATE infoList 
-                         SET real_name = ?, bio = ?, profile_picture = ? 
-                         WHERE LOWER(username) = LOWER(?)""",
-                      (real_name, bio, profile_picture_blob, username))
+                         SET real_name = ?, bio = ?, picture_hash = ? 
+                         WHERE username = ? COLLATE NOCASE""",
+                      (real_name, bio, picture_hash, username))
         conn.commit()
         cursor.close()
         conn.close()
@@ -621,685 +1374,1042 @@ def update_user_profile(username, real_name, bio, profile_picture_b64):
         conn.close()
         return False
 
-def handle_client(client_socket, address):
-    print(f"Client connected from {address}")
-    username = None
+def authenticate_client(session, auth_choice, args):
+    # returns (reply, username); username stays None until login/signup succeeds
+    if auth_choice == "yes":
+        username = field_text(args[0]).lower()
+        password = field_text(args[1])
+        if not user_exists(username):
+            return [b'0'], None  # Username not found
+        
+        if not verify_password(username, password) or username in online_users:
+            return [b'2'], None  # Wrong password or already logged in
+        
+        register_online_user(username, session, 0)
+        return [b'1', b"Login successful!"], username
     
+    elif auth_choice == "no":
+        username = field_text(args[0]).lower()
+        real_name = field_text(args[1])
+        password = field_text(args[2])
+        if user_exists(username):
+            return [b'0'], None  # Username already exists
+        
+        if create_user(username, password, real_name):
+            register_online_user(username, session, 0)
+            return [b'1', b"Account created successfully!"], username
+        return [b'2', b"Error creating account"], None
+    
+    return [b'0'], None
+
+def handle_request(username, request_code, args):
+    # serves one request on an authenticated connection and returns the reply fields
     try:
-        auth_choice = client_socket.recv(1024).decode('utf-8').lower()
+        if request_code == "1":
+            reply = []
+            history = get_user_purchase_history(username)
+            if history[username]:
+                reply += [b'1', json.dumps(history)]
+            else:
+                reply += [b'0', b'']
+            
+            reply.append(get_catalog_by_seller())
+            return reply
+        
+        elif request_code == "2":
+            product_name = field_text(args[0]).strip()
+            product_data = args[1]
+            
+            try:
+                data_str = json.loads(product_data.decode('utf-8'))
+                parts = data_str.split('|')
+                prod_name, image_b64, description, price, quantity = parts
+                
+                if image_b64 != "No Image":
+                    image_binary = base64.b64decode(image_b64)
+                else:
+                    image_binary = None
+                
+                if add_product(prod_name, username, image_binary, description, float(price), int(quantity)):
+                    print(f"Product '{prod_name}' added by {username}")
+                    return [b'1']
+                else:
+                    return [b'0']
+            except Exception as e:
+                print(f"Error adding product: {e}")
+                return [b'0']
         
-        if auth_choice == "yes":
-            username = client_socket.recv(1024).decode('utf-8').lower()
-            if user_exists(username):
-                client_socket.send(b'1')
+        elif request_code == "3":
+            data = field_text(args[0]).strip()
+            
+            if '|' in data:
+                product_name, seller = data.split('|', 1)
             else:
-                client_socket.send(b'0')
-                return
+                product_name = data
+                seller = None
             
-            password = client_socket.recv(1024).decode('utf-8')
-            if verify_password(username, password):
-                if username in online_users:
-                    client_socket.send(b'0')
-                    return
-                client_socket.send(b'1')
+            if product_exists(product_name, seller):
+                product_info = get_product_info(product_name, seller)
+                seller_name, image, description, price, quantity = product_info
+                
+                info_str = f"{seller_name}|{description}|{price}|{quantity}"
+                return [b'1', info_str, image if image else b"No Image"]
+            else:
+                return [b'0']
+        
+        elif request_code == "4":
+            history = get_user_purchase_history(username)
+            if history is not None:
+                return [b'1', json.dumps(history)]
+            else:
+                return [b'0']
+        
+        elif request_code == "5":
+            if not get_unread_counts(username):
+                return [b'0']
+            messages = get_unread_messages(username)
+            if messages:
+                return [b'1', json.dumps(messages)]
             else:
-                client_socket.send(b'0')
-                return
+                return [b'0']
+        
+        elif request_code == "6":
+            other_user = field_text(args[0]).strip()
+            history = get_chat_history(username, other_user)
+            if history:
+                return [b'1', json.dumps(history)]
+            else:
+                return [b'0']
+        
+        elif request_code == "7":
+            try:
+                recipient = field_text(args[0]).strip()
+                message = field_text(args[1]).strip()
+                
+                stored = store_message(username, recipient, message)
+                if stored:
+                    push_event(recipient, "message", stored)
+                    return [b'1']
+                return [b'0']
+            except Exception as e:
+                print(f"Error in command 7: {e}")
+                return [b'0']
+        
+        elif request_code == "8":
+            port = int(field_text(args[0]))
+            if username in online_users:
+                online_users[username]['port'] = port
+            return [b'1']
+        
+        elif request_code == "17":
+            recipient = field_text(args[0])
+            message = field_text(args[1])
             
-            client_socket.recv(1024)
-            client_socket.send(b"Login successful!")
+            stored = store_message(username, recipient, message)
+            if stored:
+                push_event(recipient, "message", stored)
+                return [b'1']
+            else:
+                return [b'0']
+        
+        elif request_code == "9":
+            unregister_online_user(username)
+            return [b'1']
+        
+        elif request_code == "10":
+            conversations = get_conversations(username)
+            return [json.dumps(conversations)]
+        
+        elif request_code == "11":
+            seller = field_text(args[0])
+            products = get_seller_products(seller)
+            product_list = [{'name': p[0], 'rating': p[1], 'price': p[2], 'image': p[3]} for p in products]
+            return [b'1', json.dumps(product_list)]
+        
+        elif request_code == "12":  # Create purchase proposal
+            proposal = json.loads(args[0].decode('utf-8'))
+            trans_id = create_transaction(
+                proposal['buyer'],
+                proposal['seller'],
+                proposal['product'],
+                proposal['date'],
+                proposal['quantity']
+            )
             
-            register_online_user(username, client_socket, address, 0)
+            if trans_id:
+                push_transaction(trans_id)
+                return [trans_id]
+            else:
+                return [b'error']
         
-        elif auth_choice == "no":
-            username = client_socket.recv(1024).decode('utf-8').lower()
-            if not user_exists(username):
-                client_socket.send(b'1')
+        elif request_code == "13":  # Check transactions with user
+            other_user = field_text(args[0])
+            transactions = get_user_transactions(username, other_user)
+            
+            if transactions:
+                return [b'1', json.dumps(transactions)]
             else:
-                client_socket.send(b'0')
-                return
+                return [b'0']
+        
+        elif request_code == "14":  # Respond to transaction
+            trans_id = field_text(args[0])
+            response = field_text(args[1])
             
-            user_data = client_socket.recv(1024).decode('utf-8')
-            real_name, password = user_data.split('|')
+            updated = update_transaction_status(trans_id, response)
+            if updated:
+                push_transaction(trans_id)
+                return [b'1']
+            elif updated is None:
+                return [b'2']  # not enough stock left to approve
+            else:
+                return [b'0']
+        
+        elif request_code == "15":  # Complete purchase with product and buyer ratings
+            trans_id = field_text(args[0]).strip()
+            product_name = field_text(args[1]).strip()
+            product_rating = int(field_text(args[2]).strip())
+            buyer_rating = int(field_text(args[3]).strip())
             
-            if create_user(username, password, real_name):
-                client_socket.send(b"Account created successfully!")
-                client_socket.recv(1024)
-                register_online_user(username, client_socket, address, 0)
+            if complete_purchase(trans_id, product_name, product_rating, buyer_rating):
+                push_transaction(trans_id)
+                return [b'1']
             else:
-                client_socket.send(b"Error creating account")
-                return
+                return [b'0']
         
-        while True:
-            try:
-                request_code = client_socket.recv(1024).decode('utf-8')
-                
-                if not request_code:
-                    break
-            except Exception as receive_error:
-                print(f"Error receiving request: {receive_error}")
-                break
+        elif request_code == "16":  # Check if user is online
+            check_username = field_text(args[0])
+            if check_username in online_users:
+                return [b'1']  # Online
+            else:
+                return [b'0']  # Offline
+        
+        elif request_code == "18":  # Get user profile
+            profile_username = field_text(args[0]).strip()
+            profile = get_user_profile(profile_username)
             
-            try:
-                if request_code == "1":
-                    history = get_user_purchase_history(username)
-                    if history[username]:
-                        client_socket.send(b'1')
-                        history_json = json.dumps(history)
-                        client_socket.send(len(history_json).to_bytes(16, 'big'))
-                        client_socket.sendall(history_json.encode('utf-8'))
-                    else:
-                        client_socket.send(b'0')
-                    
-                    client_socket.recv(1024)
+            if profile:
+                try:
+                    # Ensure all string fields are properly encoded
+                    if profile.get('bio') is None:
+                        profile['bio'] = ""
+                    if profile.get('real_name') is None:
+                        profile['real_name'] = "User"
                     
-                    products = get_all_products()
-                    products_json = json.dumps(products)
-                    client_socket.send(len(products_json).to_bytes(16, 'big'))  # 16-byte length prefix
-                    client_socket.sendall(products_json.encode('utf-8'))
+                    # ensure_ascii=False keeps unicode characters intact
+                    profile_json = json.dumps(profile, ensure_ascii=False)
+                    return [b'1', profile_json]
+                except Exception as e:
+                    print(f"Error encoding profile: {e}")
+                    return [b'0']
+            else:
+                return [b'0']
+        
+        elif request_code == "19":  # Update user profile
+            profile_info = json.loads(args[0].decode('utf-8'))
             
-                elif request_code == "2":
-                    product_name = client_socket.recv(1024).decode('utf-8').strip('\x00').strip()
-                    
-                    client_socket.send(b'1')
-                    
-                    data_length = int.from_bytes(client_socket.recv(16), 'big')
-                    product_data = b""
-                    
-                    # receive in chunks to handle large images
-                    while len(product_data) < data_length:
-                        chunk = client_socket.recv(4096)
-                        if not chunk:
-                            break
-                        product_data += chunk
-                    
-                    try:
-                        data_str = json.loads(product_data.decode('utf-8'))
-                        parts = data_str.split('|')
-                        prod_name, image_b64, description, price, quantity = parts
-                        
-                        if image_b64 != "No Image":
-                            image_binary = base64.b64decode(image_b64)
-                        else:
-                            image_binary = None
-                        
-                        if add_product(prod_name, username, image_binary, description, float(price), int(quantity)):
-                            client_socket.send(b'1')
-                            print(f"Product '{prod_name}' added by {username}")
-                        else:
-                            client_socket.send(b'0')
-                    except Exception as e:
-                        print(f"Error adding product: {e}")
-                        client_socket.send(b'0')
+            if update_user_profile(
+                username,
+                profile_info.get('real_name'),
+                profile_info.get('bio'),
+                profile_info.get('profile_picture')
+            ):
+                return [b'1']
+            else:
+                return [b'0']
+        
+        elif request_code == "20":  # Store received message (from P2P chat)
+            sender = field_text(args[0])
+            message = field_text(args[1])
             
-                elif request_code == "3":
-                    data = client_socket.recv(1024).decode('utf-8').strip('\x00').strip()  # removes padding
-                    
-                    if '|' in data:
-                        product_name, seller = data.split('|', 1)
-                    else:
-                        product_name = data
-                        seller = None
-                    
-                    if product_exists(product_name, seller):
-                        client_socket.send(b'1')
-                        
-                        product_info = get_product_info(product_name, seller)
-                        seller_name, image, description, price, quantity = product_info
-                        
-                        info_str = f"{seller_name}|{description}|{price}|{quantity}"
-                        client_socket.send(info_str.encode('utf-8'))
-                        
-                        client_socket.recv(1024)
-                        
-                        if image:
-                            client_socket.send(len(image).to_bytes(16, 'big'))
-                            client_socket.sendall(image)
-                        else:
-                            image_data = b"No Image"
-                            client_socket.send(len(image_data).to_bytes(16, 'big'))
-                            client_socket.sendall(image_data)
-                    else:
-                        client_socket.send(b'0')
+            # Store message with sender as sender and current user as receiver
+            if store_message(sender, username, message):
+                return [b'1']  # Success
+            else:
+                return [b'0']  # Failed
+        
+        elif request_code == "21":  # Get new messages from specific user
+            other_user = field_text(args[0]).strip()
+            if not get_unread_counts(username).get(other_user):
+                return [b'0']
             
-                elif request_code == "4":
-                    history = get_user_purchase_history(username)
-                    if history is not None:
-                        client_socket.send(b'1')
-                        history_json = json.dumps(history)
-                        client_socket.send(len(history_json).to_bytes(16, 'big'))
-                        client_socket.sendall(history_json.encode('utf-8'))
-                    else:
-                        client_socket.send(b'0')
+            # Get unread messages from other_user to this user
+            conn_db = get_read_connection()
+            cursor = conn_db.cursor()
+            cursor.execute("""SELECT id, sender, message, timestamp FROM chat_messages
+                             WHERE sender = ? AND receiver = ? AND is_read = 0
+                             ORDER BY timestamp ASC""",
+                          (other_user, username))
+            rows = cursor.fetchall()
+            cursor.close()
+            conn_db.close()
             
-                elif request_code == "5":
-                    messages = get_unread_messages(username)
-                    if messages:
-                        client_socket.send(b'1')
-                        messages_json = json.dumps(messages)
-                        client_socket.send(len(messages_json).to_bytes(16, 'big'))
-                        client_socket.sendall(messages_json.encode('utf-8'))
-                    else:
-                        client_socket.send(b'0')
-                
-                elif request_code == "6":
-                    other_user = client_socket.recv(1024).decode('utf-8').strip('\x00').strip()
-                    history = get_chat_history(username, other_user)
-                    if history:
-                        client_socket.send(b'1')
-                        history_json = json.dumps(history)
-                        client_socket.send(len(history_json).to_bytes(16, 'big'))
-                        client_socket.sendall(history_json.encode('utf-8'))
-                    else:
-                        client_socket.send(b'0')
+            new_messages = [row[1:] for row in rows]
+            if new_messages:
+                # Mark as read, up to the newest one returned: a message stored
+                # since the SELECT stays unread for the next poll
+                mark_messages_read(username, other_user, max(row[0] for row in rows))
+                return [b'1', json.dumps(new_messages)]
+            else:
+                return [b'0']
+        
+        elif request_code == "22":  # Submit ratings for purchase
+            try:
+                rating_info = json.loads(args[0].decode('utf-8'))
+                product_name = rating_info['product_name']
+                seller = rating_info['seller']
+                buyer = rating_info['buyer']
+                product_rating = rating_info['product_rating']
+                seller_rating = rating_info['seller_rating']
                 
-                elif request_code == "7":
-                    try:
-                        recipient = client_socket.recv(1024).decode('utf-8').strip('\x00').strip()
-                        message = client_socket.recv(4096).decode('utf-8').strip('\x00').strip()
-                        
-                        store_message(username, recipient, message)
-                        
-                        client_socket.send(b'1')
-                    except Exception as e:
-                        print(f"Error in command 7: {e}")
-                        client_socket.send(b'0')
+                print(f"Processing rating: product={product_name}, seller={seller}, buyer={buyer}, rating={product_rating}")
                 
-                elif request_code == "8":
-                    port = int(client_socket.recv(1024).decode('utf-8'))
-                    if username in online_users:
-                        online_users[username]['port'] = port
+                conn_db = get_connection()
+                cursor = conn_db.cursor()
                 
-                elif request_code == "17":
-                    recipient = client_socket.recv(1024).decode('utf-8')
-                    message = client_socket.recv(4096).decode('utf-8')
-                    
-                    if store_message(username, recipient, message):
-                        client_socket.send(b'1')
-                    else:
-                        client_socket.send(b'0')
+                # Add product rating to product_ratings table with seller info; its trigger
+                # updates the product's average rating for THIS SPECIFIC SELLER only
+                cursor.execute("""INSERT INTO product_ratings (product_name, seller, buyer, rating, timestamp)
+                                 VALUES (?, ?, ?, ?, datetime('now'))""",
+                              (product_name, seller, buyer, product_rating))
+                print(f"Inserted into product_ratings table")
                 
-                elif request_code == "9":
-                    unregister_online_user(username)
-                    break
+                # Add seller rating to buyer_ratings table (re-purpose for seller ratings)
+                # Note: buyer_ratings table is used for all user ratings
+                cursor.execute("""INSERT INTO buyer_ratings (buyer, rating, rated_by, timestamp)
+                                 VALUES (?, ?, ?, datetime('now'))""",
+                              (seller, seller_rating, buyer))
+                print(f"Inserted seller rating into buyer_ratings: seller={seller}, rating={seller_rating}")
                 
-                elif request_code == "10":
-                    conversations = get_conversations(username)
-                    conv_json = json.dumps(conversations)
-                    client_socket.send(len(conv_json).to_bytes(16, 'big'))
-                    client_socket.sendall(conv_json.encode('utf-8'))
+                cursor.execute("SELECT rating, numberOfRating FROM productList WHERE product_name = ? AND user_name = ?",
+                              (product_name, seller))
+                prod = cursor.fetchone()
+                if prod:
+                    print(f"New product stats: rating={prod[0]}, count={prod[1]}")
+                else:
+                    print(f"ERROR: Product not found in productList: {product_name} by {seller}")
                 
-                elif request_code == "11":
-                    seller = client_socket.recv(1024).decode('utf-8').strip('\x00')
-                    products = get_seller_products(seller)
-                    product_list = [{'name': p[0], 'rating': p[1], 'price': p[2], 'image': p[3]} for p in products]
-                    products_json = json.dumps(product_list)
-                    client_socket.send(b'1')
-                    client_socket.send(len(products_json).to_bytes(16, 'big'))
-                    client_socket.sendall(products_json.encode('utf-8'))
+                conn_db.commit()
+                cursor.close()
+                conn_db.close()
                 
-                elif request_code == "12":  # Create purchase proposal
-                    length = int.from_bytes(client_socket.recv(16), 'big')
-                    proposal_data = b""
-                    while len(proposal_data) < length:
-                        packet = client_socket.recv(4096)
-                        if not packet:
-                            break
-                        proposal_data += packet
-                    
-                    proposal = json.loads(proposal_data.decode('utf-8'))
-                    trans_id = create_transaction(
-                        proposal['buyer'],
-                        proposal['seller'],
-                        proposal['product'],
-                        proposal['date'],
-                        proposal['quantity']
-                    )
-                    
-                    if trans_id:
-                        client_socket.send(trans_id.encode('utf-8'))
-                    else:
-                        client_socket.send(b'error')
-                
-                elif request_code == "13":  # Check transactions with user
-                    other_user = client_socket.recv(1024).decode('utf-8')
-                    transactions = get_user_transactions(username, other_user)
-                    
-                    if transactions:
-                        client_socket.send(b'1')
-                        trans_json = json.dumps(transactions)
-                        client_socket.send(len(trans_json).to_bytes(16, 'big'))
-                        client_socket.sendall(trans_json.encode('utf-8'))
-                    else:
-                        client_socket.send(b'0')
-                
-                elif request_code == "14":  # Respond to transaction
-                    trans_id = client_socket.recv(1024).decode('utf-8')
-                    response = client_socket.recv(1024).decode('utf-8')
-                    
-                    if update_transaction_status(trans_id, response):
-                        client_socket.send(b'1')
-                    else:
-                        client_socket.send(b'0')
-                
-                elif request_code == "15":  # Complete purchase with product and buyer ratings
-                    trans_id = client_socket.recv(1024).decode('utf-8').strip('\x00').strip()
-                    product_name = client_socket.recv(1024).decode('utf-8').strip('\x00').strip()
-                    product_rating = int(client_socket.recv(1024).decode('utf-8').strip('\x00').strip())
-                    buyer_rating = int(client_socket.recv(1024).decode('utf-8').strip('\x00').strip())
-                    
-                    if complete_purchase(trans_id, product_name, product_rating, buyer_rating):
-                        client_socket.send(b'1')
-                    else:
-                        client_socket.send(b'0')
-                
-                elif request_code == "16":  # Check if user is online
-                    check_username = client_socket.recv(1024).decode('utf-8').strip('\x00')
-                    if check_username in online_users:
-                        client_socket.send(b'1')  # Online
-                    else:
-                        client_socket.send(b'0')  # Offline
-                
-                elif request_code == "18":  # Get user profile
-                    profile_username = client_socket.recv(1024).decode('utf-8').strip('\x00').strip()
-                    profile = get_user_profile(profile_username)
-                    
-                    if profile:
-                        try:
-                            # Ensure all string fields are properly encoded
-                            if profile.get('bio') is None:
-                                profile['bio'] = ""
-                            if profile.get('real_name') is None:
-                                profile['real_name'] = "User"
-                            
-                            # ensure_ascii=False keeps unicode characters intact
-                            profile_json = json.dumps(profile, ensure_ascii=False)
-                            profile_bytes = profile_json.encode('utf-8')
-                            
-                            # Send success indicator
-                            client_socket.send(b'1')
-                            # Send length prefix (16 bytes)
-                            client_socket.send(len(profile_bytes).to_bytes(16, 'big'))
-                            # Send actual data
-                            client_socket.sendall(profile_bytes)
-                        except Exception as e:
-                            print(f"Error encoding profile: {e}")
-                            client_socket.send(b'0')
-                    else:
-                        client_socket.send(b'0')
-                
-                elif request_code == "19":  # Update user profile
-                    length = int.from_bytes(client_socket.recv(16), 'big')
-                    profile_data = b""
-                    while len(profile_data) < length:
-                        packet = client_socket.recv(4096)
-                        if not packet:
-                            break
-                        profile_data += packet
-                    
-                    profile_info = json.loads(profile_data.decode('utf-8'))
-                    
-                    if update_user_profile(
-                        username,
-                        profile_info.get('real_name'),
-                        profile_info.get('bio'),
-                        profile_info.get('profile_picture')
-                    ):
-                        client_socket.send(b'1')
-                    else:
-                        client_socket.send(b'0')
+                print(f"Rating saved successfully!")
+                return [b'1']
+            except Exception as e:
+                print(f"Error saving ratings: {e}")
+                import traceback
+                traceback.print_exc()
+                return [b'0']
+        
+        elif request_code == "23":  # Delete product (owner only)
+            product_name = field_text(args[0])
+            if delete_product(product_name, username):
+                return [b'1']
+            else:
+                return [b'0']
+        
+        elif request_code == "24":  # Check if already purchased
+            # Receive product name and seller (format: "product_name|seller")
+            data = field_text(args[0])
+            
+            # Parse data - check if seller is included
+            if '|' in data:
+                product_name, seller = data.split('|', 1)
+            else:
+                # Backwards compatibility
+                product_name = data
+                seller = None
+            
+            if seller and check_already_purchased(username, product_name, seller):
+                return [b'1']  # Already purchased from this seller
+            else:
+                return [b'0']  # Not purchased from this seller
+        
+        elif request_code == "25":  # Decrement stock after confirmed purchase
+            try:
+                purchase_info = json.loads(args[0].decode('utf-8'))
+                product_name = purchase_info['product_name']
+                seller = purchase_info['seller']  # needed to identify correct seller's product
+                quantity = purchase_info.get('quantity', 1)
                 
-                elif request_code == "20":  # Store received message (from P2P chat)
-                    sender = client_socket.recv(1024).decode('utf-8')
-                    message = client_socket.recv(4096).decode('utf-8')
-                    
-                    # Store message with sender as sender and current user as receiver
-                    if store_message(sender, username, message):
-                        client_socket.send(b'1')  # Success
-                    else:
-                        client_socket.send(b'0')  # Failed
+                print(f"Stock reduction request: product={product_name}, seller={seller}, buyer={username}, qty={quantity}")
                 
-                elif request_code == "21":  # Get new messages from specific user
-                    other_user = client_socket.recv(1024).decode('utf-8').strip('\x00').strip()
-                    
-                    # Get unread messages from other_user to this user
+                remaining = decrement_product_stock(product_name, seller, quantity)
+                if remaining is not None and remaining >= 0:
+                    # Record the purchase with seller info
                     conn_db = get_connection()
                     cursor = conn_db.cursor()
-                    cursor.execute("""SELECT sender, message, timestamp FROM chat_messages 
-                                     WHERE sender = ? AND receiver = ? AND is_read = 0
-                                     ORDER BY timestamp ASC""",
-                                  (other_user, username))
-                    new_messages = cursor.fetchall()
-                    
-                    if new_messages:
-                        # Mark as read
-                        cursor.execute("""UPDATE chat_messages SET is_read = 1 
-                                         WHERE sender = ? AND receiver = ? AND is_read = 0""",
-                                      (other_user, username))
-                        conn_db.commit()
-                        
-                        client_socket.send(b'1')
-                        messages_json = json.dumps(new_messages)
-                        client_socket.send(len(messages_json).to_bytes(16, 'big'))
-                        client_socket.sendall(messages_json.encode('utf-8'))
-                    else:
-                        client_socket.send(b'0')
-                    
+                    cursor.execute("INSERT INTO buyers (seller_username, product_name, buyer_username) VALUES (?, ?, ?)",
+                                  (seller, product_name, username))
+                    conn_db.commit()
                     cursor.close()
                     conn_db.close()
-                
-                elif request_code == "22":  # Submit ratings for purchase
-                    # Receive rating data
-                    rating_length = int.from_bytes(client_socket.recv(16), 'big')
-                    rating_data = b""
-                    while len(rating_data) < rating_length:
-                        packet = client_socket.recv(4096)
-                        if not packet:
-                            break
-                        rating_data += packet
-                    
-                    try:
-                        rating_info = json.loads(rating_data.decode('utf-8'))
-                        product_name = rating_info['product_name']
-                        seller = rating_info['seller']
-                        buyer = rating_info['buyer']
-                        product_rating = rating_info['product_rating']
-                        seller_rating = rating_info['seller_rating']
-                        
-                        print(f"Processing rating: product={product_name}, seller={seller}, buyer={buyer}, rating={product_rating}")
-                        
-                        conn_db = get_connection()
-                        cursor = conn_db.cursor()
-                        
-                        # Add product rating to product_ratings table with seller info
-                        cursor.execute("""INSERT INTO product_ratings (product_name, seller, buyer, rating, timestamp)
-                                         VALUES (?, ?, ?, ?, datetime('now'))""",
-                                      (product_name, seller, buyer, product_rating))
-                        print(f"Inserted into product_ratings table")
-                        
-                        # Add seller rating to buyer_ratings table (re-purpose for seller ratings)
-                        # Note: buyer_ratings table is used for all user ratings
-                        cursor.execute("""INSERT INTO buyer_ratings (buyer, rating, rated_by, timestamp)
-                                         VALUES (?, ?, ?, datetime('now'))""",
-                                      (seller, seller_rating, buyer))
-                        print(f"Inserted seller rating into buyer_ratings: seller={seller}, rating={seller_rating}")
-                        
-                        # Update average product rating for THIS SPECIFIC SELLER'S product only
-                        cursor.execute("""SELECT rating, numberOfRating FROM productList 
-                                         WHERE product_name = ? AND user_name = ?""",
-                                      (product_name, seller))
-                        prod = cursor.fetchone()
-                        if prod:
-                            current_rating, num_ratings = prod
-                            print(f"Current product stats: rating={current_rating}, count={num_ratings}")
-                            new_num_ratings = num_ratings + 1
-                            new_rating = ((current_rating * num_ratings) + product_rating) / new_num_ratings
-                            print(f"New product stats: rating={new_rating}, count={new_num_ratings}")
-                            cursor.execute("""UPDATE productList SET rating = ?, numberOfRating = ? 
-                                             WHERE product_name = ? AND user_name = ?""",
-                                          (new_rating, new_num_ratings, product_name, seller))
-                            print(f"Updated productList with new rating")
-                        else:
-                            print(f"ERROR: Product not found in productList: {product_name} by {seller}")
-                        
-                        conn_db.commit()
-                        cursor.close()
-                        conn_db.close()
-                        
-                        print(f"Rating saved successfully!")
-                        client_socket.send(b'1')
-                    except Exception as e:
-                        print(f"Error saving ratings: {e}")
-                        import traceback
-                        traceback.print_exc()
-                        client_socket.send(b'0')
-                
-                elif request_code == "23":  # Delete product (owner only)
-                    product_name = client_socket.recv(1024).decode('utf-8').strip('\x00')
-                    if delete_product(product_name, username):
-                        client_socket.send(b'1')
-                    else:
-                        client_socket.send(b'0')
-                
-                elif request_code == "24":  # Check if already purchased
-                    # Receive product name and seller (format: "product_name|seller")
-                    data = client_socket.recv(1024).decode('utf-8').strip('\x00')
-                    
-                    # Parse data - check if seller is included
-                    if '|' in data:
-                        product_name, seller = data.split('|', 1)
-                    else:
-                        # Backwards compatibility
-                        product_name = data
-                        seller = None
                     
-                    if seller and check_already_purchased(username, product_name, seller):
-                        client_socket.send(b'1')  # Already purchased from this seller
-                    else:
-                        client_socket.send(b'0')  # Not purchased from this seller
+                    print(f"Stock reduced successfully. Remaining: {remaining}")
+                    return [b'1']  # Success even if stock is now 0
+                else:
+                    print(f"Failed to reduce stock for {product_name} by {seller}")
+                    return [b'0']  # Failed or negative stock
+            except Exception as e:
+                print(f"Error decrementing stock for {seller}'s {product_name}: {e}")
+                return [b'0']
+        
+        elif request_code == "26":  # Register active chat window
+            other_user = field_text(args[0]).strip()
+            if username not in active_chats:
+                active_chats[username] = set()
+            active_chats[username].add(other_user)
+            print(f"{username} opened chat with {other_user}")
+            return [b'1']
+        
+        elif request_code == "27":  # Unregister active chat window
+            other_user = field_text(args[0]).strip()
+            if username in active_chats:
+                active_chats[username].discard(other_user)
+                if not active_chats[username]:
+                    del active_chats[username]
+            print(f"{username} closed chat with {other_user}")
+            return [b'1']
+        
+        elif request_code == "28":  # Check detailed user status (in chat, online, or offline)
+            check_user = field_text(args[0]).strip()
+            
+            # Check if user has chat open with requester
+            in_chat = username in active_chats and check_user in active_chats.get(username, set())
+            other_has_chat = check_user in active_chats and username in active_chats.get(check_user, set())
+            
+            if in_chat or other_has_chat:
+                return [b'2']  # In chat
+            elif check_user in online_users:
+                return [b'1']  # Online
+            else:
+                return [b'0']  # Offline
+        
+        elif request_code == "29":  # Check if user has new messages since last interaction
+            check_user = field_text(args[0]).strip()
+            
+            # Check if there are unread messages from this user
+            count = get_unread_counts(username).get(check_user, 0)
+            
+            if count > 0:
+                return [b'1']  # Has new messages
+            else:
+                return [b'0']  # No new messages
+        
+        elif request_code == "30":  # Mark messages as read from specific sender
+            sender = field_text(args[0]).strip()
+            mark_messages_read(username, sender)
+            return [b'1']  # Acknowledgment
+        
+        elif request_code == "31":  # Update user profile
+            try:
+                profile_data = json.loads(args[0].decode('utf-8'))
+                prof_username = profile_data.get('username')
+                real_name = profile_data.get('real_name')
+                bio = profile_data.get('bio')
+                profile_picture = profile_data.get('profile_picture')
                 
-                elif request_code == "25":  # Decrement stock after confirmed purchase
-                    length = int.from_bytes(client_socket.recv(16), 'big')
-                    data = b""
-                    while len(data) < length:
-                        packet = client_socket.recv(4096)
-                        if not packet:
-                            break
-                        data += packet
-                    
-                    try:
-                        purchase_info = json.loads(data.decode('utf-8'))
-                        product_name = purchase_info['product_name']
-                        seller = purchase_info['seller']  # needed to identify correct seller's product
-                        quantity = purchase_info.get('quantity', 1)
-                        
-                        print(f"Stock reduction request: product={product_name}, seller={seller}, buyer={username}, qty={quantity}")
-                        
-                        remaining = decrement_product_stock(product_name, seller, quantity)
-                        if remaining is not None and remaining >= 0:
-                            # Record the purchase with seller info
-                            conn_db = get_connection()
-                            cursor = conn_db.cursor()
-                            cursor.execute("INSERT INTO buyers (seller_username, product_name, buyer_username) VALUES (?, ?, ?)",
-                                          (seller, product_name, username))
-                            conn_db.commit()
-                            cursor.close()
-                            conn_db.close()
-                            
-                            print(f"Stock reduced successfully. Remaining: {remaining}")
-                            client_socket.send(b'1')  # Success even if stock is now 0
-                        else:
-                            print(f"Failed to reduce stock for {product_name} by {seller}")
-                            client_socket.send(b'0')  # Failed or negative stock
-                    except Exception as e:
-                        print(f"Error decrementing stock for {seller}'s {product_name}: {e}")
-                        client_socket.send(b'0')
+                if update_user_profile(prof_username, real_name, bio, profile_picture):
+                    return [b'1']  # Success
+                else:
+                    return [b'0']  # Failed
+            except Exception as e:
+                print(f"Error updating profile: {e}")
+                return [b'0']
+        
+        elif request_code == "32":  # Update product details
+            try:
+                update_data = json.loads(args[0].decode('utf-8'))
+                product_name = update_data.get('product_name')
+                quantity = update_data.get('quantity')
+                price = update_data.get('price')
+                description = update_data.get('description')
+                image_b64 = update_data.get('image')
                 
-                elif request_code == "26":  # Register active chat window
-                    other_user = client_socket.recv(1024).decode('utf-8').strip('\x00').strip()
-                    if username not in active_chats:
-                        active_chats[username] = set()
-                    active_chats[username].add(other_user)
-                    client_socket.send(b'1')
-                    print(f"{username} opened chat with {other_user}")
+                conn = get_connection()
+                cursor = conn.cursor()
                 
-                elif request_code == "27":  # Unregister active chat window
-                    other_user = client_socket.recv(1024).decode('utf-8').strip('\x00').strip()
-                    if username in active_chats:
-                        active_chats[username].discard(other_user)
-                        if not active_chats[username]:
-                            del active_chats[username]
-                    client_socket.send(b'1')
-                    print(f"{username} closed chat with {other_user}")
+                # Verify ownership - check for THIS user's product specifically
+                cursor.execute("SELECT user_name FROM productList WHERE product_name = ? AND user_name = ?",
+                              (product_name, username))
+                result = cursor.fetchone()
                 
-                elif request_code == "28":  # Check detailed user status (in chat, online, or offline)
-                    check_user = client_socket.recv(1024).decode('utf-8').strip('\x00').strip()
-                    
-                    # Check if user has chat open with requester
-                    in_chat = username in active_chats and check_user in active_chats.get(username, set())
-                    other_has_chat = check_user in active_chats and username in active_chats.get(check_user, set())
-                    
-                    if in_chat or other_has_chat:
-                        client_socket.send(b'2')  # In chat
-                    elif check_user in online_users:
-                        client_socket.send(b'1')  # Online
+                if result:
+                    # Update THIS user's product only
+                    if image_b64:
+                        image_hash = put_image(cursor, base64.b64decode(image_b64), ('card', 'detail'))
+                        cursor.execute("""UPDATE productList
+                                        SET quantity = ?, price = ?, description = ?, image_hash = ?
+                                        WHERE product_name = ? AND user_name = ?""",
+                                     (quantity, price, description, image_hash, product_name, username))
                     else:
-                        client_socket.send(b'0')  # Offline
-                
-                elif request_code == "29":  # Check if user has new messages since last interaction
-                    check_user = client_socket.recv(1024).decode('utf-8').strip('\x00').strip()
+                        cursor.execute("""UPDATE productList
+                                        SET quantity = ?, price = ?, description = ?
+                                        WHERE product_name = ? AND user_name = ?""",
+                                     (quantity, price, description, product_name, username))
                     
-                    # Check if there are unread messages from this user
-                    conn = get_connection()
-                    cursor = conn.cursor()
-                    cursor.execute("""SELECT COUNT(*) FROM chat_messages 
-                                    WHERE receiver = ? AND sender = ? AND is_read = 0""",
-                                 (username, check_user))
-                    count = cursor.fetchone()[0]
+                    conn.commit()
                     cursor.close()
                     conn.close()
-                    
-                    if count > 0:
-                        client_socket.send(b'1')  # Has new messages
-                    else:
-                        client_socket.send(b'0')  # No new messages
-                
-                elif request_code == "30":  # Mark messages as read from specific sender
-                    sender = client_socket.recv(1024).decode('utf-8').strip('\x00').strip()
-                    mark_messages_read(username, sender)
-                    client_socket.send(b'1')  # Acknowledgment
-                
-                elif request_code == "31":  # Update user profile
-                    length = int.from_bytes(client_socket.recv(16), 'big')
-                    data = b""
-                    while len(data) < length:
-                        packet = client_socket.recv(4096)
-                        if not packet:
-                            break
-                        data += packet
-                    
-                    try:
-                        profile_data = json.loads(data.decode('utf-8'))
-                        prof_username = profile_data.get('username')
-                        real_name = profile_data.get('real_name')
-                        bio = profile_data.get('bio')
-                        profile_picture = profile_data.get('profile_picture')
-                        
-                        if update_user_profile(prof_username, real_name, bio, profile_picture):
-                            client_socket.send(b'1')  # Success
-                        else:
-                            client_socket.send(b'0')  # Failed
-                    except Exception as e:
-                        print(f"Error updating profile: {e}")
-                        client_socket.send(b'0')
-                
-                elif request_code == "32":  # Update product details
-                    length = int.from_bytes(client_socket.recv(16), 'big')
-                    data = b""
-                    while len(data) < length:
-                        packet = client_socket.recv(4096)
-                        if not packet:
-                            break
-                        data += packet
-                    
-                    try:
-                        update_data = json.loads(data.decode('utf-8'))
-                        product_name = update_data.get('product_name')
-                        quantity = update_data.get('quantity')
-                        price = update_data.get('price')
-                        description = update_data.get('description')
-                        image_b64 = update_data.get('image')
-                        
-                        conn = get_connection()
-                        cursor = conn.cursor()
-                        
-                        # Verify ownership - check for THIS user's product specifically
-                        cursor.execute("SELECT user_name FROM productList WHERE product_name = ? AND user_name = ?", 
-                                      (product_name, username))
-                        result = cursor.fetchone()
-                        
-                        if result:
-                            # Update THIS user's product only
-                            if image_b64:
-                                image_blob = base64.b64decode(image_b64)
-                                cursor.execute("""UPDATE productList 
-                                                SET quantity = ?, price = ?, description = ?, image = ?
-                                                WHERE product_name = ? AND user_name = ?""",
-                                             (quantity, price, description, image_blob, product_name, username))
-                            else:
-                                cursor.execute("""UPDATE productList 
-                                                SET quantity = ?, price = ?, description = ?
-                                                WHERE product_name = ? AND user_name = ?""",
-                                             (quantity, price, description, product_name, username))
-                            
-                            conn.commit()
-                            cursor.close()
-                            conn.close()
-                            print(f"Product '{product_name}' updated by {username}")
-                            client_socket.send(b'1')  # Success
-                        else:
-                            cursor.close()
-                            conn.close()
-                            print(f"Failed to update: {username} does not own product '{product_name}'")
-                            client_socket.send(b'0')  # Not owner or doesn't exist
-                    except Exception as e:
-                        print(f"Error updating product: {e}")
-                        import traceback
-                        traceback.print_exc()
-                        client_socket.send(b'0')
-                
-                elif request_code == "b":  # Buy request - placeholder for chat functionality
-                    # This needs to be implemented with the buying flow
-                    pass
-                
+                    print(f"Product '{product_name}' updated by {username}")
+                    return [b'1']  # Success
+                else:
+                    cursor.close()
+                    conn.close()
+                    print(f"Failed to update: {username} does not own product '{product_name}'")
+                    return [b'0']  # Not owner or doesn't exist
             except Exception as e:
-                print(f"Error handling request '{request_code}': {e}")
+                print(f"Error updating product: {e}")
                 import traceback
                 traceback.print_exc()
-                try:
-                    client_socket.send(b'0')  # Send error response
-                except:
+                return [b'0']
+        
+        elif request_code == "34":  # Database pool and group-commit stats
+            stats = get_pool().stats()
+            stats['group_commit'] = get_chat_writer().stats()
+            stats['unread_cache'] = unread_cache_stats()
+            stats['admission'] = admission.stats()
+            return [b'1', json.dumps(stats)]
+        
+        elif request_code == "42":  # Request metrics: [] -> [1, json]
+            return [b'1', json.dumps(request_metrics.stats())]
+        
+        elif request_code == "43":  # Slow query log: [top N] -> [1, json], or [0] when it is off
+            if query_log is None:
+                return [b'0']
+            top = int(field_text(args[0])) if args and args[0] else slow_query_top
+            return [b'1', json.dumps(query_log.report(top))]
+        
+        elif request_code == "35":  # Catalog page: [page size, cursor] -> [1, products, next cursor, version]
+            try:
+                page_size = int(field_text(args[0])) if args and args[0] else CATALOG_PAGE_SIZE
+            except ValueError:
+                return [b'2']
+            cursor_text = field_text(args[1]) if len(args) > 1 else ""
+            page = get_product_page(page_size, cursor_text)
+            if page is None:
+                return [b'2']  # not a cursor from this server: page again from the start
+            products, next_cursor, version = page
+            return [b'1', json.dumps(products), next_cursor or b'', version]
+        
+        elif request_code == "36":  # Product search: [query, page size, cursor] -> [1, products, next cursor]
+            query = field_text(args[0])
+            page_size = int(field_text(args[1])) if len(args) > 1 and args[1] else CATALOG_PAGE_SIZE
+            cursor_text = field_text(args[2]) if len(args) > 2 else ""
+            products, next_cursor = search_products(query, page_size, cursor_text)
+            if products is None:
+                return [b'2']  # not a cursor from this server: search again from the first page
+            return [b'1', json.dumps(products), next_cursor or b'']
+        
+        elif request_code == "37":  # Catalog changes since version N -> [1, changes, version] or [2, version] to resync
+            since_version = int(field_text(args[0]))
+            changes, version = get_catalog_changes(since_version)
+            if changes is None:
+                return [b'2', version]
+            return [b'1', json.dumps(changes), version]
+        
+        elif request_code == "38":  # Catalog snapshot: [etag, "zlib" if accepted] -> [3], [2] or [1, etag, version, encoding, products]
+            etag = field_text(args[0]) if args else ""
+            accepts_zlib = len(args) > 1 and field_text(args[1]) == "zlib"
+            snapshot = get_catalog_snapshot()
+            if etag == snapshot['etag']:
+                return [NOT_MODIFIED]
+            if accepts_zlib:
+                if len(snapshot['compressed']) > MAX_SNAPSHOT_BYTES:
+                    return [TOO_LARGE]
+                return [b'1', snapshot['etag'], snapshot['version'], b'zlib', snapshot['compressed']]
+            if snapshot['size'] > MAX_SNAPSHOT_BYTES:
+                return [TOO_LARGE]
+            return [b'1', snapshot['etag'], snapshot['version'], b'', zlib.decompress(snapshot['compressed'])]
+        
+        elif request_code == "44":  # Images by hash: [hash, ...] -> [1, {hash: base64 or null}] for a prefix of them
+            hashes = list(dict.fromkeys(field_text(arg) for arg in args if arg))
+            if not hashes:
+                return [b'2']
+            return [b'1', json.dumps(get_images(hashes))]
+        
+        elif request_code == "39":  # Messages screen: [1, conversations with last message and unread count]
+            return [b'1', json.dumps(get_conversation_summaries(username))]
+        
+        elif request_code == "40":  # Chat history page: [other user, before id, after id, page size] -> [1, messages, more]
+            other_user = field_text(args[0]).strip()
+            try:
+                before_id = int(field_text(args[1])) if len(args) > 1 and args[1] else None
+                after_id = int(field_text(args[2])) if len(args) > 2 and args[2] else None
+                page_size = int(field_text(args[3])) if len(args) > 3 and args[3] else CHAT_PAGE_SIZE
+            except ValueError:
+                return [b'2']  # ids and page size must be integers
+            if any(message_id is not None and not 0 <= message_id <= MAX_MESSAGE_ID
+                   for message_id in (before_id, after_id)):
+                return [b'2']  # past what SQLite can bind
+            # get_chat_page clamps the page size to 1..MAX_CHAT_PAGE_SIZE
+            messages, more = get_chat_page(username, other_user, before_id, after_id, page_size)
+            return [b'1', json.dumps(messages), b'1' if more else b'0']
+        
+        elif request_code == "b":  # Buy request - placeholder for chat functionality
+            # This needs to be implemented with the buying flow
+            return [b'0']
+        
+        print(f"Unknown request code '{request_code}' from {username}")
+        return [b'0']
+    except Exception as e:
+        print(f"Error handling request '{request_code}': {e}")
+        import traceback
+        traceback.print_exc()
+        raise  # the caller replies 0 and counts the error
+
+class ClientSession:
+    # One connected client. Replies to its requests can be written by several
+    # worker threads at once, so every frame goes out under send_lock.
+    def __init__(self, client_socket, address):
+        self.socket = client_socket
+        self.address = address
+        self.username = None
+        self.subscribed = False  # set by SUBSCRIBE_CODE; events are only pushed after that
+        self.send_lock = threading.Lock()
+        self.in_flight = 0  # requests handed to the workers and not yet answered
+        self.in_flight_lock = threading.Lock()
+    
+    def start_request(self):
+        with self.in_flight_lock:
+            self.in_flight += 1
+    
+    def finish_request(self):
+        with self.in_flight_lock:
+            self.in_flight -= 1
+    
+    def send(self, kind, request_id, fields):
+        with self.send_lock:
+            return send_frame(self.socket, kind, request_id, fields)
+
+class AsyncClientSession(ClientSession):
+    def __init__(self, client_socket, address, loop):
+        super().__init__(client_socket, address)
+        self.loop = loop
+        self.send_lock = asyncio.Lock()
+    
+    def send(self, kind, request_id, fields):
+        # pushed events come from worker threads; hand the write to the loop
+        # without waiting so a slow receiver never holds up the sender
+        asyncio.run_coroutine_threadsafe(self.send_async(kind, request_id, fields), self.loop)
+    
+    async def send_async(self, kind, request_id, fields):
+        async with self.send_lock:
+            return await send_frame_async(self.loop, self.socket, kind, request_id, fields)
+
+def dispatch_request(session, fields):
+    # returns the reply fields; a successful login/signup sets session.username
+    if not fields:
+        raise ProtocolError("Empty request")
+    request_code = field_text(fields[0])
+    args = fields[1:]
+    
+    try:
+        if session.username is None:
+            reply, session.username = authenticate_client(session, request_code.lower(), args)
+            return reply
+        if request_code == SUBSCRIBE_CODE:
+            session.subscribed = True
+            return [b'1']
+        return handle_request(session.username, request_code, args)
+    finally:
+        get_pool().release_thread()  # a helper that failed half-way may not have closed
+
+def runs_in_order(session, fields):
+    # login and logout change who the session belongs to, so they are never
+    # overlapped with other requests on the same connection
+    return session.username is None or (fields and field_text(fields[0]) == LOGOUT_CODE)
+
+def run_request(session, fields):
+    # dispatch_request plus what the metrics need: (reply, raised, seconds spent in SQLite)
+    pool = get_pool()
+    pool.take_thread_time()  # drop anything charged to this thread outside a request
+    if query_log is not None:
+        query_log.set_context(field_text(fields[0]) if fields else "", session.username)
+    try:
+        reply, raised = dispatch_request(session, fields), False
+    except Exception as e:
+        print(f"Error handling request from {session.address}: {e}")
+        reply, raised = [b'0'], True
+    finally:
+        if query_log is not None:
+            query_log.set_context()
+    return reply, raised, pool.take_thread_time()
+
+def record_request(fields, logged_in, received, sending, reply, bytes_out, raised, db_seconds):
+    finished = time.perf_counter()
+    code = field_text(fields[0]) if fields else ""
+    if not logged_in:
+        code = code.lower()  # login choices are matched case-insensitively
+    request_metrics.record(code, finished - received, frame_size(fields), bytes_out, raised,
+                           not raised and reply[:1] == [b'0'], db_seconds, finished - sending)
+
+def metrics_gauges():
+    admitted = admission.stats()
+    return {
+        'connections': admitted['connections'],
+        'pending_requests': admitted['pending_requests'],
+        'idle_db_readers': get_pool().idle_readers.qsize(),
+        'chat_writes_queued': get_chat_writer().pending.qsize(),
+    }
+
+def export_metrics_loop(path, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            request_metrics.write_prometheus(path, metrics_gauges())
+        except Exception as e:
+            print(f"Error writing metrics to {path}: {e}")
+
+def resident_memory_mb():
+    # current RSS from /proc where there is one; None elsewhere
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1 << 20)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def dashboard_gauges():
+    # everything here is a dict or counter read: no database work, and the
+    # catalog is only reported as last built, never built for the dashboard
+    snapshot = catalog_snapshot
+    # client threads log users in and out meanwhile; list() copies the keys in
+    # one step, where iterating the live dict could see it change size
+    usernames = sorted(list(online_users))
+    return {
+        **metrics_gauges(),
+        'online': len(usernames),
+        'online_users': usernames,
+        'active_chats': sum(len(others) for others in list(active_chats.values())),
+        'threads': threading.active_count(),
+        'rss_mb': resident_memory_mb(),
+        'catalog_products': snapshot['products'] if snapshot else None,
+        'catalog_kb': snapshot['size'] / 1024 if snapshot else None,
+    }
+
+def sample_metrics_loop(interval):
+    while True:
+        try:
+            metrics_history.sample(request_metrics, dashboard_gauges())
+        except Exception as e:
+            print(f"Error sampling metrics: {e}")
+        time.sleep(interval)
+
+def serve_forever(server_socket, executor, mode):
+    if mode == 'async':
+        asyncio.run(serve_async(server_socket, executor))
+        return
+    while True:
+        try:
+            client_socket, address = server_socket.accept()
+        except OSError:
+            return  # listening socket closed on shutdown
+        reason = admission.admit(address[0])
+        if reason:
+            reject_client(client_socket, address, reason)
+            continue
+        client_thread = threading.Thread(target=handle_client, args=(client_socket, address, executor))
+        client_thread.daemon = True
+        client_thread.start()
+
+def serve_request(session, request_id, fields, received):
+    # received: perf_counter() when the frame arrived, so queueing counts toward latency
+    logged_in = session.username is not None  # before the request: a login is labelled as one
+    reply, raised, db_seconds = run_request(session, fields)
+    sending = time.perf_counter()
+    bytes_out = 0
+    try:
+        bytes_out = session.send(KIND_RESPONSE, request_id, reply)
+    except OSError:
+        pass  # client went away while the request was running
+    record_request(fields, logged_in, received, sending, reply, bytes_out, raised, db_seconds)
+
+def serve_admitted(session, request_id, fields, received):
+    # a request counted by admission.begin_request() and session.start_request()
+    try:
+        serve_request(session, request_id, fields, received)
+    finally:
+        session.finish_request()
+        admission.end_request()
+
+async def serve_request_async(session, executor, request_id, fields, received):
+    loop = asyncio.get_running_loop()
+    logged_in = session.username is not None
+    reply, raised, db_seconds = await loop.run_in_executor(executor, run_request, session, fields)
+    sending = time.perf_counter()
+    bytes_out = 0
+    try:
+        bytes_out = await session.send_async(KIND_RESPONSE, request_id, reply)
+    except OSError:
+        pass  # client went away while the request was running
+    record_request(fields, logged_in, received, sending, reply, bytes_out, raised, db_seconds)
+
+def is_heartbeat(fields):
+    return bool(fields) and field_text(fields[0]) == HEARTBEAT_CODE
+
+def reject_client(client_socket, address, reason):
+    # no room for this connection: say why, then hang up before any thread or task is spent on it
+    print(f"Rejected connection from {address}: {reason}")
+    try:
+        send_frame(client_socket, KIND_EVENT, EVENT_REQUEST_ID, [BUSY_EVENT, json.dumps({'reason': reason})])
+    except OSError:
+        pass
+    try:
+        client_socket.close()
+    except OSError:
+        pass
+
+def disconnect_client(client_socket, address, username):
+    admission.release(address[0])
+    # Unregister user if they were online
+    if username:
+        unregister_online_user(username)
+        # Clean up active chats
+        if username in active_chats:
+            del active_chats[username]
+    try:
+        client_socket.close()
+    except:
+        pass
+    print(f"Client disconnected: {address}")
+
+def handle_client(client_socket, address, executor):
+    # This thread only reads frames; requests run on the shared worker pool and
+    # may answer out of order, each reply tagged with its request id.
+    print(f"Client connected from {address}")
+    session = ClientSession(client_socket, address)
+    
+    try:
+        while True:
+            try:
+                # idle time is only enforced on receives: the socket stays
+                # blocking, so replies to a slow reader are never cut off
+                frame = recv_frame(client_socket, admission.idle_timeout or None)
+                
+                if frame is None:
                     break
+            except socket.timeout:
+                if session.in_flight:
+                    continue  # waiting on its replies is not idle
+                print(f"Closing idle connection {address}")
+                admission.record_idle_close()
+                break
+            except Exception as receive_error:
+                print(f"Error receiving request: {receive_error}")
+                break
+            
+            received = time.perf_counter()
+            kind, request_id, fields = frame
+            if is_heartbeat(fields):
+                session.send(KIND_RESPONSE, request_id, [b'1'])
+            elif runs_in_order(session, fields):
+                serve_request(session, request_id, fields, received)
+                if session.username and field_text(fields[0]) == LOGOUT_CODE:
+                    break
+            elif admission.begin_request():
+                session.start_request()
+                executor.submit(serve_admitted, session, request_id, fields, received)
+            else:
+                session.send(KIND_RESPONSE, request_id, [SERVER_BUSY])
     
     except Exception as e:
         print(f"Error handling client: {e}")
         import traceback
         traceback.print_exc()
     finally:
-        # Unregister user if they were online
-        if username:
-            unregister_online_user(username)
-            # Clean up active chats
-            if username in active_chats:
-                del active_chats[username]
-        try:
-            client_socket.close()
-        except:
-            pass
-        print(f"Client disconnected: {address}")
+        disconnect_client(client_socket, address, session.username)
+
+async def handle_client_async(client_socket, address, executor):
+    # Same protocol as handle_client, but an idle connection is just a pending
+    # sock_recv on the event loop instead of a parked OS thread.
+    loop = asyncio.get_running_loop()
+    client_socket.setblocking(False)
+    print(f"Client connected from {address}")
+    session = AsyncClientSession(client_socket, address, loop)
+    in_flight = set()
+    
+    try:
+        while True:
+            try:
+                # only the receives are timed, as in handle_client; a timeout
+                # with part of a frame read is an error, not idleness
+                frame = await recv_frame_async(loop, client_socket, admission.idle_timeout or None)
+                
+                if frame is None:
+                    break
+            except socket.timeout:
+                if in_flight:
+                    continue  # waiting on its replies is not idle
+                print(f"Closing idle connection {address}")
+                admission.record_idle_close()
+                break
+            except Exception as receive_error:
+                print(f"Error receiving request: {receive_error}")
+                break
+            
+            received = time.perf_counter()
+            kind, request_id, fields = frame
+            if is_heartbeat(fields):
+                await session.send_async(KIND_RESPONSE, request_id, [b'1'])
+            elif runs_in_order(session, fields):
+                await serve_request_async(session, executor, request_id, fields, received)
+                if session.username and field_text(fields[0]) == LOGOUT_CODE:
+                    break
+            elif admission.begin_request():
+                task = loop.create_task(serve_request_async(session, executor, request_id, fields, received))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+                task.add_done_callback(lambda _: admission.end_request())
+            else:
+                await session.send_async(KIND_RESPONSE, request_id, [SERVER_BUSY])
+    
+    except Exception as e:
+        print(f"Error handling client: {e}")
+        import traceback
+        traceback.print_exc()
+    finally:
+        disconnect_client(client_socket, address, session.username)
+
+async def serve_async(server_socket, executor):
+    loop = asyncio.get_running_loop()
+    server_socket.setblocking(False)
+    client_tasks = set()
+    
+    while True:
+        client_socket, address = await loop.sock_accept(server_socket)
+        reason = admission.admit(address[0])
+        if reason:
+            reject_client(client_socket, address, reason)
+            continue
+        task = loop.create_task(handle_client_async(client_socket, address, executor))
+        client_tasks.add(task)
+        task.add_done_callback(client_tasks.discard)
 
 def main():
+    parser = argparse.ArgumentParser(description="Marketplace server")
+    parser.add_argument('--mode', choices=['threaded', 'async'], default='threaded',
+                        help="threaded: one reader thread per client; async: one event loop for all clients")
+    parser.add_argument('--workers', type=int, default=16,
+                        help="request worker threads shared by all clients")
+    parser.add_argument('--backlog', type=int, default=socket.SOMAXCONN,
+                        help="pending connection queue size")
+    parser.add_argument('--db-readers', type=int, default=None,
+                        help=f"pooled SQLite reader connections (default: one per worker plus {BACKGROUND_READERS})")
+    parser.add_argument('--statement-cache', type=int, default=256,
+                        help="prepared statements cached per pooled connection")
+    parser.add_argument('--storage-profile', choices=sorted(STORAGE_PROFILES), default='durable',
+                        help="durable: fsync every commit; throughput: WAL with synchronous=NORMAL and a larger cache")
+    parser.add_argument('--commit-delay', type=float, default=2.0,
+                        help="ms the chat writer waits to batch more messages into one commit")
+    parser.add_argument('--commit-batch', type=int, default=256,
+                        help="most chat writes committed together")
+    parser.add_argument('--unread-reconcile', type=float, default=60.0,
+                        help="seconds between re-reading the cached unread counts from the database")
+    parser.add_argument('--reservation-hours', type=float, default=48.0,
+                        help="how long an approved purchase holds its stock before it is released")
+    parser.add_argument('--max-connections', type=int, default=1000,
+                        help="open client connections allowed at once (0: unlimited)")
+    parser.add_argument('--max-per-ip', type=int, default=0,
+                        help="open connections allowed from one address (0: unlimited)")
+    parser.add_argument('--max-pending', type=int, default=None,
+                        help="requests queued or running on the worker pool before new ones get 'server busy' "
+                             "(default: 16 per worker, 0: unlimited)")
+    parser.add_argument('--idle-timeout', type=float, default=180.0,
+                        help="seconds a connection may send nothing, not even a heartbeat, before it is closed (0: never)")
+    parser.add_argument('--metrics-file', default=None,
+                        help="write per-request-code metrics to this file in Prometheus text format")
+    parser.add_argument('--metrics-interval', type=float, default=15.0,
+                        help="seconds between rewrites of --metrics-file")
+    parser.add_argument('--slow-query-ms', type=float, default=None,
+                        help="log SQL statements slower than this many ms (off by default); read with request 43")
+    parser.add_argument('--slow-query-file', default=None,
+                        help="also append each slow statement to this file as a JSON line")
+    parser.add_argument('--slow-query-top', type=int, default=20,
+                        help="most expensive normalized statements listed by request 43")
+    parser.add_argument('--dashboard', action='store_true',
+                        help="open a live dashboard window (connections, request rates, SQLite time, memory)")
+    parser.add_argument('--check-indexes', action='store_true',
+                        help="print the query plan of every hot query and exit (status 1 if any scans)")
+    args = parser.parse_args()
+    
+    if args.check_indexes:
+        connection = sqlite3.connect('marketplace.db')
+        results = check_query_plans(connection)
+        connection.close()
+        for name, plan, ok in results:
+            print(f"{'ok  ' if ok else 'SCAN'} {name}: {'; '.join(plan)}")
+        raise SystemExit(0 if all(ok for _, _, ok in results) else 1)
+    
+    global db_pool
+    db_pool = DatabasePool('marketplace.db', readers=args.db_readers or args.workers + BACKGROUND_READERS,
+                           statement_cache=args.statement_cache, profile=args.storage_profile)
+    print(f"Database {db_pool.describe()}")
+    global query_log, slow_query_top
+    if args.slow_query_ms is not None:
+        query_log = SlowQueryLog(args.slow_query_ms / 1000, path=args.slow_query_file)
+        db_pool.statement_log = query_log
+        slow_query_top = args.slow_query_top
+        print(f"Logging SQL statements slower than {args.slow_query_ms} ms")
+    global chat_writer
+    chat_writer = GroupCommitWriter(db_pool, max_batch=args.commit_batch, max_delay=args.commit_delay / 1000)
+    threading.Thread(target=reconcile_unread_loop, args=(args.unread_reconcile,), daemon=True).start()
+    global reservation_ttl
+    reservation_ttl = args.reservation_hours * 3600
+    threading.Thread(target=expire_reservations_loop, args=(60,), daemon=True).start()
+    global admission
+    admission = AdmissionControl(max_connections=args.max_connections, per_ip=args.max_per_ip,
+                                 max_pending=args.workers * 16 if args.max_pending is None else args.max_pending,
+                                 idle_timeout=args.idle_timeout)
+    if args.metrics_file:
+        threading.Thread(target=export_metrics_loop, args=(args.metrics_file, args.metrics_interval),
+                         daemon=True).start()
+    
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     #change port here and user if you want to change where server and clietns connect to
     port = 10001
     
     server_socket.bind((socket.gethostbyname(socket.gethostname()), port))
-    server_socket.listen(5)
+    server_socket.listen(args.backlog)
+    
+    # bounded pool for the blocking SQLite work behind each request
+    executor = ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="request-worker")
     
-    print(f"Server listening on port {port}")
+    print(f"Server listening on port {port} ({args.mode} mode)")
     print(f"Server address: {socket.gethostbyname(socket.gethostname())}:{port}")
     
+    dashboard = None
+    if args.dashboard:
+        try:
+            from ServerDashboard import open_dashboard  # Tk only when asked for
+            dashboard = open_dashboard(metrics_history)
+        except Exception as e:
+            print(f"Dashboard unavailable ({e}), serving without it")
+        else:
+            threading.Thread(target=sample_metrics_loop, args=(1,), daemon=True).start()
+    
     try:
-        while True:
-            client_socket, address = server_socket.accept()
-            client_thread = threading.Thread(target=handle_client, args=(client_socket, address))
-            client_thread.daemon = True
-            client_thread.start()
+        if dashboard is not None:
+            # Tk wants the main thread; the server runs beside it until the window closes
+            threading.Thread(target=serve_forever, args=(server_socket, executor, args.mode), daemon=True).start()
+            dashboard.mainloop()
+            print("Dashboard closed, server shutting down...")
+        else:
+            serve_forever(server_socket, executor, args.mode)
     except KeyboardInterrupt:
         print("\nServer shutting down...")
     finally:
+        executor.shutdown(wait=False, cancel_futures=True)
         server_socket.close()
+        chat_writer.close()
+        print(f"Database pool: {json.dumps(db_pool.stats())}")
+        print(f"Chat group commit: {json.dumps(chat_writer.stats())}")
+        print(f"Admission: {json.dumps(admission.stats())}")
+        print(f"Request metrics: {json.dumps(request_metrics.stats())}")
+        if query_log is not None:
+            print(f"Most expensive statements: {json.dumps(query_log.top(slow_query_top))}")
+            query_log.close()
+        if args.metrics_file:
+            request_metrics.write_prometheus(args.metrics_file, metrics_gauges())
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,63 @@
+import os
+import sys
+import sqlite3
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Every query in ServerGUI.HOT_QUERIES must be answered from an index on the
+# schema the server builds. ServerGUI builds marketplace.db in the working
+# directory when it is imported, so it is imported from an empty temp dir.
+
+server = None
+workdir = None
+
+
+def setUpModule():
+    global server, workdir
+    workdir = tempfile.TemporaryDirectory()
+    cwd = os.getcwd()
+    os.chdir(workdir.name)
+    try:
+        import ServerGUI
+        server = ServerGUI
+    finally:
+        os.chdir(cwd)
+
+
+def tearDownModule():
+    workdir.cleanup()
+
+
+class QueryPlanTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(os.path.join(workdir.name, 'marketplace.db'))
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_hot_queries_use_indexes(self):
+        results = server.check_query_plans(self.conn)
+        self.assertEqual(len(results), len(server.HOT_QUERIES))
+        for name, plan, ok in results:
+            with self.subTest(query=name):
+                self.assertTrue(ok, f"{name} scans: {plan}")
+
+    def test_full_reads(self):
+        # The only exemption is build_catalog_snapshot: it serializes every
+        # product in stock, once per catalog version, so it must read all of
+        # productList and an index on quantity would only add lookups. It may
+        # scan that table and nothing else; the thumbnail join stays a search.
+        self.assertEqual(server.FULL_READS, {'build_catalog_snapshot'})
+        for name in server.FULL_READS:
+            query, params = server.HOT_QUERIES[name]
+            self.assertEqual(params, ())  # takes no key to search by
+            self.assertNotIn('LIMIT', query)
+            plan = [row[3] for row in self.conn.execute(f"EXPLAIN QUERY PLAN {query}")]
+            self.assertEqual([step for step in plan if step.startswith('SCAN ')], ['SCAN productList'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import os
+import sys
+import sqlite3
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import RatingStore
+
+# The trigger-maintained rating totals must be what RatingStore.rebuild()
+# computes from the rating rows, including after a product is deleted and
+# listed again under the same name (which starts it unrated).
+
+
+def create_tables(cursor):
+    # the columns of ServerGUI's tables that the rating triggers touch
+    cursor.execute("""CREATE TABLE productList (
+        product_name TEXT NOT NULL,
+        user_name TEXT NOT NULL,
+        rating REAL DEFAULT 0,
+        quantity INTEGER DEFAULT 1,
+        numberOfRating INTEGER DEFAULT 0,
+        UNIQUE(product_name, user_name)
+    )""")
+    cursor.execute("""CREATE TABLE product_ratings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        product_name TEXT NOT NULL,
+        seller TEXT NOT NULL,
+        buyer TEXT NOT NULL,
+        rating INTEGER NOT NULL,
+        review TEXT,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    )""")
+    cursor.execute("""CREATE TABLE buyer_ratings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        buyer TEXT NOT NULL,
+        rating INTEGER NOT NULL,
+        rated_by TEXT NOT NULL,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    )""")
+
+
+class RebuildMatchesTriggersTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.cursor = self.conn.cursor()
+        create_tables(self.cursor)
+        RatingStore.create_schema(self.cursor)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def list_product(self, name, seller):
+        self.cursor.execute("INSERT INTO productList (product_name, user_name) VALUES (?, ?)", (name, seller))
+
+    def rate(self, name, seller, buyer, stars):
+        self.cursor.execute("INSERT INTO product_ratings (product_name, seller, buyer, rating) VALUES (?, ?, ?, ?)",
+                            (name, seller, buyer, stars))
+        self.cursor.execute("INSERT INTO buyer_ratings (buyer, rating, rated_by) VALUES (?, ?, ?)",
+                            (seller, stars, buyer))
+
+    def aggregates(self):
+        self.cursor.execute("SELECT * FROM product_rating_totals ORDER BY product_name, seller")
+        products = self.cursor.fetchall()
+        self.cursor.execute("SELECT product_name, user_name, rating, numberOfRating FROM productList "
+                            "ORDER BY product_name, user_name")
+        listings = self.cursor.fetchall()
+        self.cursor.execute("SELECT * FROM user_rating_totals ORDER BY username")
+        users = self.cursor.fetchall()
+        return products, listings, users
+
+    def assert_rebuild_agrees(self):
+        live = self.aggregates()
+        RatingStore.rebuild(self.cursor)
+        self.assertEqual(self.aggregates(), live)
+
+    def test_ratings(self):
+        self.list_product('lamp', 'sam')
+        self.list_product('desk', 'sam')
+        self.rate('lamp', 'sam', 'ann', 5)
+        self.rate('lamp', 'sam', 'bob', 2)
+        self.rate('desk', 'sam', 'ann', 4)
+        self.assert_rebuild_agrees()
+
+    def test_delete_and_relist(self):
+        self.list_product('lamp', 'sam')
+        self.rate('lamp', 'sam', 'ann', 1)
+        self.rate('lamp', 'sam', 'bob', 2)
+        self.cursor.execute("DELETE FROM productList WHERE product_name = 'lamp' AND user_name = 'sam'")
+        self.list_product('lamp', 'sam')
+        self.assert_rebuild_agrees()
+
+        self.rate('lamp', 'sam', 'cat', 5)
+        products, listings, _ = self.aggregates()
+        self.assertEqual(products, [('lamp', 'sam', 5, 1)])  # the earlier listing's ratings are gone
+        self.assertEqual(listings, [('lamp', 'sam', 5.0, 1)])
+        self.assert_rebuild_agrees()
+
+    def test_rating_for_unlisted_product(self):
+        # e.g. a purchase completed after the seller deleted the listing
+        self.rate('lamp', 'sam', 'ann', 3)
+        self.list_product('lamp', 'sam')
+        self.assert_rebuild_agrees()
+        self.assertEqual(self.aggregates()[0], [])
+
+
+if __name__ == "__main__":
+    unittest.main()